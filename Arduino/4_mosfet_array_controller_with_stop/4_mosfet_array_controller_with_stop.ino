@@ -1,15 +1,54 @@
 const int dataPin=10;
 const int latchPin=11;
 const int clockPin=12;
-uint32_t switch_state; 
+
+// ready banner, sent from setup() and on "version": ready:<firmware>:<version>
+#define BANNER "ready:mosfet_array:8"
+
+// shift registers in the chain, 8 channels each; "width" reports the channels.
+// Build with 8 for 64 channels, 16 for 128
+#define chain_bytes 4
+#if chain_bytes < 4 || chain_bytes > 16
+#error "chain_bytes must be 4..16"
+#endif
+#define n_channels (8 * chain_bytes)
+
+// one state of the whole chain, byte 0 = channels 0-7
+struct chain_t {
+  uint8_t b[chain_bytes];
+};
 
 //#define verbose
-#define seq_size 200
-#define state_mem 6*seq_size 
+#define state_mem 1200
+#define step_bytes (chain_bytes + 2)             // plain step: state + uint16 delay
+#define code_capacity (state_mem - step_bytes)   // bytes usable by programs
+
+// program slots share code_sequence, stored back to back:
+// slot k holds slot_len[k] bytes starting at byte slot_start[k]
+#define max_slots 8
+size_t slot_start[max_slots];
+size_t slot_len[max_slots];
+bool slot_used[max_slots];
+// a slot holds either plain 6-byte steps (addcode) or a packed program (packed + addbytes)
+bool slot_packed[max_slots];
+size_t cur_slot = 0;   // slot used by clearcode/addcode/printcode/exec, set by select:k
 
-size_t len_code = 0; 
+// step delays are counted in ticks of the slot's timer tick (default 1 ms), set by tick:<us>
+#define default_tick_us 1000
+#define min_tick_us (25 * chain_bytes)   // the interrupt needs ~10 us per byte to shift out a new state
+#define max_tick_us 32767    // 16-bit compare register at 2 counts per us
+uint16_t slot_tick[max_slots];
+
+size_t len_code = 0;   // bytes used by all slots together
 char code_sequence[state_mem];
 
+// position of an interrupted exec, continued by "resume" (-1: nothing paused)
+int paused_slot = -1;
+size_t paused_pos, paused_step;
+chain_t paused_state;
+uint32_t paused_dur, paused_left;
+bool pos_reported = false;   // the interrupt just reported it, "pause" stays quiet
+
 
 static bool parseUint32(const String & s, uint32_t & out) {
   out=0; size_t l =  s.length(); 
@@ -36,16 +75,250 @@ static bool parseUint32(const String & s, uint32_t & out) {
 }
 
 
-void write32bits(uint32_t st){
+// state argument of setstate/addcode: "0x" + lower-case hex of up to n_channels bits,
+// or a decimal number for the first 32 channels
+static bool parseState(const String & s, chain_t & out) {
+  memset(out.b, 0, chain_bytes);
+  size_t l = s.length();
+  if(!s.startsWith("0x")) {
+    uint32_t v;
+    if(!parseUint32(s, v)) return false;
+    memcpy(out.b, &v, 4);
+    return true;
+  }
+  // from the last digit on, two digits per byte
+  for(size_t i = 0; i + 2 < l; ++i) {
+    char c = s[l - 1 - i];
+    uint8_t d;
+    if(c >= '0' && c <= '9') d = (uint8_t)(c - '0');
+    else if(c >= 'a' && c <= 'f') d = (uint8_t)(c - 'a') + 10;
+    else return false;
+    if(i / 2 >= chain_bytes) {
+      // leading zeros are fine, set bits beyond the chain are not
+      if(d) return false;
+      continue;
+    }
+    out.b[i / 2] |= (i % 2) ? (d << 4) : d;
+  }
+  return true;
+}
+
+
+// "select:k" / "exec:k" / "free:k" argument, false if not a valid slot number
+static bool parseSlot(const String & s, size_t & out) {
+  uint32_t k;
+  if(!parseUint32(s, k) || k >= max_slots) return false;
+  out = (size_t)k;
+  return true;
+}
+
+
+// remove slot k and move the programs stored after it down
+void free_slot(size_t k) {
+  if(!slot_used[k]) return;
+  // the programs stored after k move, a paused position is no longer valid
+  paused_slot = -1;
+  size_t start = slot_start[k], n = slot_len[k];
+  memmove(code_sequence + start, code_sequence + start + n, len_code - start - n);
+  len_code -= n;
+  for(size_t j = 0; j < max_slots; ++j) {
+    if(slot_used[j] && slot_start[j] > start) slot_start[j] -= n;
+  }
+  slot_used[k] = false;
+  slot_len[k] = 0;
+}
+
+
+// start an empty program for slot k at the end of the used memory
+void open_slot(size_t k) {
+  free_slot(k);
+  slot_used[k] = true;
+  slot_start[k] = len_code;
+  slot_len[k] = 0;
+  slot_tick[k] = default_tick_us;
+  slot_packed[k] = false;
+}
+
+
+// two lower-case hex digits, false if s[i], s[i+1] are not
+static bool parseHexByte(const String & s, size_t i, uint8_t & out) {
+  out = 0;
+  for(size_t j = i; j < i + 2; ++j) {
+    char c = s[j];
+    uint8_t d;
+    if(c >= '0' && c <= '9') d = (uint8_t)(c - '0');
+    else if(c >= 'a' && c <= 'f') d = (uint8_t)(c - 'a') + 10;
+    else return false;
+    out = (out << 4) | d;
+  }
+  return true;
+}
+
+
+// one step of a packed program, from byte pos: the bits that flip against
+// the previous state, then the duration in ticks
+//   flip byte: bits 0-4 channel within the bank, bit 7 set on the last flip of the step
+//   0x40: no flip (a long step continued), 0x41: the whole state follows (chain_bytes, LSB first)
+//   0x42 | bank << 2: the following flips are channels bank*32 .. bank*32+31 (bank 0 at every step)
+//   bit 5 of the last byte: same duration as the previous step, else a LEB128 varint follows
+static void decode_packed(size_t & pos, size_t end, chain_t & state, uint32_t & dur) {
+  uint8_t b, bank = 0;
+  do {
+    b = (uint8_t)code_sequence[pos++];
+    if(b & 0x40) {
+      if(b & 0x02) {
+        bank = (b >> 2) & 0x07;
+        continue;
+      }
+      if(b & 0x01) {
+        memcpy(state.b, code_sequence + pos, chain_bytes);
+        pos += chain_bytes;
+      }
+      break;
+    }
+    uint8_t ch = (bank << 5) | (b & 0x1f);
+    if(ch < n_channels) state.b[ch >> 3] ^= (uint8_t)1 << (ch & 7);
+  } while(!(b & 0x80) && pos < end);
+  if(!(b & 0x20)) {
+    uint32_t d = 0;
+    uint8_t shift = 0, c;
+    do {
+      c = (uint8_t)code_sequence[pos++];
+      d |= (uint32_t)(c & 0x7f) << shift;
+      shift += 7;
+    } while((c & 0x80) && pos < end);
+    dur = d;
+  }
+}
+
+
+// all channels off
+const chain_t chain_off = {};
+
+void write_chain(const chain_t & st){
   digitalWrite(latchPin, LOW);
-  shiftOut(dataPin, clockPin, LSBFIRST , st & 0xff ); 
-  shiftOut(dataPin, clockPin, LSBFIRST , (st>> 8 ) & 0xff ); 
-  shiftOut(dataPin, clockPin, LSBFIRST , (st>> 16 ) & 0xff ); 
-  shiftOut(dataPin, clockPin, LSBFIRST , (st>> 24 ) & 0xff ); 
+  for(uint8_t i = 0; i < chain_bytes; ++i) {
+    shiftOut(dataPin, clockPin, LSBFIRST , st.b[i] ); 
+  }
   digitalWrite(latchPin, HIGH);
 }
 
 
+// the same shift out with direct port access, fast enough for the timer interrupt
+#if defined(__AVR__)
+volatile uint8_t * data_port;
+volatile uint8_t * clock_port;
+volatile uint8_t * latch_port;
+uint8_t data_bit, clock_bit, latch_bit;
+
+void write_chain_fast(const chain_t & st) {
+  *latch_port &= ~latch_bit;
+  // bit 0 first, same order as the LSBFIRST shiftOut() calls
+  for(uint8_t i = 0; i < chain_bytes; ++i) {
+    uint8_t v = st.b[i];
+    for(uint8_t j = 0; j < 8; ++j) {
+      if(v & 1) *data_port |= data_bit; else *data_port &= ~data_bit;
+      *clock_port |= clock_bit;
+      *clock_port &= ~clock_bit;
+      v >>= 1;
+    }
+  }
+  *latch_port |= latch_bit;
+}
+#else
+#define write_chain_fast write_chain
+#endif
+
+
+// state as upper-case hex without leading zeros, as Serial.print(x, HEX)
+void print_state(const chain_t & st) {
+  bool lead = true;
+  for(int i = chain_bytes - 1; i >= 0; --i) {
+    uint8_t hi = st.b[i] >> 4, lo = st.b[i] & 0x0f;
+    if(!lead || hi) { Serial.print(hi, HEX); lead = false; }
+    if(!lead || lo || i == 0) { Serial.print(lo, HEX); lead = false; }
+  }
+}
+
+
+// ---------------------------------------------------------------------------
+// scheduler: the running program advances one tick per timer interrupt
+// ---------------------------------------------------------------------------
+volatile bool sched_running = false;
+volatile uint32_t sched_left = 0;  // ticks left in the current step
+bool sched_packed = false;
+size_t sched_pos = 0;              // byte of the next step
+size_t sched_end = 0;              // one past the last byte of the program
+size_t sched_step = 0;             // steps started so far, the current step is sched_step - 1
+chain_t sched_state;               // state and duration of the current step
+uint32_t sched_dur = 0;
+
+void sched_begin(size_t k) {
+  sched_pos = slot_start[k];
+  sched_end = sched_pos + (slot_used[k] ? slot_len[k] : 0);
+  sched_packed = slot_packed[k];
+  sched_state = chain_off;
+  sched_dur = 0;
+  sched_step = 0;
+}
+
+// next step with a duration into sched_state / sched_dur, false at the end of the program
+bool sched_next() {
+  while(sched_pos < sched_end) {
+    if(sched_packed) {
+      decode_packed(sched_pos, sched_end, sched_state, sched_dur);
+    } else {
+      uint16_t d;
+      memcpy(sched_state.b, code_sequence + sched_pos, chain_bytes);
+      memcpy(&d, code_sequence + sched_pos + chain_bytes, 2);
+      sched_dur = d;
+      sched_pos += step_bytes;
+    }
+    if(sched_dur > 0) {
+      sched_step++;
+      return true;
+    }
+  }
+  return false;
+}
+
+void sched_tick() {
+  if(!sched_running) return;
+  if(--sched_left > 0) return;
+  if(sched_next()) {
+    write_chain_fast(sched_state);
+    sched_left = sched_dur;
+  } else {
+    write_chain_fast(chain_off);
+    sched_running = false;
+  }
+}
+
+#if defined(__AVR__)
+// Timer1 in CTC mode, prescaler 8: compare match every tick_us
+void start_timer(uint16_t tick_us) {
+  noInterrupts();
+  TCCR1A = 0;
+  TCCR1B = 0;
+  TCNT1 = 0;
+  OCR1A = (uint16_t)((uint32_t)tick_us * (F_CPU / 8000000UL) - 1);
+  TIFR1 = _BV(OCF1A);
+  TIMSK1 |= _BV(OCIE1A);
+  TCCR1B = _BV(WGM12) | _BV(CS11);
+  interrupts();
+}
+
+void stop_timer() {
+  TIMSK1 &= ~_BV(OCIE1A);
+  TCCR1B = 0;
+}
+
+ISR(TIMER1_COMPA_vect) {
+  sched_tick();
+}
+#endif
+
+
 void setup() {
   // setup serial
 	Serial.begin(115200) ; 
@@ -54,11 +327,172 @@ void setup() {
   pinMode(latchPin, OUTPUT) ; 
   pinMode(clockPin, OUTPUT) ; 
   pinMode(dataPin, OUTPUT) ; 
-  write32bits(0);
+  #if defined(__AVR__)
+  data_port = portOutputRegister(digitalPinToPort(dataPin));
+  clock_port = portOutputRegister(digitalPinToPort(clockPin));
+  latch_port = portOutputRegister(digitalPinToPort(latchPin));
+  data_bit = digitalPinToBitMask(dataPin);
+  clock_bit = digitalPinToBitMask(clockPin);
+  latch_bit = digitalPinToBitMask(latchPin);
+  #endif
+  for(size_t k = 0; k < max_slots; ++k) slot_tick[k] = default_tick_us;
+  write_chain(chain_off);
+  // tell the host that the board is up (after the auto-reset the bootloader drops anything sent earlier)
+  Serial.println(BANNER);
+}
+
+// timestamped event line for host clock alignment: evt:<name>:<micros>
+void print_event(const char * name, unsigned long t_us) {
+  Serial.print("evt:");
+  Serial.print(name);
+  Serial.print(":");
+  Serial.println(t_us);
+}
+
+// paused:<slot>:<step>:<ticks left in the step>, or paused:none
+void print_position() {
+  Serial.print("paused:");
+  if(paused_slot < 0) {
+    Serial.println("none");
+    return;
+  }
+  Serial.print(paused_slot);
+  Serial.print(":");
+  Serial.print(paused_step);
+  Serial.print(":");
+  Serial.println(paused_left);
+}
+
+// run slot k from the step in sched_state / sched_dur with sched_left ticks left,
+// until the end of the program or until serial input arrives
+void run_slot(size_t k, const char * event) {
+  bool interrupted = false;
+  unsigned long t_step = micros();
+  write_chain(sched_state) ;
+  sched_running = true;
+  // steps switch in the timer interrupt, exactly on tick boundaries, so
+  // the loop below only watches the serial port
+  #if defined(__AVR__)
+  start_timer(slot_tick[k]);
+  #else
+  unsigned long next_tick = t_step + slot_tick[k];
+  #endif
+  print_event(event, t_step);
+  while(sched_running) {
+    #if !defined(__AVR__)
+    // no timer setup for this board: same schedule from micros() deadlines
+    while(sched_running && (long)(micros() - next_tick) >= 0) {
+      next_tick += slot_tick[k];
+      sched_tick();
+    }
+    #endif
+    //  Arbitary stop  by serial availability
+    if(Serial.available() ) { 
+      noInterrupts();
+      bool was_running = sched_running;
+      sched_running = false;
+      uint32_t left = sched_left;
+      interrupts();
+      // switch off first, then report; the host measures stop latency on this line
+      write_chain(chain_off);
+      Serial.println("Execution Interrupted!");
+      print_event("interrupt", micros());
+      if(was_running) {
+        // keep the position, "resume" continues with the rest of this step
+        paused_slot = (int)k;
+        paused_pos = sched_pos;
+        paused_step = sched_step - 1;
+        paused_state = sched_state;
+        paused_dur = sched_dur;
+        paused_left = left;
+        print_position();
+        pos_reported = true;
+      }
+      interrupted = true;
+    }
+  }
+  #if defined(__AVR__)
+  stop_timer();
+  #endif
+  write_chain(chain_off);
+  if(!interrupted) print_event("done", micros());
+}
+
+void exec_slot(size_t k) {
+  #ifdef verbose
+		Serial.println("Execution of sequence : " ); 
+  #endif
+  paused_slot = -1;
+  sched_begin(k);
+  if(sched_next()) {
+    sched_left = sched_dur;
+    run_slot(k, "exec");
+  } else {
+    write_chain(chain_off);
+    print_event("done", micros());
+  }
+}
+
+// continue the paused program where it was interrupted
+void resume_slot() {
+  if(paused_slot < 0) {
+    Serial.println("resume failed, nothing paused") ;
+    return;
+  }
+  size_t k = (size_t)paused_slot;
+  paused_slot = -1;
+  sched_begin(k);
+  sched_pos = paused_pos;
+  sched_step = paused_step + 1;
+  sched_state = paused_state;
+  sched_dur = paused_dur;
+  sched_left = paused_left;
+  run_slot(k, "resume");
+}
+
+
+// status:<slot>:<bytes>:<tick us>:<packed>:<fletcher16> of the current slot,
+// tells the host how much of an interrupted upload was stored
+void print_status() {
+  size_t k = cur_slot;
+  size_t n = slot_used[k] ? slot_len[k] : 0;
+  uint16_t s1 = 0, s2 = 0;
+  for(size_t i = 0; i < n; ++i) {
+    s1 = (s1 + (uint8_t)code_sequence[slot_start[k] + i]) % 255;
+    s2 = (s2 + s1) % 255;
+  }
+  Serial.print("status:");
+  Serial.print(k);
+  Serial.print(":");
+  Serial.print(n);
+  Serial.print(":");
+  Serial.print(slot_tick[k]);
+  Serial.print(":");
+  Serial.print(slot_packed[k] ? 1 : 0);
+  Serial.print(":");
+  Serial.println(((uint16_t)s2 << 8) | s1);
+}
+
+
+// decode slot k without output: bench:<steps>/<us>
+void bench_slot(size_t k) {
+  size_t n = 0;
+  sched_begin(k);
+  unsigned long t0 = micros();
+  while(sched_next()) n++;
+  unsigned long t1 = micros();
+  Serial.print("bench:");
+  Serial.print(n);
+  Serial.print("/");
+  Serial.println(t1 - t0);
 }
 
-void execute_command(String command) {
-  uint32_t nss; // new switch state
+
+// reported: the exec interrupted by this line has already printed its position
+void execute_command(String command, bool reported) {
+  uint32_t nss;
+  chain_t state; // new switch state
+  size_t nslot;
   int sub_idx = command.indexOf(':');
   bool maj_mnr;
   String cmd_MAJ,cmd_mnr;
@@ -72,16 +506,18 @@ void execute_command(String command) {
 	  cmd_mnr = command.substring(sub_idx+1) ; 
   }
 
-	if(maj_mnr && cmd_MAJ.equals("setstate") && parseUint32(cmd_mnr , nss)) {  
-    write32bits(nss) ;
+	if(maj_mnr && cmd_MAJ.equals("setstate") && parseState(cmd_mnr , state)) {  
+    write_chain(state) ;
     #ifdef verbose
 		  Serial.print( "command : " ); 
 		  Serial.print( cmd_MAJ ); 
 		  Serial.print( "new state: " ); 
-		  Serial.println( nss); 
+		  print_state(state); 
+		  Serial.println(""); 
     #endif
   } else if( (!maj_mnr) &  cmd_MAJ.equals("clearcode"))   { 
-    len_code=0;
+    // clears the current slot only, the other slots are kept
+    open_slot(cur_slot);
     #ifdef verbose
 		  Serial.println( "code is cleared " ); 
     #endif
@@ -89,23 +525,30 @@ void execute_command(String command) {
     size_t slash_idx  = cmd_mnr.indexOf('/') ;
     String cmd_state = cmd_mnr.substring(0, slash_idx) ;
     String cmd_delay = cmd_mnr.substring(slash_idx + 1) ;
-    uint32_t t1,t2 ; 
-    if(parseUint32(cmd_state , t1) && parseUint32(cmd_delay , t2 )) {
-      if(6  *(len_code+1) < state_mem) {
-        uint32_t * s  = ( uint32_t * ) (code_sequence + 6*len_code ) ;
-        uint16_t * d  = ( uint16_t * ) (code_sequence + 6*len_code + 4  ) ;
-        s[0] = t1;
-        d[0] = (uint16_t)t2; 
-        len_code+=1;
+    uint32_t t2 ; 
+    if(!slot_used[cur_slot]) open_slot(cur_slot);
+    if(slot_start[cur_slot] + slot_len[cur_slot] != len_code) {
+      // only the most recently opened slot can grow
+      Serial.println("add code failed, slot is closed, send clearcode") ;
+    } else if(slot_packed[cur_slot]) {
+      Serial.println("add code failed, slot is packed, use addbytes") ;
+    } else if(parseState(cmd_state , state) && parseUint32(cmd_delay , t2 )) {
+      if(len_code + step_bytes <= code_capacity) {
+        uint16_t d = (uint16_t)t2;
+        memcpy(code_sequence + len_code, state.b, chain_bytes);
+        memcpy(code_sequence + len_code + chain_bytes, &d, 2);
+        len_code+=step_bytes;
+        slot_len[cur_slot]+=step_bytes;
         #ifdef verbose
 		      Serial.print( "code add success : " ); 
 		      Serial.print( "new state: " ); 
-		      Serial.println( s[0]); 
+		      print_state(state); 
+		      Serial.println(""); 
 		      Serial.print( "new delay: " ); 
-		      Serial.println( d[0]); 
+		      Serial.println( d); 
         #endif
       } else {
-        Serial.print("add code failed, memory overflow") ; 
+        Serial.println("add code failed, memory overflow") ; 
       }
     } else {
       #ifdef verbose
@@ -118,53 +561,101 @@ void execute_command(String command) {
     } 
   } else if((!maj_mnr) && cmd_MAJ.equals("printcode")) {
     Serial.println("current code : "); 
-    for(size_t i =0 ;  i < len_code ; ++i ) {
-      uint32_t * s  = ( uint32_t * ) (code_sequence + 6*i ) ;
-      uint16_t * d  = ( uint16_t * ) (code_sequence + 6*i + 4  ) ;
+    sched_begin(cur_slot);
+    while(sched_next()) {
       Serial.print("state:0x");
-      Serial.print(s[0], HEX) ;
+      print_state(sched_state) ;
       Serial.print(" delay:");
-      Serial.print(d[0]) ;
+      Serial.print(sched_dur) ;
       Serial.println("") ;
     }
-  } else if((!maj_mnr) && cmd_MAJ.equals("exec") ) {
-    #ifdef verbose
-		Serial.println("Execution of sequence : " ); 
-    #endif
-    for(size_t i =0 ;  i < len_code ; ++i ) {
-      uint32_t * s  = ( uint32_t * ) (code_sequence + 6*i ) ;
-      uint16_t * d  = ( uint16_t * ) (code_sequence + 6*i + 4  ) ;
-      write32bits(s[0]) ;
-      
-
-
-
-      //delay(d[0]) ; //delay in mills
-      //#ifdef verbose
-      //  Serial.print("state:0x");
-      //  Serial.print(s[0], HEX) ;
-      //  Serial.print(" delay:");
-      //  Serial.print(d[0]) ;
-      //  Serial.println("") ;
-      //#endif
-      ////interruption of execution if anything comes from serial
-      //if(Serial.available() ) { 
-      //  Serial.println("Execution Interrupted!");
-      //  break;
-      //}
-      //
-
-      //  Arbitary stop  by serial availability
-      
-      unsigned long del_start = millis();
-      while( millis()  - del_start  <  d[0] )  {
-        if(Serial.available() ) { 
-          Serial.println("Execution Interrupted!");
-          break;
-        }
+  } else if((!maj_mnr) && cmd_MAJ.equals("version")) {
+    Serial.println(BANNER);
+  } else if((!maj_mnr) && cmd_MAJ.equals("width")) {
+    // channels of the register chain: width:<n>
+    Serial.print("width:");
+    Serial.println(n_channels);
+  } else if((!maj_mnr) && cmd_MAJ.equals("time")) {
+    // device clock query used by the host clock synchronization
+    unsigned long t_us = micros();
+    Serial.print("time:");
+    Serial.println(t_us);
+  } else if(maj_mnr && cmd_MAJ.equals("select") && parseSlot(cmd_mnr, nslot)) {
+    cur_slot = nslot;
+  } else if(maj_mnr && cmd_MAJ.equals("free") && parseSlot(cmd_mnr, nslot)) {
+    free_slot(nslot);
+  } else if((!maj_mnr) && cmd_MAJ.equals("clearall")) {
+    for(size_t k = 0; k < max_slots; ++k) free_slot(k);
+  } else if((!maj_mnr) && cmd_MAJ.equals("slots")) {
+    // slots:<bytes used>/<bytes available> <slot>:<bytes> ...
+    Serial.print("slots:");
+    Serial.print(len_code);
+    Serial.print("/");
+    Serial.print(code_capacity);
+    for(size_t k = 0; k < max_slots; ++k) {
+      if(!slot_used[k]) continue;
+      Serial.print(" ");
+      Serial.print(k);
+      Serial.print(":");
+      Serial.print(slot_len[k]);
+    }
+    Serial.println("");
+  } else if(maj_mnr && cmd_MAJ.equals("tick") && parseUint32(cmd_mnr, nss)) {
+    // timer tick of the current slot in us, send after clearcode
+    if(nss >= min_tick_us && nss <= max_tick_us) {
+      slot_tick[cur_slot] = (uint16_t)nss;
+    } else {
+      Serial.println("tick failed, out of range") ;
+    }
+  } else if((!maj_mnr) && cmd_MAJ.equals("tick")) {
+    Serial.print("tick:");
+    Serial.println(slot_tick[cur_slot]);
+  } else if((!maj_mnr) && cmd_MAJ.equals("packed")) {
+    // the current slot takes a packed program, send after clearcode
+    if(!slot_used[cur_slot]) open_slot(cur_slot);
+    if(slot_len[cur_slot] == 0) {
+      slot_packed[cur_slot] = true;
+    } else {
+      Serial.println("packed failed, slot is not empty") ;
+    }
+  } else if(maj_mnr && cmd_MAJ.equals("addbytes")) {
+    // addbytes:<hex>, raw bytes of a packed program
+    size_t n = cmd_mnr.length() / 2;
+    uint8_t b;
+    bool valid = (cmd_mnr.length() % 2 == 0);
+    for(size_t i = 0; valid && i < n; ++i) valid = parseHexByte(cmd_mnr, 2*i, b);
+    if(!slot_used[cur_slot] || !slot_packed[cur_slot]) {
+      Serial.println("add bytes failed, slot is not packed, send packed") ;
+    } else if(slot_start[cur_slot] + slot_len[cur_slot] != len_code) {
+      Serial.println("add bytes failed, slot is closed, send clearcode") ;
+    } else if(!valid) {
+      Serial.println("add bytes failed, bad hex") ;
+    } else if(len_code + n > code_capacity) {
+      Serial.println("add bytes failed, memory overflow") ;
+    } else {
+      for(size_t i = 0; i < n; ++i) {
+        parseHexByte(cmd_mnr, 2*i, b);
+        code_sequence[len_code++] = (char)b;
       }
+      slot_len[cur_slot] += n;
     }
-    write32bits(0);
+  } else if((!maj_mnr) && cmd_MAJ.equals("pause")) {
+    // a running exec is already interrupted by this line and has reported its position
+    if(!reported) print_position();
+  } else if((!maj_mnr) && cmd_MAJ.equals("resume")) {
+    resume_slot();
+  } else if((!maj_mnr) && cmd_MAJ.equals("status")) {
+    print_status();
+  } else if((!maj_mnr) && cmd_MAJ.equals("bench")) {
+    bench_slot(cur_slot);
+  } else if(maj_mnr && cmd_MAJ.equals("bench") && parseSlot(cmd_mnr, nslot)) {
+    bench_slot(nslot);
+  } else if((!maj_mnr) && cmd_MAJ.equals("exec") ) {
+    exec_slot(cur_slot);
+  } else if(maj_mnr && cmd_MAJ.equals("exec") && parseSlot(cmd_mnr, nslot)) {
+    // switch and run in one command
+    cur_slot = nslot;
+    exec_slot(cur_slot);
   }
 
 }
@@ -173,6 +664,9 @@ void execute_command(String command) {
 void loop(){
 	if(Serial.available()) {
 		String msg = Serial.readStringUntil('\n') ; 
-		if( msg.length() >  0)  execute_command(msg); 
+		// cleared by every line, also the bare newline of an interrupt
+		bool reported = pos_reported;
+		pos_reported = false;
+		if( msg.length() >  0)  execute_command(msg, reported); 
 	}
 }
@@ -0,0 +1,225 @@
+'''
+Batch compiler for directories of CSV stimulus matrices.
+
+Compiles every *.csv in a directory (horizontal or vertical layout) into
+Arduino command files, binary step files and/or one JSON stimulus library,
+using a process pool. Inputs whose content and options did not change since
+the last build are skipped (content hashes are kept in <out>/.build_cache.json).
+
+Run from the Python directory:
+    python -m batch_compile stim_files --col-ms 100
+    python -m batch_compile stim_files -o build --format commands binary library -j 4
+
+Heavy modules (NumPy, the mask engine) are only imported by the workers, so
+a no-op rebuild returns almost immediately.
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+
+T_START = time.perf_counter()
+
+FORMATS = ("commands", "binary", "library")
+CACHE_FILE = ".build_cache.json"
+LIBRARY_FILE = "library.json"
+
+
+def detect_layout(csv_path):
+    """
+    'vertical' or 'horizontal', from the file name or the content:
+
+    - a channel id other than 0/1 in the first row after its first value: vertical
+    - a value repeated in the first column (time steps of 0/1): vertical, the
+      first column of a horizontal file holds distinct channel ids
+    - a first-column value other than 0/1 below the first row: horizontal
+
+    ValueError if none applies (a few rows of channels 0 and 1 read both
+    ways), the layout then has to be given (--layout).
+    """
+    if "vertical" in os.path.basename(csv_path).lower():
+        return "vertical"
+    first_column = set()
+    with open(csv_path, encoding="utf-8") as f:
+        for line in f:
+            delimiter = '\t' if '\t' in line else ','
+            values = [x.strip() for x in line.split(delimiter) if x.strip() != '']
+            if not values:
+                continue
+            if not first_column and any(v not in ("0", "1") for v in values[1:]):
+                return "vertical"
+            if values[0] in first_column:
+                return "vertical"
+            if first_column and values[0] not in ("0", "1"):
+                return "horizontal"
+            first_column.add(values[0])
+    raise ValueError(f"{csv_path}: layout is ambiguous (channels 0 and 1 only), pass --layout horizontal or vertical")
+
+
+def input_hash(data, options):
+    h = hashlib.sha256(data)
+    h.update(json.dumps(options, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def write_commands(seq, path):
+    """Same text as Stimulus.to_file4arduino_timed(). seq may be a generator, lines are written as they come."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("clearcode")
+        for mask, dur in seq:
+            if dur > 0:
+                f.write(f"\naddcode:0x{mask:x}/{dur}")
+
+
+def write_binary(seq, path, width=32):
+    """
+    Steps in the firmware's code_sequence layout: state + uint16 delay, little endian;
+    the state takes 4 bytes, width / 8 on a wider register chain.
+    """
+    import struct
+    n_bytes = (width + 7) // 8
+    with open(path, "wb") as f:
+        for mask, dur in seq:
+            if dur <= 0:
+                continue
+            if dur != int(dur) or dur > 0xFFFF:
+                raise ValueError(f"{path}: delay {dur} ms does not fit the 16-bit delay field")
+            if mask >> (8 * n_bytes):
+                raise ValueError(f"{path}: mask 0x{mask:x} does not fit {width} channels (--width)")
+            f.write(mask.to_bytes(n_bytes, "little") + struct.pack("<H", int(dur)))
+
+
+def compile_file(csv_path, out_dir, col_ms, layout, formats, width=32):
+    """Worker: compile one CSV, write the requested outputs. Returns a result dict."""
+    t0 = time.perf_counter()
+    import masks
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    try:
+        if layout == "auto":
+            layout = detect_layout(csv_path)
+        if layout == "vertical":
+            # streamed, long recordings are never loaded as a whole
+            seq = list(masks.compile_csv_vertical(csv_path, col_ms=col_ms))
+        else:
+            channel_ids, matrix = masks.read_csv_matrix(csv_path)
+            seq = masks.compile_matrix(matrix, channel_ids, col_ms=col_ms)
+        outputs = []
+        if "commands" in formats:
+            outputs.append(os.path.join(out_dir, name + ".txt"))
+            write_commands(seq, outputs[-1])
+        if "binary" in formats:
+            outputs.append(os.path.join(out_dir, name + ".bin"))
+            write_binary(seq, outputs[-1], width)
+    except (ValueError, OSError, UnicodeDecodeError) as e:
+        # reported per file, one broken input does not stop the build
+        return {"name": name, "error": str(e), "seconds": time.perf_counter() - t0}
+    return {"name": name, "layout": layout, "steps": sum(1 for _, d in seq if d > 0),
+            "seq": seq if "library" in formats else None,
+            "outputs": outputs, "seconds": time.perf_counter() - t0}
+
+
+def _up_to_date(entry, digest, out_dir, formats):
+    if not entry or entry.get("hash") != digest:
+        return False
+    outputs = list(entry.get("outputs", []))
+    if "library" in formats:
+        outputs.append(LIBRARY_FILE)
+    return all(os.path.exists(os.path.join(out_dir, o)) for o in outputs)
+
+
+def build(in_dir, out_dir=None, col_ms=100, layout="auto", formats=("commands",), jobs=None, force=False, width=32):
+    """
+    Compile all stale CSVs of in_dir. Returns (compiled results, number of inputs up to date).
+    width = channels of the register chain, sets the state size of the binary format.
+    """
+    out_dir = out_dir or os.path.join(in_dir, "build")
+    os.makedirs(out_dir, exist_ok=True)
+    cache_path = os.path.join(out_dir, CACHE_FILE)
+    cache = {}
+    if os.path.exists(cache_path) and not force:
+        with open(cache_path, encoding="utf-8") as f:
+            cache = json.load(f)
+
+    options = {"col_ms": col_ms, "layout": layout, "formats": sorted(formats)}
+    if width != 32:
+        # only wide builds hash the width, caches of 32-channel builds stay valid
+        options["width"] = width
+    todo, hashes, unreadable = [], {}, []
+    for fname in sorted(os.listdir(in_dir)):
+        if not fname.lower().endswith(".csv"):
+            continue
+        path = os.path.join(in_dir, fname)
+        try:
+            with open(path, "rb") as f:
+                hashes[fname] = input_hash(f.read(), options)
+        except OSError as e:
+            unreadable.append({"name": os.path.splitext(fname)[0], "error": str(e), "seconds": 0.0})
+            continue
+        if not _up_to_date(cache.get(fname), hashes[fname], out_dir, formats):
+            todo.append(path)
+
+    results = []
+    if len(todo) > 1 and jobs != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(compile_file, p, out_dir, col_ms, layout, formats, width) for p in todo]
+            results = [fut.result() for fut in futures]
+    else:
+        results = [compile_file(p, out_dir, col_ms, layout, formats, width) for p in todo]
+
+    if "library" in formats and results:
+        lib_path = os.path.join(out_dir, LIBRARY_FILE)
+        library = {}
+        if os.path.exists(lib_path):
+            with open(lib_path, encoding="utf-8") as f:
+                library = json.load(f)
+        for r in results:
+            if "error" in r:
+                continue
+            library[r["name"]] = {"col_ms": col_ms, "layout": r["layout"], "seq": [list(step) for step in r["seq"]]}
+        with open(lib_path, "w", encoding="utf-8") as f:
+            json.dump(library, f)
+
+    for path, r in zip(todo, results):
+        if "error" in r:
+            continue
+        fname = os.path.basename(path)
+        cache[fname] = {"hash": hashes[fname], "outputs": [os.path.basename(o) for o in r["outputs"]]}
+    with open(cache_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=1)
+    return unreadable + results, len(hashes) - len(todo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m batch_compile",
+                                     description="Compile a directory of CSV stimulus matrices")
+    parser.add_argument("in_dir", help="directory with *.csv matrices")
+    parser.add_argument("-o", "--out", default=None, help="output directory (default <in_dir>/build)")
+    parser.add_argument("--col-ms", type=float, default=100, help="duration of one matrix column in ms")
+    parser.add_argument("--layout", choices=("auto", "horizontal", "vertical"), default="auto")
+    parser.add_argument("--format", nargs="+", choices=FORMATS, default=["commands"], dest="formats")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--force", action="store_true", help="ignore the build cache")
+    parser.add_argument("--width", type=int, default=32, help="channels of the register chain (binary format)")
+    args = parser.parse_args(argv)
+    col_ms = int(args.col_ms) if args.col_ms == int(args.col_ms) else args.col_ms
+
+    t0 = time.perf_counter()
+    results, skipped = build(args.in_dir, args.out, col_ms, args.layout, args.formats, args.jobs, args.force, args.width)
+    t1 = time.perf_counter()
+    failed = [r for r in results if "error" in r]
+    for r in results:
+        if "error" in r:
+            print(f"  {r['name']:<40} FAILED: {r['error']}")
+        else:
+            print(f"  {r['name']:<40} {r['layout']:<10} {r['steps']:7d} steps {r['seconds'] * 1000:8.1f} ms")
+    print(f"compiled {len(results) - len(failed)}, failed {len(failed)}, up to date {skipped}, "
+          f"build {(t1 - t0) * 1000:.1f} ms, startup {(t0 - T_START) * 1000:.1f} ms")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+'''
+Serial port broker: keeps one Controller connection open across scripts.
+
+Opening the COM port resets the Arduino and loses the loaded program, and only
+one process can hold the port. The broker owns the connection for as long as it
+runs. PsychoPy/Qt scripts and notebooks talk to it over a local Unix socket
+with BrokerClient. Requests are serialized, the loaded program is cached (an
+upload of the same sequence is skipped) and device lines are pushed to
+subscribers, through a bounded queue per subscriber: one that falls
+SUBSCRIBER_QUEUE lines behind is disconnected.
+
+Start the daemon (from the Python directory):
+    python -m broker --port COM7 --socket /tmp/touch_the_pain_away.sock
+
+Use it from any script:
+    from broker import BrokerClient
+    client = BrokerClient("/tmp/touch_the_pain_away.sock")
+    client.upload(stim.generate_timed_sequence(), name="motion")
+    client.exec()
+    client.subscribe(lambda line, t: print(line))
+
+Protocol: one JSON object per line in both directions, {"op": ...} -> {"ok": ...}.
+Unix domain sockets are not available on Windows.
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+
+from program_slots import sequence_digest
+
+
+DEFAULT_SOCKET = "/tmp/touch_the_pain_away.sock"
+# device lines buffered per subscriber; a client that falls this far behind is dropped
+SUBSCRIBER_QUEUE = 1000
+
+
+# =============================================================================
+# DAEMON
+# =============================================================================
+class Broker:
+    def __init__(self, controller, delay=0.01):
+        self.controller = controller
+        self.delay = delay
+        self.loaded_hash = None
+        self.loaded_name = None
+        self._device_lock = threading.Lock()
+        self._subscribers = []
+        self._subscribers_lock = threading.Lock()
+        controller.add_listener(self._broadcast)
+
+    def handle(self, req):
+        op = req.get("op")
+        if op == "ping":
+            return {"ok": True}
+        if op == "status":
+            return {"ok": True, "port": self.controller.port, "banner": self.controller.banner,
+                    "loaded": self.loaded_name, "loaded_hash": self.loaded_hash,
+                    "executing": self.controller.executing}
+        if op == "stop":
+            # never waits behind an upload, Controller.stop() jumps the queue itself
+            # an upload it cancels clears the cache itself
+            latency = self.controller.stop(timeout=req.get("timeout", 1.0))
+            return {"ok": True, "latency_ms": latency}
+        with self._device_lock:
+            if op == "upload":
+                seq = [tuple(step) for step in req["seq"]]
+                digest = sequence_digest(seq)
+                if digest == self.loaded_hash and not req.get("force"):
+                    self.loaded_name = req.get("name", self.loaded_name)
+                    return {"ok": True, "cached": True, "hash": digest}
+                self.loaded_hash = None
+                if not self.controller.upload_sequence(seq, delay=req.get("delay", self.delay), log_path=None):
+                    return {"ok": False, "error": "upload cancelled"}
+                self.controller.wait_sent()
+                self.loaded_hash, self.loaded_name = digest, req.get("name")
+                return {"ok": True, "cached": False, "hash": digest}
+            if op == "exec":
+                self.controller.exec()
+                return {"ok": True}
+            if op == "send":
+                line = req["line"]
+                if line.strip().startswith(("clearcode", "addcode")):
+                    # the program changes behind the cache's back
+                    self.loaded_hash = self.loaded_name = None
+                self.controller.send(line)
+                return {"ok": True}
+        return {"ok": False, "error": f"unknown op {op!r}"}
+
+    def subscribe(self, connection):
+        """Queue of the device lines for one subscriber socket, emptied by its handler thread."""
+        events = queue.Queue(maxsize=SUBSCRIBER_QUEUE)
+        with self._subscribers_lock:
+            self._subscribers.append((events, connection))
+        return events
+
+    def unsubscribe(self, events):
+        with self._subscribers_lock:
+            self._subscribers = [s for s in self._subscribers if s[0] is not events]
+
+    def _broadcast(self, line, t):
+        # runs in the Controller reader thread: never waits for a client, a
+        # stalled one would hold up every line (also the stop() confirmation)
+        msg = (json.dumps({"event": line, "t": t}) + "\n").encode()
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+        for events, connection in subscribers:
+            try:
+                events.put_nowait(msg)
+            except queue.Full:
+                print(f"Broker: subscriber {SUBSCRIBER_QUEUE} lines behind, dropped")
+                self.unsubscribe(events)
+                try:
+                    # its handler thread may be blocked writing to it
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        events = None
+        try:
+            for raw in self.rfile:
+                try:
+                    req = json.loads(raw)
+                    if req.get("op") == "subscribe":
+                        events = broker.subscribe(self.request)
+                        resp = {"ok": True}
+                    else:
+                        resp = broker.handle(req)
+                except Exception as e:
+                    resp = {"ok": False, "error": str(e)}
+                self.wfile.write((json.dumps(resp) + "\n").encode())
+                self.wfile.flush()
+                if events is not None:
+                    # a subscribed connection only receives device lines from here on
+                    self._send_events(events)
+                    return
+        except (OSError, ValueError):
+            pass
+        finally:
+            if events is not None:
+                broker.unsubscribe(events)
+
+    def _send_events(self, events):
+        while True:
+            msg = events.get()
+            self.wfile.write(msg)
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(controller, socket_path=DEFAULT_SOCKET, delay=0.01):
+    """Run the broker until interrupted. The controller must already be connected."""
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = _Server(socket_path, _Handler)
+    server.broker = Broker(controller, delay=delay)
+    print(f"Broker for {controller.port} listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+    return server
+
+
+# =============================================================================
+# CLIENT
+# =============================================================================
+class BrokerClient:
+    """Client for the broker daemon, mirrors the Controller command methods."""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.socket_path = socket_path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._rfile = self._sock.makefile("rb")
+        self._lock = threading.Lock()
+        self._sub_sock = None
+
+    def request(self, op, **kwargs):
+        kwargs["op"] = op
+        with self._lock:
+            self._sock.sendall((json.dumps(kwargs) + "\n").encode())
+            resp = json.loads(self._rfile.readline())
+        if not resp.get("ok"):
+            raise RuntimeError(resp.get("error", "broker request failed"))
+        return resp
+
+    def ping(self):
+        """Round trip time of an empty request in ms."""
+        t0 = time.perf_counter()
+        self.request("ping")
+        return (time.perf_counter() - t0) * 1000.0
+
+    def status(self):
+        return self.request("status")
+
+    def upload(self, seq, name=None, delay=None, force=False):
+        """Upload a (mask, dur) sequence; skipped by the broker if it is already loaded."""
+        kwargs = {"seq": [[int(m), d] for m, d in seq], "name": name, "force": force}
+        if delay is not None:
+            kwargs["delay"] = delay
+        return self.request("upload", **kwargs)
+
+    def exec(self):
+        return self.request("exec")
+
+    def stop(self, timeout=1.0):
+        return self.request("stop", timeout=timeout).get("latency_ms")
+
+    def send(self, line):
+        return self.request("send", line=line)
+
+    def subscribe(self, callback):
+        """Call callback(line, host_time) for every device line, from a background thread."""
+        self._sub_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sub_sock.connect(self.socket_path)
+        self._sub_sock.sendall(b'{"op": "subscribe"}\n')
+        rfile = self._sub_sock.makefile("rb")
+        rfile.readline()
+
+        def loop():
+            for raw in rfile:
+                msg = json.loads(raw)
+                if "event" in msg:
+                    callback(msg["event"], msg["t"])
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def close(self):
+        for s in (self._sock, self._sub_sock):
+            if s is not None:
+                s.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m broker", description="Serial port broker daemon")
+    parser.add_argument("--port", default="COM7", help="serial port of the board")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="unix socket path")
+    parser.add_argument("--no-reset", action="store_true", help="open the port without resetting the board")
+    parser.add_argument("--delay", type=float, default=0.01, help="pause between uploaded lines")
+    args = parser.parse_args()
+
+    from controller import Controller
+    controller = Controller(port=args.port, baud=args.baud)
+    controller.connect(reset=not args.no_reset)
+    try:
+        serve(controller, args.socket, args.delay)
+    finally:
+        controller.disconnect()
+    sys.exit(0)
@@ -0,0 +1,171 @@
+'''
+Host/device clock synchronization.
+
+The firmware answers "time" with "time:<micros>" and reports exec start,
+completion and interruption as "evt:<name>:<micros>". ClockSync pings the
+device, keeps a window of (host midpoint, device time, round trip) samples and
+fits host = offset + rate * device with a Theil-Sen regression over the samples
+with the shortest round trips. Every device event is then converted to a
+host time.perf_counter() timestamp with an uncertainty.
+
+Usage:
+    sync = ClockSync(controller)
+    sync.start()            # initial burst, then refreshed in the background
+    controller.exec()
+    ...
+    for ev in sync.events:
+        print(ev.name, ev.host_time, ev.uncertainty)
+    sync.close()
+'''
+
+import time
+import threading
+from collections import deque, namedtuple
+from statistics import median
+
+
+DeviceEvent = namedtuple("DeviceEvent", "name device_us host_time uncertainty received")
+
+WRAP_US = 1 << 32   # micros() on the Arduino is an unsigned long
+
+
+class ClockSync:
+    def __init__(self, controller, interval=1.0, window=64, burst=16, best_fraction=0.5, min_span_s=5.0):
+        """
+        - controller: a connected Controller (with the clock-sync firmware)
+        - interval: seconds between background pings
+        - window: number of most recent samples used for the fit
+        - burst: pings sent by start() before returning
+        - best_fraction: fraction of samples with the shortest round trip used for the fit
+        - min_span_s: drift is only estimated once the samples span this long,
+          before that the rate is fixed to 1 and only the offset is fitted
+        """
+        self.controller = controller
+        self.interval = interval
+        self.burst = burst
+        self.best_fraction = best_fraction
+        self.min_span_s = min_span_s
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        # latest unwrapped device time, reference for the next wrap
+        self._latest_us = None
+        self._running = False
+        self._thread = None
+        self.offset = None
+        self.rate = 1.0
+        self.uncertainty = float("inf")
+        self.events = []
+        self.on_event = None
+        controller.add_listener(self._on_line)
+
+    # =========================================================================
+    # SAMPLING
+    # =========================================================================
+    def start(self):
+        """Take an initial burst of samples and keep refreshing in the background."""
+        for _ in range(self.burst):
+            self.ping()
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        self.controller.remove_listener(self._on_line)
+
+    def ping(self, timeout=0.5):
+        """One ping-pong exchange. Skipped (returns False) while a sequence is executing."""
+        waiter = self.controller.expect("time:")
+        t0 = time.perf_counter()
+        if not self.controller.send_if_idle("time"):
+            # executing, any byte would interrupt it
+            self.controller.wait_line(waiter, 0)
+            return False
+        result = self.controller.wait_line(waiter, timeout)
+        if result is None:
+            return False
+        line, t1 = result
+        try:
+            device_us = self._unwrap(int(line.split(":", 1)[1]))
+        except ValueError:
+            return False
+        with self._lock:
+            self._samples.append(((t0 + t1) / 2.0, device_us * 1e-6, t1 - t0))
+            self._fit()
+        return True
+
+    def _loop(self):
+        while self._running:
+            time.sleep(self.interval)
+            if self._running:
+                self.ping()
+
+    def _unwrap(self, raw_us):
+        # time: replies are unwrapped by the ping() caller and evt: lines by the
+        # reader thread, so they can come in out of order: the period is the one
+        # that puts raw_us closest to the latest time, never just "the next one"
+        with self._lock:
+            if self._latest_us is None:
+                self._latest_us = raw_us
+                return raw_us
+            value = raw_us + (self._latest_us - raw_us + WRAP_US // 2) // WRAP_US * WRAP_US
+            self._latest_us = max(self._latest_us, value)
+            return value
+
+    # =========================================================================
+    # ESTIMATE
+    # =========================================================================
+    def _fit(self):
+        # called with the lock held
+        samples = sorted(self._samples, key=lambda s: s[2])
+        n_best = max(2, int(len(samples) * self.best_fraction))
+        best = samples[:n_best]
+        span = max(d for _, d, _ in best) - min(d for _, d, _ in best)
+        slopes = []
+        if span >= self.min_span_s:
+            # Theil-Sen: median of pairwise slopes, robust against delayed replies
+            for i in range(len(best)):
+                for j in range(i + 1, len(best)):
+                    dd = best[j][1] - best[i][1]
+                    if dd != 0:
+                        slopes.append((best[j][0] - best[i][0]) / dd)
+        self.rate = median(slopes) if slopes else 1.0
+        self.offset = median(h - self.rate * d for h, d, _ in best)
+        residuals = [abs(h - (self.offset + self.rate * d)) for h, d, _ in best]
+        # half the shortest round trip bounds the reply time, plus the fit scatter
+        self.uncertainty = best[0][2] / 2.0 + median(residuals)
+
+    @property
+    def drift_ppm(self):
+        """Device clock drift relative to the host in parts per million."""
+        return (self.rate - 1.0) * 1e6
+
+    def to_host(self, device_us):
+        """
+        Convert an (unwrapped) device time in µs to host time.perf_counter() seconds.
+        Returns (host_time, uncertainty_s); (None, inf) before the first sample.
+        """
+        with self._lock:
+            if self.offset is None:
+                return None, float("inf")
+            return self.offset + self.rate * device_us * 1e-6, self.uncertainty
+
+    # =========================================================================
+    # DEVICE EVENTS
+    # =========================================================================
+    def _on_line(self, line, received):
+        if not line.startswith("evt:"):
+            return
+        try:
+            _, name, raw = line.split(":", 2)
+            device_us = self._unwrap(int(raw))
+        except ValueError:
+            return
+        host_time, uncertainty = self.to_host(device_us)
+        if host_time is None:
+            # no estimate yet, the receive time is an upper bound
+            host_time = received
+        event = DeviceEvent(name, device_us, host_time, uncertainty, received)
+        self.events.append(event)
+        if self.on_event:
+            self.on_event(event)
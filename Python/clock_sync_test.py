@@ -0,0 +1,31 @@
+'''
+ClockSync wrap handling, run with pytest.
+'''
+
+from clock_sync import ClockSync, WRAP_US
+
+
+class _Listeners:
+    def add_listener(self, callback):
+        pass
+
+    def remove_listener(self, callback):
+        pass
+
+
+def test_unwrap_across_the_micros_wrap():
+    sync = ClockSync(_Listeners())
+    # sampled well within half a wrap (~36 min), as the background pings do
+    quarter = WRAP_US // 4
+    device = [WRAP_US - 3000, WRAP_US - 1000, WRAP_US + 500, WRAP_US + quarter, WRAP_US + 2 * quarter,
+              WRAP_US + 3 * quarter, 2 * WRAP_US - 100, 2 * WRAP_US + 100, 2 * WRAP_US + quarter]
+    assert [sync._unwrap(d % WRAP_US) for d in device] == device
+
+
+def test_unwrap_out_of_order_near_the_wrap():
+    sync = ClockSync(_Listeners())
+    # an evt: line after the wrap is handled before a time: reply from just before it
+    assert sync._unwrap(WRAP_US - 2000) == WRAP_US - 2000
+    assert sync._unwrap(1000) == WRAP_US + 1000
+    assert sync._unwrap(WRAP_US - 1500) == WRAP_US - 1500
+    assert sync._unwrap(3000) == WRAP_US + 3000
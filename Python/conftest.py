@@ -0,0 +1,2 @@
+# controller_test.py is a walkthrough for a connected board, not a pytest module
+collect_ignore = ["controller_test.py"]
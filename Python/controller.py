@@ -3,6 +3,9 @@ import time
 import threading
 import os
 import csv
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 class Controller:
@@ -11,37 +14,271 @@ class Controller:
     Integrates serial communication, channel management, and stimulus generation.
     """
     
-    def __init__(self, port="COM7", baud=115200):
+    # any byte interrupts exec on the device; a bare newline is ignored by loop() afterwards
+    INTERRUPT_BYTES = b"\n"
+    INTERRUPTED_MSG = "Execution Interrupted!"
+    # position of an interrupted exec (firmware version 7): paused:<slot>:<step>:<ticks left> or paused:none
+    PAUSED_PREFIX = "paused:"
+    # sent by the firmware from setup() and in reply to "version": ready:<firmware>:<version>
+    READY_PREFIX = "ready:"
+    # channels of the register chain before firmware version 8 reports it with "width"
+    DEFAULT_WIDTH = 32
+    # allocator key of the program upload_sequence()/send_stimulus_from_csv* put in slot 0 once load_slot() is used
+    UPLOAD_KEY = "(upload)"
+    # times an upload the device confirmed only in part is continued before it counts as failed
+    INCOMPLETE_UPLOAD_RETRIES = 2
+
+    def __init__(self, port="COM7", baud=115200, trace=None, auto_reconnect=False):
+        """
+        - trace: path of a binary trace of all serial traffic (serial_trace.py),
+          recorded across connects until stop_trace()
+        - auto_reconnect: reconnect with backoff when the port is lost and resume
+          an interrupted upload (see SUPERVISED CONNECTION)
+        """
         self.port = port
         self.baud = baud
         self.ser = None
         self._print_thread = None
+        self._write_thread = None
+        self.banner = None
+        self.firmware_version = None
+        # channels of the register chain, read from the board on connect()
+        self.width = self.DEFAULT_WIDTH
         self._running = False
+        # output lanes, the writer thread always empties the emergency lane first
+        self._normal_lane = deque()
+        self._emergency_lane = deque()
+        self._lane_cond = threading.Condition()
+        self._writing = False
+        self._upload_cancel = threading.Event()
+        # callbacks(line, host_time) and one-shot waiters for incoming lines
+        self._listeners = []
+        self._waiters = []
+        self._listeners_lock = threading.Lock()
+        # True from exec() until the device reports done/interrupt; any byte sent meanwhile interrupts
+        self.executing = False
+        # {"slot", "step", "ticks_left"} where the device was interrupted, continued by resume()
+        self.paused = None
+        # program_slots.SlotAllocator, created by the first load_slot() of a connection
+        self.slots = None
+        # serial_trace.TraceWriter while tracing
+        self._trace = None
+        # supervised connection: set while connected, the id changes with every lost connection
+        self.auto_reconnect = auto_reconnect
+        self.reconnect_backoff = (0.2, 5.0)     # first and longest pause between attempts, s
+        self.reconnect_timeout = 60.0           # give up after this many seconds
+        self.recoveries = []                    # one dict per lost connection, see _recover()
+        self._connected = threading.Event()
+        self._connection_id = 0
+        self._recovering = False
+        self._upload_slot = None
+        self._supervisor_lock = threading.Lock()
+        if trace:
+            self.start_trace(trace)
 
     # =========================================================================
     # CONNECTION HANDLING
     # =========================================================================
-    def connect(self):
-        """Connect to Arduino via serial port."""
+    def connect(self, wait_ready=True, timeout=3.0, reset=True):
+        """
+        Connect to Arduino via serial port.
+
+        - wait_ready: wait for the firmware's ready banner instead of a fixed sleep
+        - timeout: max seconds to wait for the banner (older firmware sends none)
+        - reset: if False the port is opened without toggling DTR, so the board
+          keeps running and keeps its program; the banner is then requested with "version"
+          (not every OS/driver honours this, Linux usually still pulses DTR)
+
+        Returns the banner, or None if none arrived within timeout.
+        """
         if self.ser and self.ser.is_open:
             self.ser.close()
-        self.ser = serial.Serial(self.port, self.baud, timeout=1)
+        waiter = self.expect(self.READY_PREFIX)
+        self.slots = None
+        self.ser = self._open_port(self.port, self.baud, reset)
         self._running = True
         self._start_print_thread()
+        self._start_write_thread()
+        if not self._recovering:
+            # during a recovery set by _recover() once the board answered
+            self._connected.set()
         print(f"Connected {self.port} @ {self.baud} baud")
+        if not wait_ready:
+            return None
+        if not reset:
+            self.send("version")
+        result = self.wait_line(waiter, timeout)
+        if result is None:
+            print(f"No ready banner from {self.port} within {timeout} s")
+            return None
+        self.banner = result[0]
+        self.firmware_version = self.banner.split(":")[-1]
+        self.width = self.query_width() or self.DEFAULT_WIDTH
+        return self.banner
+
+    @staticmethod
+    def _open_port(port, baud, reset=True, timeout=0.1):
+        ser = serial.Serial()
+        ser.port = port
+        ser.baudrate = baud
+        ser.timeout = timeout
+        if not reset:
+            # DTR low on open = no auto-reset of the board
+            ser.dtr = False
+            ser.rts = False
+        ser.open()
+        return ser
+
+    @classmethod
+    def find_port(cls, candidates=None, baud=115200, timeout=3.0, reset=True, firmware="mosfet_array"):
+        """
+        Scan candidate ports in parallel and return (port, banner) of the first board
+        whose ready banner names `firmware`, or (None, None).
+
+        - candidates: list of port names, default = all serial ports on this machine
+        """
+        if candidates is None:
+            from serial.tools import list_ports
+            candidates = [p.device for p in list_ports.comports()]
+        if not candidates:
+            return None, None
+
+        def probe(port):
+            try:
+                ser = cls._open_port(port, baud, reset)
+            except (serial.SerialException, OSError):
+                return None
+            try:
+                if not reset:
+                    ser.write(b"version\n")
+                deadline = time.perf_counter() + timeout
+                while time.perf_counter() < deadline:
+                    line = ser.readline().decode(errors="ignore").strip()
+                    if line.startswith(cls.READY_PREFIX) and line.split(":")[1:2] == [firmware]:
+                        return line
+            except (serial.SerialException, OSError):
+                return None
+            finally:
+                ser.close()
+            return None
+
+        pool = ThreadPoolExecutor(max_workers=len(candidates))
+        futures = {pool.submit(probe, port): port for port in candidates}
+        try:
+            for future in as_completed(futures):
+                if future.result():
+                    return futures[future], future.result()
+        finally:
+            # probes still running close their port when they time out
+            pool.shutdown(wait=False)
+        return None, None
 
     def disconnect(self):
         """Disconnect from Arduino."""
+        self.wait_sent(timeout=1.0)
         self._running = False
+        self._recovering = False
+        self._connected.clear()
+        with self._lane_cond:
+            self._lane_cond.notify_all()
         if self.ser and self.ser.is_open:
             self.ser.close()
             print("Disconnected")
+        if self._trace is not None:
+            self._trace.flush()
 
-    def reconnect(self):
+    def reconnect(self, reset=True):
         """Reconnect to Arduino."""
         self.disconnect()
         time.sleep(0.2)
-        self.connect()
+        return self.connect(reset=reset)
+
+    # =========================================================================
+    # SUPERVISED CONNECTION (auto_reconnect)
+    # =========================================================================
+    # A read or write error counts as a lost connection. With auto_reconnect the
+    # port is opened again with exponential backoff (without reset, the "version"
+    # request also interrupts a running exec). Programs loaded with load_slot()
+    # that the device no longer holds are forgotten, and an upload in progress
+    # continues from the bytes the device stored (_send_resumable()). Each
+    # loss is recorded in self.recoveries:
+    #   lost_at (time.time()), attempts, recover_s (None if it gave up),
+    #   slots_lost (keys), resumed_at_byte / upload_bytes (for an interrupted upload)
+    # An upload the device confirms only in part without losing the connection
+    # (lines lost on the way) is recorded the same way, with incomplete=True.
+    def _connection_lost(self):
+        with self._supervisor_lock:
+            if not self._running:
+                # closed by disconnect(), or already seen by the other thread
+                return
+            print("Error: Serial disconnected")
+            self._connection_id += 1
+            recover = self.auto_reconnect and not self._recovering
+            if recover:
+                self._recovering = True
+            self._connected.clear()
+            self._running = False
+            self.executing = False
+        with self._lane_cond:
+            self._lane_cond.notify_all()
+        if recover:
+            threading.Thread(target=self._recover, daemon=True).start()
+
+    def _recover(self):
+        t0 = time.perf_counter()
+        record = {"lost_at": time.time(), "attempts": 0, "recover_s": None, "slots_lost": []}
+        self.recoveries.append(record)
+        for thread in (self._print_thread, self._write_thread):
+            if thread is not None:
+                thread.join(1.0)
+        with self._lane_cond:
+            # queued for the lost port, an upload in progress sends again what the device is missing
+            self._normal_lane.clear()
+            self._emergency_lane.clear()
+        try:
+            self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
+        slots = self.slots
+        wait, longest = self.reconnect_backoff
+        while self._recovering and time.perf_counter() - t0 < self.reconnect_timeout:
+            time.sleep(wait)
+            wait = min(wait * 2, longest)
+            record["attempts"] += 1
+            try:
+                banner = self.connect(reset=False, timeout=1.0)
+            except (serial.SerialException, OSError):
+                continue
+            if banner is None:
+                # the port is back but the board does not answer (yet)
+                self._running = False
+                with self._lane_cond:
+                    self._lane_cond.notify_all()
+                self.ser.close()
+                continue
+            self.slots = slots
+            self._check_slots(record)
+            record["recover_s"] = time.perf_counter() - t0
+            print(f"Reconnected after {record['recover_s']:.2f} s ({record['attempts']} attempts)")
+            self._recovering = False
+            self._connected.set()
+            return
+        if self._recovering:
+            print(f"Could not reconnect to {self.port} within {self.reconnect_timeout} s")
+        self._recovering = False
+
+    def _check_slots(self, record):
+        """Forget the load_slot() programs the device lost (e.g. reset by the reconnect)."""
+        if self.slots is None:
+            return
+        result = self.query_slots()
+        device = {} if result is None else result[2]
+        for key, (slot, size, _) in list(self.slots.entries.items()):
+            if slot != self._upload_slot and device.get(slot) != size:
+                self.slots.forget(key)
+                record["slots_lost"].append(key)
+        if record["slots_lost"]:
+            print(f"Programs lost on the device: {', '.join(map(str, record['slots_lost']))}")
 
     # =========================================================================
     # BACKGROUND SERIAL MONITOR
@@ -53,30 +290,249 @@ class Controller:
         self._print_thread.start()
 
     def _print_loop(self):
+        buf = bytearray()
         while self._running:
             try:
-                if self.ser.in_waiting:
-                    line = self.ser.readline().decode(errors="ignore").strip()
+                # blocks for at most the port timeout, so lines are seen as soon as they arrive
+                data = self.ser.read(self.ser.in_waiting or 1)
+                if not data:
+                    continue
+                t = time.perf_counter()
+                trace = self._trace
+                if trace is not None:
+                    trace.record(1, data, t)     # serial_trace.RX
+                buf += data
+                while b"\n" in buf:
+                    raw, _, rest = buf.partition(b"\n")
+                    buf = bytearray(rest)
+                    line = raw.decode(errors="ignore").strip()
                     if line:
                         print("Arduino:", line)
-                else:
-                    time.sleep(0.05)
-            except serial.SerialException:
-                print("Error: Serial disconnected")
-                self._running = False
+                        self._dispatch_line(line, t)
+            except (serial.SerialException, OSError):
+                self._connection_lost()
             except Exception:
                 time.sleep(0.1)
 
+    def _dispatch_line(self, line, t):
+        if line.startswith(("evt:done", "evt:interrupt", self.INTERRUPTED_MSG, "resume failed")):
+            self.executing = False
+        if line.startswith(self.PAUSED_PREFIX):
+            self.paused = self._parse_position(line)
+        elif line.startswith(("evt:exec", "evt:resume", "evt:done", "resume failed")):
+            self.paused = None
+        with self._listeners_lock:
+            listeners = list(self._listeners)
+            waiters = [w for w in self._waiters if line.startswith(w["prefix"])]
+            for w in waiters:
+                self._waiters.remove(w)
+        for w in waiters:
+            w["line"], w["time"] = line, t
+            w["event"].set()
+        for callback in listeners:
+            try:
+                callback(line, t)
+            except Exception as e:
+                print("Listener error:", e)
+
+    def add_listener(self, callback):
+        """Call callback(line, host_time) for every line received from Arduino (host_time = time.perf_counter())."""
+        with self._listeners_lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._listeners_lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def expect(self, prefix):
+        """
+        Register interest in the next line starting with prefix.
+        Call before sending the command that triggers the line, then pass the
+        returned waiter to wait_line().
+        """
+        waiter = {"prefix": prefix, "event": threading.Event(), "line": None, "time": None}
+        with self._listeners_lock:
+            self._waiters.append(waiter)
+        return waiter
+
+    def wait_line(self, waiter, timeout=1.0):
+        """Wait for a line registered with expect(); return (line, host_time) or None on timeout."""
+        if not waiter["event"].wait(timeout):
+            with self._listeners_lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            return None
+        return waiter["line"], waiter["time"]
+
+    # =========================================================================
+    # SERIAL TRACE
+    # =========================================================================
+    def start_trace(self, path):
+        """
+        Record every byte sent and received, with µs timestamps, to a binary trace
+        (replay and compare with serial_trace.py). Replaces a running trace.
+        """
+        from serial_trace import TraceWriter
+        self.stop_trace()
+        self._trace = TraceWriter(path, {"port": self.port, "baud": self.baud, "banner": self.banner, "width": self.width})
+        print(f"Tracing serial traffic to {path}")
+
+    def stop_trace(self):
+        """Close the trace file; returns its path or None if not tracing."""
+        trace, self._trace = self._trace, None
+        if trace is None:
+            return None
+        trace.close()
+        return trace.path
+
+    # =========================================================================
+    # BACKGROUND SERIAL WRITER
+    # =========================================================================
+    def _start_write_thread(self):
+        if self._write_thread and self._write_thread.is_alive():
+            return
+        self._write_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._write_thread.start()
+
+    def _write_loop(self):
+        while self._running:
+            with self._lane_cond:
+                while self._running and not self._emergency_lane and not self._normal_lane:
+                    self._lane_cond.wait(0.1)
+                if self._emergency_lane:
+                    data = self._emergency_lane.popleft()
+                elif self._normal_lane:
+                    data = self._normal_lane.popleft()
+                else:
+                    continue
+                self._writing = True
+            try:
+                # recorded before the write, a fast reply must not come first in the trace
+                trace = self._trace
+                if trace is not None:
+                    trace.record(0, data)        # serial_trace.TX
+                self.ser.write(data)
+            except (serial.SerialException, OSError):
+                self._connection_lost()
+            finally:
+                with self._lane_cond:
+                    self._writing = False
+                    self._lane_cond.notify_all()
+
+    def wait_sent(self, timeout=None):
+        """Block until all queued output has been handed to the port. Returns False on timeout."""
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self._lane_cond:
+            while self._running and (self._normal_lane or self._emergency_lane or self._writing):
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lane_cond.wait(remaining)
+        return True
+
     # =========================================================================
     # COMMAND METHODS
     # =========================================================================
     def send(self, command):
-        """Send a command to Arduino."""
+        """Queue a command for Arduino (written by the writer thread, in order)."""
         if not self.ser or not self.ser.is_open:
             raise ConnectionError("Serial port not open")
         if not command.endswith("\n"):
             command += "\n"
-        self.ser.write(command.encode())
+        with self._lane_cond:
+            self._normal_lane.append(command.encode())
+            self._lane_cond.notify_all()
+
+    def send_if_idle(self, command):
+        """
+        Queue a command unless an exec is running, returns False if it was not sent.
+        Checked under the same lock _send_exec() sets executing with, so a
+        background query (ClockSync) can never be queued right behind an exec
+        and interrupt it.
+        """
+        with self._lane_cond:
+            if self.executing:
+                return False
+            self.send(command)
+        return True
+
+    def _send_exec(self, command):
+        # executing and the queued command change together, see send_if_idle()
+        with self._lane_cond:
+            self.executing = True
+            self.send(command)
+
+    def stop(self, timeout=1.0):
+        """
+        Interrupt a running exec as fast as possible.
+
+        - drops all queued output (also what the OS has not sent yet) and
+          cancels an upload in progress; a cancelled upload has to be sent again
+        - the interrupt byte jumps the queue through the emergency lane
+        - returns the latency in ms until Arduino confirmed "Execution Interrupted!",
+          or None if nothing was confirmed within timeout (e.g. nothing was running)
+        """
+        if not self.ser or not self.ser.is_open:
+            raise ConnectionError("Serial port not open")
+        t0 = time.perf_counter()
+        self.executing = False
+        self._upload_cancel.set()
+        waiter = self.expect(self.INTERRUPTED_MSG)
+        # firmware version 7 reports the position right after, resume() needs it
+        position = self.expect(self.PAUSED_PREFIX)
+        with self._lane_cond:
+            self._normal_lane.clear()
+            self.ser.reset_output_buffer()
+            self._emergency_lane.append(self.INTERRUPT_BYTES)
+            self._lane_cond.notify_all()
+        result = self.wait_line(waiter, timeout)
+        self.wait_line(position, 0.1 if result is not None and not self._firmware_older_than(7) else 0)
+        if result is None:
+            return None
+        latency_ms = (result[1] - t0) * 1000.0
+        print(f"Stopped in {latency_ms:.2f} ms")
+        return latency_ms
+
+    def pause(self, timeout=1.0):
+        """
+        Interrupt a running exec and keep its position on the device (firmware
+        version 7). Queued output is kept. stop() keeps the position as well,
+        pause() only asks for it by name and returns it:
+        {"slot", "step", "ticks_left"}, or None if nothing was paused.
+        """
+        if not self.ser or not self.ser.is_open:
+            raise ConnectionError("Serial port not open")
+        self._require_firmware(7, "Pause and resume")
+        waiter = self.expect(self.PAUSED_PREFIX)
+        with self._lane_cond:
+            self._emergency_lane.append(b"pause\n")
+            self._lane_cond.notify_all()
+        result = self.wait_line(waiter, timeout)
+        if result is None:
+            return None
+        return self._parse_position(result[0])
+
+    def resume(self):
+        """
+        Continue the program interrupted by pause() or stop() with the rest of
+        the step it was in, without uploading anything. Loading or freeing
+        programs on the device in between drops the position.
+        """
+        self._require_firmware(7, "Pause and resume")
+        if self.paused is None:
+            raise RuntimeError("Nothing paused on the device")
+        position = self.paused
+        self._send_exec("resume")
+        return position
+
+    @staticmethod
+    def _parse_position(line):
+        fields = line.split(":")[1:]
+        if len(fields) != 3 or not all(f.isdigit() for f in fields):
+            return None
+        slot, step, left = (int(f) for f in fields)
+        return {"slot": slot, "step": step, "ticks_left": left}
 
     # too quick for longer files
     def send_file(self, filename):
@@ -97,11 +553,298 @@ class Controller:
         self.send(f"{cmd}/{index}:{value}")
 
     def exec(self):
-        """Execute the loaded stimulus on Arduino."""
-        self.send("exec")
+        """Execute the loaded stimulus on Arduino (slot 0 once load_slot() is used)."""
+        slot = self.slots.lookup(self.UPLOAD_KEY) if self.slots is not None else None
+        self._send_exec("exec" if slot is None else f"exec:{slot}")
+
+    def upload_sequence(self, seq, delay=0.01, log_path=None, tick_us=None, packed=False):
+        """
+        Send clearcode followed by one addcode per (mask, dur) step with dur > 0.
+
+        - delay = pause between sending lines
+        - log_path = optional path to log file (will be overwritten each time)
+        - tick_us = None sends the delays as whole ms; "auto" or a tick in µs
+          converts them to timer ticks (timebase.py, firmware version 4), so
+          delays can be fractional and longer than 65.5 s
+        - packed = send the program XOR-delta/varint encoded (packed_program.py,
+          firmware version 5), about a third of the device memory per step
+
+        Returns False if the upload was cancelled by stop(), True otherwise.
+        """
+        if tick_us is not None:
+            tick_us, seq = self.tick_sequence(seq, tick_us)
+        if not self._send_program(seq, tick_us, delay, log_path, self._pack(seq) if packed else None):
+            if self.slots is not None:
+                self.slots.forget(self.UPLOAD_KEY)
+            return False
+        return True
+
+    def tick_sequence(self, seq, tick_us="auto"):
+        """(tick_us, steps) of a (mask, dur_ms) sequence for the timer scheduler of firmware version 4."""
+        import timebase
+        self._require_firmware(4, "Timer ticks")
+        return timebase.to_ticks(seq, None if tick_us == "auto" else tick_us, self.width)
+
+    def _firmware_older_than(self, version):
+        return self.firmware_version is not None and self.firmware_version.isdigit() and int(self.firmware_version) < version
+
+    def _require_firmware(self, version, feature):
+        if self._firmware_older_than(version):
+            raise RuntimeError(f"{feature} need firmware version {version}, the board reports {self.banner}")
+
+    def _pack(self, seq):
+        import packed_program
+        self._require_firmware(5, "Packed programs")
+        return packed_program.encode(seq, self.width)
+
+    def _send_program(self, seq, tick_us, delay, log_path, packed=None, slot=None):
+        self._upload_cancel.clear()
+        if slot is None and self.slots is not None:
+            seq, slot = self._claim_upload_slot(seq, packed)
+        log_file = open(log_path, "w") if log_path else None
+        try:
+            head = [] if slot is None else [f"select:{slot}"]
+            head += ["clearcode"] if tick_us is None else ["clearcode", f"tick:{tick_us}"]
+            if packed is not None:
+                import packed_program
+                head.append("packed")
+                body = packed_program.upload_lines(packed)
+            elif self.auto_reconnect:
+                seq = list(seq)
+                body = list(self._addcode_lines(seq))
+            else:
+                # seq may be a generator (e.g. masks.compile_csv_vertical), lines are produced as sent
+                body = self._addcode_lines(seq)
+            if self.auto_reconnect:
+                return self._send_resumable(head, body, seq, tick_us, packed, slot, delay, log_file)
+            return self._send_lines(chain(head, body), delay, log_file)
+        finally:
+            if log_file:
+                log_file.close()
+
+    def _claim_upload_slot(self, seq, packed):
+        """
+        With load_slot() programs on the device a plain upload goes to slot 0,
+        and is kept in the allocator (UPLOAD_KEY) so no program is overwritten
+        behind its back and the buffer space stays accounted for.
+        """
+        from program_slots import step_bytes
+        seq = list(seq)
+        size = len(packed) if packed is not None else step_bytes(self.width) * sum(1 for _, dur in seq if dur > 0)
+        for old_key, old_slot in self.slots.claim(self.UPLOAD_KEY, 0, size):
+            self.send(f"free:{old_slot}")
+        return seq, 0
+
+    def _addcode_lines(self, seq):
+        """addcode lines of the steps with dur > 0; ValueError for a channel beyond the board's chain."""
+        for mask, dur in seq:
+            if dur > 0:
+                if int(mask) >> self.width:
+                    raise ValueError(f"Mask 0x{int(mask):x} has channels beyond the {self.width}-channel chain of the board")
+                yield f"addcode:0x{int(mask):x}/{dur}"
+
+    def _send_lines(self, lines, delay, log_file, connection=None):
+        """Send lines with a pause; False if cancelled by stop(), ConnectionError if the connection changes."""
+        for cmd in lines:
+            if self._upload_cancel.is_set():
+                print("Upload cancelled")
+                return False
+            if connection is not None and connection != self._connection_id:
+                raise ConnectionError("Serial connection lost")
+            self.send(cmd)
+            if log_file:
+                log_file.write(f"{cmd}\n")
+            time.sleep(delay)
+        return True
+
+    def _send_resumable(self, head, body, seq, tick_us, packed, slot, delay, log_file):
+        """
+        Upload that survives a lost connection (auto_reconnect): after the
+        reconnect the device reports how much of the slot it stored (status,
+        firmware version 6) and only the rest is sent. The whole program is sent
+        again if the stored part does not match, or with older firmware. An
+        upload the device confirms only in part is continued the same way, and
+        fails (False) if it is still incomplete after INCOMPLETE_UPLOAD_RETRIES.
+        """
+        from program_slots import plain_bytes
+        image = packed if packed is not None else plain_bytes(seq, self.width)
+        lines = head + body
+        incomplete = 0
+        self._upload_slot = slot
+        try:
+            while True:
+                connection = self._connection_id
+                try:
+                    if lines is None:
+                        lines = self._resume_lines(head, body, image, tick_us, packed, slot)
+                    if not self._send_lines(lines, delay, log_file, connection):
+                        return False
+                    self.wait_sent()
+                    if connection == self._connection_id:
+                        # confirm on the device, the last lines may have been lost with the port
+                        stored = self._stored_bytes(image, tick_us, packed is not None, slot)
+                        if connection == self._connection_id:
+                            if stored is None or stored == len(image):
+                                return True
+                            print(f"Upload incomplete, the device stored {stored} of {len(image)} bytes")
+                            self.recoveries.append({"lost_at": time.time(), "attempts": 0, "recover_s": 0.0,
+                                                    "slots_lost": [], "incomplete": True})
+                            incomplete += 1
+                            if incomplete > self.INCOMPLETE_UPLOAD_RETRIES:
+                                print("Upload failed")
+                                return False
+                            lines = self._resume_lines(head, body, image, tick_us, packed, slot, stored)
+                            continue
+                except ConnectionError:
+                    pass
+                print("Upload interrupted by the lost connection, waiting for the reconnect")
+                while not self._connected.wait(0.1):
+                    if not self._recovering:
+                        raise ConnectionError(f"Upload failed, {self.port} did not come back")
+                if self._upload_cancel.is_set():
+                    print("Upload cancelled")
+                    return False
+                lines = None
+        finally:
+            self._upload_slot = None
+
+    def _resume_lines(self, head, body, image, tick_us, packed, slot, stored=None):
+        """Lines that complete an interrupted upload, from what the device stored (asked if None)."""
+        import packed_program
+        from program_slots import step_bytes
+        if stored is None:
+            stored = self._stored_bytes(image, tick_us, packed is not None, slot) or 0
+        if self.recoveries:
+            self.recoveries[-1]["resumed_at_byte"] = stored
+            self.recoveries[-1]["upload_bytes"] = len(image)
+        if stored == 0:
+            print("Sending the whole program again")
+            return head + body
+        if packed is not None:
+            print(f"Resuming the upload at byte {stored} of {len(image)}")
+            return packed_program.upload_lines(packed[stored:])
+        print(f"Resuming the upload at step {stored // step_bytes(self.width)} of {len(body)}")
+        return body[stored // step_bytes(self.width):]
+
+    def _stored_bytes(self, image, tick_us, packed, slot):
+        """
+        Bytes of image the device holds in slot (default: the current slot), 0 if
+        the slot holds something else, None without a status reply.
+        """
+        import timebase
+        from program_slots import fletcher16, step_bytes
+        if slot is not None:
+            self.send(f"select:{slot}")
+        status = self.query_status()
+        if status is None:
+            return None
+        n = status["bytes"]
+        if ((slot is not None and status["slot"] != slot)
+                or status["tick_us"] != (timebase.DEFAULT_TICK_US if tick_us is None else tick_us)
+                or status["packed"] != packed
+                or n > len(image) or (not packed and n % step_bytes(self.width))
+                or fletcher16(image[:n]) != status["checksum"]):
+            return 0
+        return n
+
+    def query_width(self, timeout=1.0):
+        """
+        Channels of the board's register chain: "width" of firmware version 8
+        (built for 32..128 channels), 32 before that, None without a reply.
+        """
+        if self._firmware_older_than(8):
+            return self.DEFAULT_WIDTH
+        waiter = self.expect("width:")
+        self.send("width")
+        result = self.wait_line(waiter, timeout)
+        if result is None:
+            return None
+        return int(result[0].split(":")[1])
+
+    def query_status(self, timeout=1.0):
+        """
+        Device view of the current slot (firmware version 6): dict with slot, bytes,
+        tick_us, packed and checksum (program_slots.fletcher16 of its bytes), or None.
+        """
+        if self._firmware_older_than(6):
+            return None
+        waiter = self.expect("status:")
+        self.send("status")
+        result = self.wait_line(waiter, timeout)
+        if result is None:
+            return None
+        slot, n, tick_us, packed, checksum = (int(x) for x in result[0].split(":")[1:6])
+        return {"slot": slot, "bytes": n, "tick_us": tick_us, "packed": bool(packed), "checksum": checksum}
+
+    # =========================================================================
+    # PROGRAM SLOTS (with_stop firmware version 3 and later)
+    # =========================================================================
+    def load_slot(self, key, seq, delay=0.01, log_path=None, tick_us=None, packed=False):
+        """
+        Make a (mask, dur) sequence resident in a device program slot under `key`.
+        Nothing is sent if the same sequence is already loaded under that key.
+        When the device runs out of slots or buffer space the least recently
+        used programs are freed.
+
+        - tick_us / packed: as for upload_sequence(), both are kept per slot
+
+        Returns the slot number, or None if the upload was cancelled by stop().
+        After the first load_slot(), upload_sequence()/send_stimulus_from_csv*
+        replace the program in slot 0 (exec() runs it), the others stay loaded.
+        """
+        from program_slots import SlotAllocator, sequence_digest, step_bytes, capacity_bytes
+        self._require_firmware(3, "Program slots")
+        if self.slots is None:
+            self.slots = SlotAllocator(capacity=capacity_bytes(self.width))
+            # programs left from an earlier session are unknown here
+            self.send("clearall")
+        if tick_us is not None:
+            tick_us, seq = self.tick_sequence(seq, tick_us)
+        seq = list(seq)
+        digest = sequence_digest(seq) if tick_us is None else f"{sequence_digest(seq)}@{tick_us}"
+        data = self._pack(seq) if packed else None
+        if packed:
+            digest += "/packed"
+        slot = self.slots.lookup(key, digest)
+        if slot is not None:
+            return slot
+        size = len(data) if packed else step_bytes(self.width) * sum(1 for _, dur in seq if dur > 0)
+        slot, evicted = self.slots.allocate(key, size, digest)
+        for _, old_slot in evicted:
+            self.send(f"free:{old_slot}")
+        if not self._send_program(seq, tick_us, delay, log_path, data, slot):
+            self.slots.forget(key)
+            return None
+        return slot
+
+    def exec_slot(self, key):
+        """Run the program loaded under `key` with a single exec:<slot> command."""
+        slot = self.slots.lookup(key) if self.slots is not None else None
+        if slot is None:
+            raise KeyError(f"No program loaded under {key!r}, call load_slot() first")
+        self._send_exec(f"exec:{slot}")
+        return slot
+
+    def query_slots(self, timeout=1.0):
+        """Device view of the slots: (bytes used, bytes available, {slot: bytes}) or None."""
+        waiter = self.expect("slots:")
+        self.send("slots")
+        result = self.wait_line(waiter, timeout)
+        if result is None:
+            return None
+        usage, *slots = result[0].split(":", 1)[1].split()
+        used, available = (int(x) for x in usage.split("/"))
+        slots = {int(k): int(n) for k, n in (s.split(":") for s in slots)}
+        if self._firmware_older_than(5):
+            # counted in 6-byte steps before version 5
+            from program_slots import STEP_BYTES
+            used, available = used * STEP_BYTES, available * STEP_BYTES
+            slots = {k: n * STEP_BYTES for k, n in slots.items()}
+        return used, available, slots
+
 ################################################################
 # debugging (saves log of sent commands)
-    def send_stimulus_from_csv(self, csv_path, col_ms=100, delay=0.01, log_path="arduino_commands.log"):
+    def send_stimulus_from_csv(self, csv_path, col_ms=100, delay=0.01, log_path="arduino_commands.log", timing_model=None, tick_us=None):
         """
         Read a binary matrix CSV and send corresponding Arduino commands directly.
 
@@ -111,30 +854,24 @@ class Controller:
         - col_ms = time duration per column
         - delay = pause between sending lines
         - log_path = path to log file (will be overwritten each time)
+        - timing_model = optional TimingModel to compensate the per-step overhead
+        - tick_us = timer tick for upload_sequence(), "auto" when col_ms is fractional
 
         This is equivalent to generating 'stim_from_csv.txt' and then
         calling send_file_line_by_line(), but avoids creating the file.
         """
-        stim = Controller.Stimulus.from_csv_matrix(csv_path, col_ms=col_ms)
-        seq = stim.generate_timed_sequence()
-
-        # Open log file in write mode (overwrites existing file)
-        with open(log_path, 'w') as log_file:
-            # Send clearcode
-            cmd = "clearcode"
-            self.send(cmd)
-            log_file.write(f"{cmd}\n")
-            time.sleep(delay)
+        # compiled with the NumPy mask engine, same result as Stimulus.from_csv_matrix()
+        import masks
+        channel_ids, matrix = masks.read_csv_matrix(csv_path)
+        seq = masks.compile_matrix(matrix, channel_ids, col_ms=col_ms)
+        if timing_model is not None:
+            seq = timing_model.compensate(seq)
+        if tick_us is None and col_ms != int(col_ms):
+            tick_us = "auto"
+        return self.upload_sequence(seq, delay=delay, log_path=log_path, tick_us=tick_us)
 
-            # Send addcode commands
-            for mask, dur in seq:
-                if dur > 0:
-                    cmd = f"addcode:0x{mask:x}/{dur}"
-                    self.send(cmd)
-                    log_file.write(f"{cmd}\n")
-                    time.sleep(delay)
     # keep one final version eventually
-    def send_stimulus_from_csv_vertical(self, csv_path, col_ms=100, delay=0.01, log_path="arduino_commands.log"):
+    def send_stimulus_from_csv_vertical(self, csv_path, col_ms=100, delay=0.01, log_path="arduino_commands.log", timing_model=None, tick_us=None):
         """
         Read a binary matrix CSV and send corresponding Arduino commands directly.
         CSV:
@@ -145,28 +882,37 @@ class Controller:
         - col_ms = time duration per column
         - delay = pause between sending lines
         - log_path = path to log file (will be overwritten each time)
+        - timing_model = optional TimingModel to compensate the per-step overhead
+        - tick_us = timer tick for upload_sequence(), "auto" when col_ms is fractional
 
         This is equivalent to generating 'stim_from_csv.txt' and then
         calling send_file_line_by_line(), but avoids creating the file.
         """
-        stim = Controller.Stimulus.from_csv_matrix_vertical(csv_path, col_ms=col_ms)
-        seq = stim.generate_timed_sequence()
+        # streamed through the NumPy mask engine, same result as Stimulus.from_csv_matrix_vertical();
+        # the matrix is never loaded as a whole, so the file can be arbitrarily long
+        import masks
+        seq = masks.compile_csv_vertical(csv_path, col_ms=col_ms)
+        if timing_model is not None:
+            seq = timing_model.compensate(seq)
+        if tick_us is None and col_ms != int(col_ms):
+            tick_us = "auto"
+        return self.upload_sequence(seq, delay=delay, log_path=log_path, tick_us=tick_us)
 
-        # Open log file in write mode (overwrites existing file)
-        with open(log_path, 'w') as log_file:
-            # Send clearcode
-            cmd = "clearcode"
-            self.send(cmd)
-            log_file.write(f"{cmd}\n")
-            time.sleep(delay)
+    def send_stimulus_from_file(self, path, col_ms=100, delay=0.01, log_path="arduino_commands.log", timing_model=None, channel_ids=None, tick_us=None):
+        """
+        Compile and send a matrix file of any supported format (see matrix_io.py):
+        .csv (layout detected), .npy / .npz (memory-mapped) or .u32 / .u64 / .u128 (bit-packed).
 
-            # Send addcode commands
-            for mask, dur in seq:
-                if dur > 0:
-                    cmd = f"addcode:0x{mask:x}/{dur}"
-                    self.send(cmd)
-                    log_file.write(f"{cmd}\n")
-                    time.sleep(delay)
+        - channel_ids = channel per column for a plain .npy (default 0..n-1)
+        - tick_us = timer tick for upload_sequence(), "auto" when col_ms is fractional
+        """
+        import matrix_io
+        seq = matrix_io.compile_path(path, col_ms=col_ms, channel_ids=channel_ids)
+        if timing_model is not None:
+            seq = timing_model.compensate(seq)
+        if tick_us is None and col_ms != int(col_ms):
+            tick_us = "auto"
+        return self.upload_sequence(seq, delay=delay, log_path=log_path, tick_us=tick_us)
 
 ##############################################################################
 
@@ -215,7 +961,8 @@ class Controller:
 
             Constructor 1:
                 Channel(ids, is_on=1, hold_time_ms=500)
-                  - ids: int or list[int]
+                  - ids: int or list[int], 0 .. width - 1 of the register chain
+                    (Controller.width, up to 128 with firmware version 8)
                   - is_on: 1 or 0 (default 1)
                   - hold_time_ms: duration in ms
 
@@ -352,55 +1099,53 @@ class Controller:
             0   1   1
             ...
             """
-            # Read CSV into matrix
+            # Scan the rows one by one, only the open onset per channel is kept
             with open(csv_path, newline="", encoding="utf-8") as f:
                 first_line = f.readline()
                 delimiter = '\t' if '\t' in first_line else ','
                 f.seek(0)
                 reader = csv.reader(f, delimiter=delimiter)
-                
-                # Read all rows
-                all_rows = []
+
+                channel_ids = None
+                onsets = []
+                per_channel = []    # channels per column, concatenated column by column below
+                n_steps = 0
                 for row in reader:
                     row = [x.strip() for x in row if x.strip() != '']
-                    if row:
-                        all_rows.append(row)
-                
-                if not all_rows:
-                    return cls([])
-                
-                # First row contains channel IDs
-                channel_ids = [int(x) for x in all_rows[0]]
-                
-                # Remaining rows contain time steps
-                time_steps = [[int(x) for x in row] for row in all_rows[1:]]
-            
-            if not time_steps:
+                    if not row:
+                        continue
+                    if channel_ids is None:
+                        # First row contains channel IDs
+                        channel_ids = [int(x) for x in row]
+                        onsets = [None] * len(channel_ids)
+                        per_channel = [[] for _ in channel_ids]
+                        continue
+                    if len(row) != len(channel_ids):
+                        raise ValueError(f"{csv_path}: row {n_steps + 1} has {len(row)} values, expected {len(channel_ids)}")
+                    t = n_steps * col_ms
+                    for ch_idx, x in enumerate(row):
+                        val = int(x)
+                        if val == 1 and onsets[ch_idx] is None:
+                            onsets[ch_idx] = t
+                        elif val == 0 and onsets[ch_idx] is not None:
+                            per_channel[ch_idx].append(Controller.Channel(ids=channel_ids[ch_idx],
+                                                                          onset_ms=onsets[ch_idx],
+                                                                          offset_ms=t))
+                            onsets[ch_idx] = None
+                    n_steps += 1
+
+            if not n_steps:
                 return cls([])
-            
-            n_steps = len(time_steps)
+
             channels = []
-            
-            # Process each channel (column)
             for ch_idx, ch_id in enumerate(channel_ids):
-                onset = None
-                for step_idx, step_row in enumerate(time_steps):
-                    val = step_row[ch_idx]
-                    if val == 1 and onset is None:
-                        onset = step_idx * col_ms
-                    elif val == 0 and onset is not None:
-                        offset = step_idx * col_ms
-                        channels.append(Controller.Channel(ids=ch_id,
-                                                        onset_ms=onset,
-                                                        offset_ms=offset))
-                        onset = None
-                
+                channels += per_channel[ch_idx]
                 # Channel still active at the end
-                if onset is not None:
+                if onsets[ch_idx] is not None:
                     channels.append(Controller.Channel(ids=ch_id,
-                                                    onset_ms=onset,
+                                                    onset_ms=onsets[ch_idx],
                                                     offset_ms=n_steps * col_ms))
-            
+
             return cls(channels)
 
         # ---------------------------------------------------------------------
@@ -427,9 +1172,12 @@ class Controller:
         # ---------------------------------------------------------------------
         # TIMED MODE (channels with onset/offset times)
         # ---------------------------------------------------------------------
-        def generate_timed_sequence(self):
+        def generate_timed_sequence(self, timing_model=None):
             """
             Create a time-based activation sequence using channels with onset and offset times.
+
+            - timing_model: optional TimingModel (timing_model.py); step delays are then
+              shortened by the board's measured per-step overhead so the sequence ends on time
             """
             events = []
             for ch in self.channels:
@@ -452,6 +1200,8 @@ class Controller:
 
             # final state (off)
             seq.append((0, 0))
+            if timing_model is not None:
+                seq = timing_model.compensate(seq)
             return seq
 # bug with sorting?
         # def generate_timed_sequence(self):
@@ -480,14 +1230,28 @@ class Controller:
         #     seq.append((0, 0))
         #     return seq
 
-        def to_file4arduino_timed(self, file_name):
+        def to_file4arduino_timed(self, file_name, timing_model=None):
             """Generate Arduino commands from onset/offset timed channels."""
             path2file = os.path.join(os.getcwd(), file_name)
-            seq = self.generate_timed_sequence()
+            seq = self.generate_timed_sequence(timing_model=timing_model)
             lines = ["clearcode"]
             for mask, dur in seq:
                 if dur > 0:
                     lines.append(f"addcode:0x{mask:x}/{dur}")
             with open(path2file, "w", encoding="utf-8") as f:
                 f.write("\n".join(lines))
-            return path2file
\ No newline at end of file
+            return path2file
+
+        def index(self):
+            """StimulusIndex (stimulus_index.py) of the timed sequence for time queries and safety checks."""
+            from stimulus_index import StimulusIndex
+            return StimulusIndex(self.generate_timed_sequence())
+
+        def generate_tick_sequence(self, tick_us=None, width=32):
+            """
+            Timed sequence in timer ticks for firmware version 4: (tick_us, [(mask, n_ticks), ...]).
+            Onsets/offsets may be fractional ms; tick_us=None lets timebase.choose_tick() pick the tick
+            (width = channels of the register chain, wider chains need a longer tick).
+            """
+            import timebase
+            return timebase.to_ticks(self.generate_timed_sequence(), tick_us, width)
@@ -18,8 +18,8 @@ stim_dir = "stim_files"
 
 print("=== Connect to the controller ===")
 controller = Controller(port="COM9")
+# waits for the ready banner of the board instead of a fixed sleep
 controller.connect()
-time.sleep(2)
 print("\n=== Upload stimulus from csv to the controller ===")
 # select the desired time duration per column (col_ms)
 controller.send_stimulus_from_csv_vertical(os.path.join(stim_dir,"motion_stim_vertical.csv"), col_ms=2000)
@@ -27,7 +27,7 @@ time.sleep(1)
 print("\n=== Run ===")
 controller.exec()
 time.sleep(5)
-controller.send("stop")
+controller.stop()
 time.sleep(1)
 controller.disconnect()
 
@@ -0,0 +1,500 @@
+'''
+Serial emulator of the with_stop firmware (version 8), for testing without a board.
+
+Opens a pseudo terminal and answers on it like the Arduino does: program
+slots, timer ticks, packed programs, exec with interruption by any incoming byte, the
+evt:/time: lines for clock synchronization. Every state written to the
+shift registers is recorded with its time, so the timing of a run can be
+checked against the sequence that was requested:
+
+    from emulator import Emulator
+    with Emulator() as emu:
+        controller = Controller(emu.port)
+        controller.connect(reset=False)      # a pty has no DTR reset, the banner comes from "version"
+        controller.upload_sequence(seq, delay=0, tick_us="auto")
+        controller.exec()
+        controller.wait_sent()
+        emu.wait_idle()
+        errors = emu.timing_errors(seq)      # [(requested switch in µs, error in µs), ...]
+
+Steps switch at absolute deadlines t0 + ticks * tick_us, like the timer
+interrupt of the firmware. Each write keeps its deadline and the host time it
+actually happened: timing_errors() checks the deadlines, so the result only
+shows the tick rounding of the program and does not depend on the load of the
+host; timing_errors(seq, actual=True) includes the host's scheduling jitter.
+replug() simulates a USB glitch: the port goes away and the board comes back
+on a new port with its memory intact, for testing reconnects
+(Controller(auto_reconnect=True)).
+
+Emulator(speed=10) runs programs and its clock ten times faster (times
+reported by timing_errors() and micros() stay in device time), for replaying
+recorded sessions quickly (serial_trace.py). Emulator(width=128) emulates
+the firmware built for a 128-channel register chain (chain_bytes 16).
+Needs a POSIX system (pty).
+'''
+
+import os
+import pty
+import tty
+import time
+import select
+import struct
+import threading
+
+
+BANNER = "ready:mosfet_array:8"
+BUFFER_BYTES = 1200
+CAPACITY_BYTES = 1194
+WIDTH = 32
+N_SLOTS = 8
+DEFAULT_TICK_US = 1000
+TICK_MIN_US = 100
+TICK_US_PER_BYTE = 25
+TICK_MAX_US = 32767
+SPIN_S = 0.0005     # the last part of a wait is spent polling, select() alone is too coarse
+
+
+def parse_uint32(text):
+    """Number as the firmware's parseUint32() reads it ("0x" + lower-case hex, or decimal), or None."""
+    if not text:
+        return None
+    if text.startswith("0x"):
+        digits, base = text[2:], 16
+        if any(c not in "0123456789abcdef" for c in digits):
+            return None
+    else:
+        digits, base = text, 10
+        if any(c not in "0123456789" for c in digits):
+            return None
+    return int(digits, base) & 0xFFFFFFFF if digits else 0
+
+
+def parse_state(text, width=WIDTH):
+    """State as the firmware's parseState() reads it: hex of up to width bits, or a 32-bit decimal; else None."""
+    if text.startswith("0x"):
+        digits = text[2:]
+        if any(c not in "0123456789abcdef" for c in digits):
+            return None
+        state = int(digits, 16) if digits else 0
+        return None if state >> (8 * ((width + 7) // 8)) else state
+    return parse_uint32(text)
+
+
+class Run:
+    def __init__(self, slot, tick_us, program):
+        self.slot = slot
+        self.tick_us = tick_us
+        self.program = program      # [(state, ticks), ...] decoded from the slot, from the resumed step on
+        self.writes = []            # [(deadline, perf_counter seconds, state), ...]
+        self.interrupted = False
+        self.finished = threading.Event()
+
+
+class Emulator:
+    def __init__(self, banner=BANNER, capacity=None, n_slots=N_SLOTS, speed=1.0, width=WIDTH):
+        """
+        - capacity: program bytes (default: the firmware's buffer less one step)
+        - width: channels of the register chain, a multiple of 8 in 32..128
+        """
+        if speed <= 0:
+            raise ValueError(f"Speed must be positive, got {speed}")
+        if width % 8 or not 32 <= width <= 128:
+            raise ValueError(f"Width must be a multiple of 8 in 32..128, got {width}")
+        self.banner = banner
+        self.speed = speed
+        self.width = width
+        self.chain_bytes = width // 8
+        self.step_bytes = self.chain_bytes + 2
+        self.tick_min_us = max(TICK_MIN_US, TICK_US_PER_BYTE * self.chain_bytes)
+        self.capacity = BUFFER_BYTES - self.step_bytes if capacity is None else capacity
+        self.n_slots = n_slots
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self.code = bytearray()            # all slots back to back, as code_sequence
+        self.slot_start = [0] * n_slots
+        self.slot_len = [0] * n_slots
+        self.slot_used = [False] * n_slots
+        self.slot_packed = [False] * n_slots
+        self.slot_tick = [DEFAULT_TICK_US] * n_slots
+        self.cur_slot = 0
+        self.state = 0
+        self.lines = []                    # every command received
+        self.runs = []                     # one Run per exec or resume
+        self.paused = None                 # (slot, step, ticks left) of an interrupted run
+        self._pos_reported = False
+        self._t_boot = time.perf_counter()
+        self._buf = b""
+        self._handling = False
+        self._closed = False
+        self._thread = None
+
+    # =========================================================================
+    # LIFETIME
+    # =========================================================================
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, args=(self._master,), daemon=True)
+        self._thread.start()
+        self._println(self.banner)
+        return self
+
+    def close(self):
+        self._closed = True
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def replug(self):
+        """
+        Drop the port and open a new one (self.port changes), as when a USB glitch
+        makes the board enumerate again. Memory and slots are kept and nothing
+        is announced on the new port. Returns the new port.
+        """
+        old = (self._master, self._slave)
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._buf = b""
+        for fd in old:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._thread = threading.Thread(target=self._loop, args=(self._master,), daemon=True)
+        self._thread.start()
+        return self.port
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def wait_idle(self, timeout=None):
+        """Wait until everything received is handled and no exec is running. Returns False on timeout."""
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while self._handling or b"\n" in self._buf or select.select([self._master], [], [], 0)[0]:
+            if deadline is not None and time.perf_counter() > deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    # =========================================================================
+    # TIMING CHECK
+    # =========================================================================
+    def timing_errors(self, seq, run=None, actual=False):
+        """
+        Compare a run with the requested (mask, dur_ms) sequence.
+
+        Returns [(requested switch time in µs, error in µs), ...] for every state
+        change (the final switch off included), times relative to the first write.
+        - actual: use the host times of the writes instead of their tick deadlines
+        Raises ValueError if the run shows other states than requested, e.g. when
+        a step shorter than half a tick was dropped.
+        """
+        run = self.runs[-1] if run is None else run
+        requested, t = [], 0.0
+        for mask, dur in seq:
+            if dur > 0:
+                if not requested or requested[-1][1] != mask:
+                    requested.append((t, mask))
+                t += dur * 1000.0
+        requested.append((t, 0))
+        if not run.writes:
+            raise ValueError("Nothing was written in this run")
+        column = 1 if actual else 0
+        t0 = run.writes[0][column]
+        switches = []
+        for write in run.writes:
+            state = write[2]
+            if not switches or switches[-1][1] != state:
+                switches.append(((write[column] - t0) * 1e6 * self.speed, state))
+        if [m for _, m in switches] != [m for _, m in requested]:
+            raise ValueError(f"Run switched through {len(switches)} states, {len(requested)} were requested")
+        return [(t_req, t_run - t_req) for (t_req, _), (t_run, _) in zip(requested, switches)]
+
+    # =========================================================================
+    # SERIAL
+    # =========================================================================
+    def micros(self):
+        return int((time.perf_counter() - self._t_boot) * 1e6 * self.speed) & 0xFFFFFFFF
+
+    def _println(self, text):
+        if not self._closed:
+            os.write(self._master, (text + "\r\n").encode())
+
+    def _available(self, timeout=0.0):
+        if self._buf:
+            return True
+        try:
+            readable, _, _ = select.select([self._master], [], [], timeout)
+        except (OSError, ValueError):
+            return False
+        return bool(readable)
+
+    def _loop(self, fd):
+        while not self._closed:
+            try:
+                select.select([fd], [], [])
+                # flagged before the bytes leave the pty, wait_idle() always sees one or the other
+                self._handling = True
+                data = os.read(fd, 4096)
+            except (OSError, ValueError):
+                self._handling = False
+                return
+            if not data or fd != self._master:
+                self._handling = False
+                return
+            self._buf += data
+            while b"\n" in self._buf:
+                line, self._buf = self._buf.split(b"\n", 1)
+                command = line.decode(errors="replace")
+                # cleared by every line, also the bare newline of an interrupt
+                reported, self._pos_reported = self._pos_reported, False
+                if command:
+                    self.lines.append(command)
+                    self.execute(command, reported)
+            self._handling = False
+
+    def _write_state(self, state, run=None, deadline=None):
+        self.state = state
+        if run is not None:
+            now = time.perf_counter()
+            run.writes.append((now if deadline is None else deadline, now, state))
+
+    # =========================================================================
+    # FIRMWARE
+    # =========================================================================
+    def _free_slot(self, k):
+        if not self.slot_used[k]:
+            return
+        self.paused = None
+        start, n = self.slot_start[k], self.slot_len[k]
+        del self.code[start:start + n]
+        for j in range(self.n_slots):
+            if self.slot_used[j] and self.slot_start[j] > start:
+                self.slot_start[j] -= n
+        self.slot_used[k] = False
+        self.slot_len[k] = 0
+
+    def _open_slot(self, k):
+        self._free_slot(k)
+        self.slot_used[k] = True
+        self.slot_start[k] = len(self.code)
+        self.slot_len[k] = 0
+        self.slot_tick[k] = DEFAULT_TICK_US
+        self.slot_packed[k] = False
+
+    def _slot_arg(self, text):
+        k = parse_uint32(text)
+        return k if k is not None and k < self.n_slots else None
+
+    def program(self, k):
+        """Steps with a duration stored in slot k, [(state, ticks), ...]."""
+        if not self.slot_used[k]:
+            return []
+        data = bytes(self.code[self.slot_start[k]:self.slot_start[k] + self.slot_len[k]])
+        n = self.chain_bytes
+        if not self.slot_packed[k]:
+            steps = []
+            for pos in range(0, len(data) - self.step_bytes + 1, self.step_bytes):
+                delay = struct.unpack_from("<H", data, pos + n)[0]
+                if delay > 0:
+                    steps.append((int.from_bytes(data[pos:pos + n], "little"), delay))
+            return steps
+        # same walk as decode_packed() in the firmware
+        steps, state, dur, pos = [], 0, 0, 0
+        while pos < len(data):
+            bank = 0
+            while True:
+                b = data[pos]
+                pos += 1
+                if b & 0x40:
+                    if b & 0x02:
+                        bank = (b >> 2) & 0x07
+                        if pos >= len(data):
+                            break
+                        continue
+                    if b & 0x01:
+                        state = int.from_bytes(data[pos:pos + n], "little")
+                        pos += n
+                    break
+                ch = bank << 5 | b & 0x1F
+                if ch < self.width:
+                    state ^= 1 << ch
+                if b & 0x80 or pos >= len(data):
+                    break
+            if not b & 0x20:
+                dur, shift = 0, 0
+                while pos < len(data):
+                    c = data[pos]
+                    pos += 1
+                    dur |= (c & 0x7F) << shift
+                    shift += 7
+                    if not c & 0x80:
+                        break
+            if dur > 0:
+                steps.append((state, dur))
+        return steps
+
+    def _slot_open_for_append(self):
+        return self.slot_start[self.cur_slot] + self.slot_len[self.cur_slot] == len(self.code)
+
+    def execute(self, command, reported=False):
+        """
+        Handle one command line, as execute_command() in the firmware.
+        reported: the exec interrupted by this line has already printed its position.
+        """
+        cmd, sep, arg = command.partition(":")
+        has_arg = bool(sep)
+        k = self._slot_arg(arg) if has_arg else None
+        if has_arg and cmd == "setstate" and parse_state(arg, self.width) is not None:
+            self._write_state(parse_state(arg, self.width))
+        elif not has_arg and cmd == "clearcode":
+            self._open_slot(self.cur_slot)
+        elif has_arg and cmd == "addcode":
+            state_text, _, delay_text = arg.partition("/")
+            if not self.slot_used[self.cur_slot]:
+                self._open_slot(self.cur_slot)
+            if not self._slot_open_for_append():
+                self._println("add code failed, slot is closed, send clearcode")
+            elif self.slot_packed[self.cur_slot]:
+                self._println("add code failed, slot is packed, use addbytes")
+            elif parse_state(state_text, self.width) is not None and parse_uint32(delay_text) is not None:
+                if len(self.code) + self.step_bytes <= self.capacity:
+                    self.code += parse_state(state_text, self.width).to_bytes(self.chain_bytes, "little")
+                    self.code += struct.pack("<H", parse_uint32(delay_text) & 0xFFFF)
+                    self.slot_len[self.cur_slot] += self.step_bytes
+                else:
+                    self._println("add code failed, memory overflow")
+        elif not has_arg and cmd == "packed":
+            if not self.slot_used[self.cur_slot]:
+                self._open_slot(self.cur_slot)
+            if self.slot_len[self.cur_slot] == 0:
+                self.slot_packed[self.cur_slot] = True
+            else:
+                self._println("packed failed, slot is not empty")
+        elif has_arg and cmd == "addbytes":
+            valid = len(arg) % 2 == 0 and all(c in "0123456789abcdef" for c in arg)
+            if not self.slot_used[self.cur_slot] or not self.slot_packed[self.cur_slot]:
+                self._println("add bytes failed, slot is not packed, send packed")
+            elif not self._slot_open_for_append():
+                self._println("add bytes failed, slot is closed, send clearcode")
+            elif not valid:
+                self._println("add bytes failed, bad hex")
+            elif len(self.code) + len(arg) // 2 > self.capacity:
+                self._println("add bytes failed, memory overflow")
+            else:
+                self.code += bytes.fromhex(arg)
+                self.slot_len[self.cur_slot] += len(arg) // 2
+        elif not has_arg and cmd == "printcode":
+            self._println("current code : ")
+            for state, delay in self.program(self.cur_slot):
+                self._println(f"state:0x{state:X} delay:{delay}")
+        elif not has_arg and cmd == "version":
+            self._println(self.banner)
+        elif not has_arg and cmd == "width":
+            self._println(f"width:{self.width}")
+        elif not has_arg and cmd == "time":
+            self._println(f"time:{self.micros()}")
+        elif has_arg and cmd == "select" and k is not None:
+            self.cur_slot = k
+        elif has_arg and cmd == "free" and k is not None:
+            self._free_slot(k)
+        elif not has_arg and cmd == "clearall":
+            for j in range(self.n_slots):
+                self._free_slot(j)
+        elif not has_arg and cmd == "slots":
+            used = "".join(f" {j}:{self.slot_len[j]}" for j in range(self.n_slots) if self.slot_used[j])
+            self._println(f"slots:{len(self.code)}/{self.capacity}{used}")
+        elif has_arg and cmd == "tick" and parse_uint32(arg) is not None:
+            if self.tick_min_us <= parse_uint32(arg) <= TICK_MAX_US:
+                self.slot_tick[self.cur_slot] = parse_uint32(arg)
+            else:
+                self._println("tick failed, out of range")
+        elif not has_arg and cmd == "tick":
+            self._println(f"tick:{self.slot_tick[self.cur_slot]}")
+        elif not has_arg and cmd == "pause":
+            if not reported:
+                self._println(self._position())
+        elif not has_arg and cmd == "resume":
+            if self.paused is None:
+                self._println("resume failed, nothing paused")
+            else:
+                k, step, left = self.paused
+                self._exec_slot(k, step, left, "resume")
+        elif not has_arg and cmd == "status":
+            k = self.cur_slot
+            data = self.code[self.slot_start[k]:self.slot_start[k] + self.slot_len[k]] if self.slot_used[k] else b""
+            s1 = s2 = 0
+            for b in data:
+                s1 = (s1 + b) % 255
+                s2 = (s2 + s1) % 255
+            self._println(f"status:{k}:{len(data)}:{self.slot_tick[k]}:{int(self.slot_packed[k])}:{s2 << 8 | s1}")
+        elif not has_arg and cmd == "bench":
+            self._bench_slot(self.cur_slot)
+        elif has_arg and cmd == "bench" and k is not None:
+            self._bench_slot(k)
+        elif not has_arg and cmd == "exec":
+            self._exec_slot(self.cur_slot)
+        elif has_arg and cmd == "exec" and k is not None:
+            self.cur_slot = k
+            self._exec_slot(k)
+
+    def _wait_until(self, deadline):
+        """Wait for a deadline (perf_counter), True if a byte arrived first."""
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return False
+            if self._available(max(remaining - SPIN_S, 0.0)):
+                return True
+
+    def _bench_slot(self, k):
+        # host decode time, not the board's
+        t0 = time.perf_counter()
+        n = len(self.program(k))
+        self._println(f"bench:{n}/{int((time.perf_counter() - t0) * 1e6)}")
+
+    def _exec_slot(self, k, start=0, left=None, event="exec"):
+        """Run slot k from step `start` with `left` ticks left in it (default: the whole step)."""
+        self.paused = None
+        program = self.program(k)[start:]
+        if program and left is not None:
+            program[0] = (program[0][0], left)
+        run = Run(k, self.slot_tick[k], program)
+        self.runs.append(run)
+        try:
+            if run.program:
+                tick_s = run.tick_us / 1e6 / self.speed
+                t0 = time.perf_counter()
+                self._write_state(run.program[0][0], run, t0)
+                self._println(f"evt:{event}:{self.micros()}")
+                ticks = 0
+                for i, (state, delay) in enumerate(run.program):
+                    if i > 0:
+                        self._write_state(state, run, t0 + ticks * tick_s)
+                    ticks += delay
+                    if self._wait_until(t0 + ticks * tick_s):
+                        self._write_state(0, run)
+                        self._println("Execution Interrupted!")
+                        self._println(f"evt:interrupt:{self.micros()}")
+                        run.interrupted = True
+                        # ticks of this step whose interrupt has not fired yet, as sched_left
+                        elapsed = int((time.perf_counter() - t0) / tick_s)
+                        self.paused = (k, start + i, min(delay, max(1, ticks - elapsed)))
+                        self._println(self._position())
+                        self._pos_reported = True
+                        break
+            if not run.interrupted:
+                self._write_state(0, run, t0 + ticks * tick_s if run.program else None)
+                self._println(f"evt:done:{self.micros()}")
+        finally:
+            run.finished.set()
+
+    def _position(self):
+        if self.paused is None:
+            return "paused:none"
+        return "paused:{}:{}:{}".format(*self.paused)
@@ -0,0 +1,64 @@
+'''
+Controller against the serial emulator (emulator.py), run with pytest.
+Needs a POSIX system (pty).
+'''
+
+import time
+import pytest
+
+pty = pytest.importorskip("pty")
+
+from emulator import Emulator
+from controller import Controller
+
+
+@pytest.fixture
+def board():
+    with Emulator() as emu:
+        controller = Controller(emu.port)
+        controller.connect(reset=False)
+        try:
+            yield controller, emu
+        finally:
+            controller.disconnect()
+
+
+def _exec_started(controller, seq):
+    waiter = controller.expect("evt:exec:")
+    controller.upload_sequence(seq, delay=0)
+    controller.exec()
+    assert controller.wait_line(waiter, 2.0) is not None
+
+
+def test_pause_after_stop_reports_the_position(board):
+    controller, emu = board
+    _exec_started(controller, [(0x1, 2000), (0x2, 2000)])
+    assert controller.stop() is not None
+    # the bare newline of stop() does not leave "pause" quiet
+    position = controller.pause(timeout=0.5)
+    assert position is not None and position["slot"] == 0 and position["step"] == 0
+
+
+def test_pause_during_exec_reports_the_position_once(board):
+    controller, emu = board
+    positions = []
+    controller.add_listener(lambda line, t: positions.append(line) if line.startswith("paused:") else None)
+    _exec_started(controller, [(0x1, 2000), (0x2, 2000)])
+    assert controller.pause(timeout=1.0) is not None
+    emu.wait_idle()
+    time.sleep(0.1)
+    assert len(positions) == 1
+
+
+def test_trial_runner_uploads_after_the_device_is_done(board):
+    from trial_runner import TrialRunner
+    controller, emu = board
+    trials = [[(0x1, 150), (0x2, 150), (0, 1)], [(0x4, 100), (0, 1)], [(0x8, 120), (0, 1)]]
+    runner = TrialRunner(controller, trials, delay=0)
+    runner.start()
+    for i in range(len(trials)):
+        runner.run_trial(i, timeout=5.0)
+    runner._wait_done(len(trials) - 1)
+    runner.close()
+    assert len(emu.runs) == len(trials)
+    assert not any(run.interrupted for run in emu.runs)
@@ -0,0 +1,403 @@
+'''
+Vectorized bit-mask engine (NumPy).
+
+Converts between boolean channel matrices and packed masks, counts bits,
+answers bit-membership queries and compiles a time x channel matrix into the
+run-length (mask, dur) sequence sent to Arduino, without building Channel
+objects per cell.
+
+    matrix[t, c] = state of column c at time step t
+    channel_ids[c] = bit (channel id) driven by column c
+
+Mask arrays hold one mask per row in mask_dtype(width): uint32 up to 32
+channels, uint64 up to 64, and the raw little-endian bytes of the register
+chain (a NumPy void type, byte j = channels 8j..8j+7) beyond that. Rows of
+every type compare with == / !=, to_ints() gives the plain ints of a
+(mask, dur) sequence.
+
+Long matrices can be compiled as a stream of row blocks (compile_blocks,
+compile_csv_vertical), memory then stays bounded by the block size.
+'''
+
+import csv
+from itertools import combinations, islice, chain
+import numpy as np
+
+
+WIDTH = 32          # channels of the default register chain (4 shift registers)
+MAX_WIDTH = 128     # widest chain the firmware is built for (chain_bytes 16)
+# number of set bits for every byte value
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def ids_to_mask(ids):
+    """Combined mask for a list of channel ids (plain int)."""
+    m = 0
+    for n in ids:
+        m |= (1 << n)
+    return m
+
+
+def chain_bytes(width=WIDTH):
+    """Bytes of one state of a width-channel register chain."""
+    return (width + 7) // 8
+
+
+def mask_dtype(width=WIDTH):
+    """NumPy dtype of one mask of width channels."""
+    if width <= 32:
+        return np.dtype("<u4")
+    if width <= 64:
+        return np.dtype("<u8")
+    return np.dtype((np.void, chain_bytes(width)))
+
+
+def width_for(channel_ids, width=WIDTH):
+    """Smallest chain width (whole bytes, at least `width`) that holds every channel id."""
+    top = max(channel_ids, default=-1)
+    return max(width, 8 * chain_bytes(int(top) + 1))
+
+
+def _mask_bytes(masks, width=None):
+    # (n, k) uint8 array of masks (mask array, ints or int array), byte j = channels 8j..8j+7;
+    # k covers width, or the dtype / the largest int if width is None
+    if isinstance(masks, (np.ndarray, np.generic)):
+        arr = np.atleast_1d(masks)
+    else:
+        # plain ints may not fit any NumPy integer
+        arr = np.atleast_1d(np.array(masks, dtype=object))
+    if arr.dtype.kind == "V":
+        out = np.ascontiguousarray(arr).view(np.uint8).reshape(arr.size, -1)
+    elif arr.dtype.kind not in "ui" or (arr.dtype.kind == "i" and arr.size and arr.min() < 0):
+        ints = [int(m) for m in arr.reshape(-1).tolist()]
+        if any(m < 0 for m in ints):
+            raise ValueError("Masks must not be negative")
+        n = chain_bytes(max([width or WIDTH] + [m.bit_length() for m in ints]))
+        out = np.frombuffer(b"".join(m.to_bytes(n, "little") for m in ints), dtype=np.uint8).reshape(len(ints), n)
+    else:
+        item = "<u4" if arr.dtype.itemsize <= 4 else "<u8"
+        out = np.ascontiguousarray(arr.reshape(-1), dtype=item).view(np.uint8).reshape(arr.size, -1)
+    if width is not None:
+        n = chain_bytes(width)
+        if out.shape[1] < n:
+            out = np.hstack([out, np.zeros((out.shape[0], n - out.shape[1]), dtype=np.uint8)])
+        out = out[:, :n]
+    return out
+
+
+def to_array(masks, width=WIDTH):
+    """Masks (ints or any mask array) as a mask_dtype(width) array."""
+    dtype = mask_dtype(width)
+    raw = np.ascontiguousarray(_mask_bytes(masks, 8 * dtype.itemsize))
+    return raw.view(dtype).reshape(-1)
+
+
+def to_ints(masks):
+    """Plain Python ints of a mask array."""
+    if masks.dtype.kind == "V":
+        return [int.from_bytes(m, "little") for m in masks.tolist()]
+    return masks.tolist()
+
+
+def _bit_columns(matrix, channel_ids, width=WIDTH):
+    # (n, width) bool matrix indexed by bit, columns driving the same bit are OR-ed
+    matrix = np.asarray(matrix, dtype=bool)
+    if matrix.ndim == 1:
+        matrix = matrix[None, :]
+    ids = np.asarray(channel_ids if channel_ids is not None else range(matrix.shape[1]), dtype=np.int64)
+    if ids.size and (ids.min() < 0 or ids.max() >= width):
+        raise ValueError(f"Channel ids must be in 0..{width - 1}")
+    bits = np.zeros((matrix.shape[0], width), dtype=bool)
+    if np.unique(ids).size == ids.size:
+        bits[:, ids] = matrix
+    else:
+        for b in np.unique(ids):
+            bits[:, b] = matrix[:, ids == b].any(axis=1)
+    return bits
+
+
+def pack(matrix, channel_ids=None, width=WIDTH):
+    """
+    Pack a (n_steps, n_columns) boolean matrix into n_steps masks of mask_dtype(width).
+    channel_ids defaults to 0..n_columns-1.
+    """
+    dtype = mask_dtype(width)
+    bits = _bit_columns(matrix, channel_ids, width)
+    packed = np.packbits(bits, axis=1, bitorder="little")
+    if packed.shape[1] < dtype.itemsize:
+        packed = np.hstack([packed, np.zeros((packed.shape[0], dtype.itemsize - packed.shape[1]), dtype=np.uint8)])
+    return np.ascontiguousarray(packed).view(dtype).reshape(-1)
+
+
+def unpack(masks, width=WIDTH):
+    """Unpack masks into a (n, width) boolean matrix, column b = bit b."""
+    bits = np.unpackbits(_mask_bytes(masks, width), axis=1, bitorder="little")
+    return bits[:, :width].astype(bool)
+
+
+def popcount(masks):
+    """Number of set bits per mask."""
+    return _POPCOUNT8[_mask_bytes(masks)].sum(axis=1, dtype=np.int64)
+
+
+def has_bit(masks, bit):
+    """Boolean array: is channel `bit` (or bit[i] for mask i) on in each mask."""
+    bit = np.asarray(bit)
+    raw = _mask_bytes(masks, int(bit.max()) + 1)
+    byte = raw[np.arange(len(raw)), bit // 8] if bit.ndim else raw[:, bit // 8]
+    return (byte >> (bit % 8)) & 1 == 1
+
+
+def has_any(masks, ids):
+    """Boolean array: is any of the channel ids on in each mask."""
+    raw, m = _id_bytes(masks, ids)
+    return (raw & m).any(axis=1)
+
+
+def has_all(masks, ids):
+    """Boolean array: are all of the channel ids on in each mask."""
+    raw, m = _id_bytes(masks, ids)
+    return ((raw & m) == m).all(axis=1)
+
+
+def _id_bytes(masks, ids):
+    # masks and the mask of ids as byte arrays of the same width
+    ids = list(ids)
+    raw = _mask_bytes(masks)
+    width = max(8 * raw.shape[1], width_for(ids))
+    return _mask_bytes(masks, width), _mask_bytes([ids_to_mask(ids)], width)[0]
+
+
+def combination_masks(n, k, chunk=1 << 16):
+    """
+    Enumerate all k-of-n channel combinations in lexicographic order.
+    Yields (combos, masks) per chunk: combos is (m, k) int16, masks is (m,)
+    of mask_dtype(n), so memory stays bounded by the chunk size.
+    """
+    it = combinations(range(n), k)
+    dtype = mask_dtype(max(n, WIDTH))
+    while True:
+        flat = np.fromiter(chain.from_iterable(islice(it, chunk)), dtype=np.int16)
+        if flat.size == 0:
+            return
+        combos = flat.reshape(-1, k)
+        if dtype.kind == "u":
+            weights = np.left_shift(dtype.type(1), combos.astype(dtype))
+            yield combos, np.bitwise_or.reduce(weights, axis=1)
+        else:
+            bits = np.zeros((len(combos), n), dtype=bool)
+            bits[np.arange(len(combos))[:, None], combos] = True
+            yield combos, pack(bits, None, n)
+
+
+# =============================================================================
+# COMPILATION
+# =============================================================================
+def compile_matrix(matrix, channel_ids, col_ms=100):
+    """
+    Compile a (n_steps, n_columns) 0/1 matrix into the (mask, dur) sequence.
+
+    Gives the same result as building the Stimulus from the matrix and calling
+    generate_timed_sequence(): a step starts wherever a column switches, a
+    trailing all-off run is dropped and (0, 0) is appended. When several
+    columns drive the same channel, an ON switch wins over an OFF switch at
+    the same time and otherwise the latest switch decides.
+    """
+    matrix = np.asarray(matrix, dtype=bool)
+    n_steps = matrix.shape[0]
+    if n_steps == 0 or not matrix.any():
+        return [(0, 0)]
+    prev = np.vstack([np.zeros((1, matrix.shape[1]), dtype=bool), matrix[:-1]])
+    switched = matrix != prev
+    bounds = np.flatnonzero(switched.any(axis=1))
+    ids = list(channel_ids)
+    width = width_for(ids)
+    if len(set(ids)) == len(ids):
+        step_masks = to_ints(pack(matrix[bounds], ids, width))
+    else:
+        on = to_ints(pack(matrix[bounds] & ~prev[bounds], ids, width))
+        off = to_ints(pack(prev[bounds] & ~matrix[bounds], ids, width))
+        step_masks, state = [], 0
+        for m_on, m_off in zip(on, off):
+            state = (state & ~m_off) | m_on
+            step_masks.append(state)
+    starts = bounds.tolist()
+    if bounds[0] != 0:
+        # all channels off until the first switch
+        starts.insert(0, 0)
+        step_masks.insert(0, 0)
+    # the last step lasts until the end only if something is still on
+    if matrix[-1].any():
+        starts.append(n_steps)
+    else:
+        step_masks.pop()
+    times = [i * col_ms for i in starts]
+    seq = [(m, t1 - t0) for m, t0, t1 in zip(step_masks, times, times[1:])]
+    seq.append((0, 0))
+    return seq
+
+
+def compile_blocks(blocks, channel_ids, col_ms=100):
+    """
+    Streaming compile_matrix(): blocks is an iterable of (k, n_columns) 0/1
+    row blocks, consecutive in time. Yields the same (mask, dur) steps as
+    compile_matrix() on the stacked matrix, each as soon as it is complete.
+    Only the last row and the current run are kept between blocks.
+    """
+    ids = list(channel_ids)
+    width = width_for(ids)
+    unique = len(set(ids)) == len(ids)
+    prev = np.zeros(len(ids), dtype=bool)
+    state = 0                   # recurrence state for duplicate ids
+    run_mask, run_start = 0, 0  # current step, all channels off until the first switch
+    n = 0
+    for block in blocks:
+        block = np.asarray(block, dtype=bool)
+        if not len(block):
+            continue
+        prevs = np.vstack([prev[None, :], block[:-1]])
+        bounds = np.flatnonzero((block != prevs).any(axis=1))
+        if bounds.size:
+            if unique:
+                step_masks = to_ints(pack(block[bounds], ids, width))
+            else:
+                on = to_ints(pack(block[bounds] & ~prevs[bounds], ids, width))
+                off = to_ints(pack(prevs[bounds] & ~block[bounds], ids, width))
+                step_masks = []
+                for m_on, m_off in zip(on, off):
+                    state = (state & ~m_off) | m_on
+                    step_masks.append(state)
+            for r, m in zip((bounds + n).tolist(), step_masks):
+                if r > run_start:
+                    yield (run_mask, r * col_ms - run_start * col_ms)
+                run_mask, run_start = m, r
+        prev = block[-1]
+        n += len(block)
+    # the last step lasts until the end only if something is still on
+    if prev.any():
+        yield (run_mask, n * col_ms - run_start * col_ms)
+    yield (0, 0)
+
+
+# bytes allowed between the cells of a plain 0/1 block
+_SEPARATORS = np.frombuffer(b",\t \r\n", dtype=np.uint8)
+
+
+def _parse_01_block(buf, n_columns):
+    # fast path for plain single-digit 0/1 cells: returns (k, n_columns) bool, or None if the block needs the csv module
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    digit = (arr == 48) | (arr == 49)
+    if not np.isin(arr[~digit], _SEPARATORS).all() or (digit[1:] & digit[:-1]).any():
+        return None
+    newline = arr == 10
+    line = np.cumsum(newline) - newline
+    counts = np.bincount(line[digit], minlength=int(line[-1]) + 1 if arr.size else 0)
+    counts = counts[counts > 0]
+    if (counts != n_columns).any():
+        # ragged, the csv path reports the row
+        return None
+    return (arr[digit] == 49).reshape(-1, n_columns)
+
+
+def compile_packed(packed, col_ms=100, chunk=1 << 20):
+    """
+    Compile one mask per time step (bit b = channel b) into the (mask, dur)
+    sequence, reading `packed` (mask array or np.memmap of any mask_dtype)
+    chunk by chunk. Same result as compile_matrix() on the unpacked matrix
+    with channel ids 0..width-1.
+    """
+    dtype = packed.dtype if isinstance(packed, np.ndarray) and packed.dtype.kind in "uV" else np.dtype(np.uint32)
+    prev = np.zeros(1, dtype=dtype)
+    run_mask, run_start = 0, 0
+    n = len(packed)
+    for start in range(0, n, chunk):
+        block = np.asarray(packed[start:start + chunk], dtype=dtype)
+        prevs = np.concatenate([prev, block[:-1]])
+        bounds = np.flatnonzero(block != prevs)
+        for r, m in zip((bounds + start).tolist(), to_ints(block[bounds])):
+            if r > run_start:
+                yield (run_mask, r * col_ms - run_start * col_ms)
+            run_mask, run_start = m, r
+        prev = block[-1:]
+    if _mask_bytes(prev).any():
+        yield (run_mask, n * col_ms - run_start * col_ms)
+    yield (0, 0)
+
+
+def iter_csv_vertical(csv_path, chunk_rows=4096):
+    """
+    Read a vertical CSV matrix (first row = channel ids, one row per time step)
+    lazily. Returns (channel_ids, blocks) where blocks yields (<= chunk_rows, n_channels)
+    bool arrays; the file stays open until blocks is exhausted.
+
+    Blocks of plain 0/1 cells are parsed with NumPy directly from the bytes,
+    anything else (quotes, other values) goes through the csv module.
+    """
+    f = open(csv_path, "rb")
+    header = None
+    for raw in f:
+        delimiter = '\t' if b'\t' in raw else ','
+        header = [x.strip() for x in raw.decode("utf-8").split(delimiter) if x.strip() != '']
+        if header:
+            break
+    if not header:
+        f.close()
+        return [], iter(())
+    ids = [int(x) for x in header]
+
+    def blocks():
+        try:
+            i = 0
+            while True:
+                lines = list(islice(f, chunk_rows))
+                if not lines:
+                    return
+                block = _parse_01_block(b"".join(lines), len(ids))
+                if block is None:
+                    rows = csv.reader((line.decode("utf-8") for line in lines), delimiter=delimiter)
+                    rows = [r for r in ([x.strip() for x in row if x.strip() != ''] for row in rows) if r]
+                    for j, row in enumerate(rows):
+                        if len(row) != len(ids):
+                            raise ValueError(f"{csv_path}: row {i + j + 1} has {len(row)} values, expected a rectangular matrix")
+                    block = np.array(rows, dtype=np.int64).reshape(-1, len(ids)) == 1
+                i += len(block)
+                yield block
+        finally:
+            f.close()
+
+    return ids, blocks()
+
+
+def compile_csv_vertical(csv_path, col_ms=100, chunk_rows=4096):
+    """Yield the (mask, dur) steps of a vertical CSV matrix without loading it, see compile_blocks()."""
+    ids, blocks = iter_csv_vertical(csv_path, chunk_rows)
+    return compile_blocks(blocks, ids, col_ms)
+
+
+def read_csv_matrix(csv_path, vertical=False):
+    """
+    Read a CSV stimulus matrix (comma or tab separated) into (channel_ids, matrix).
+
+    - horizontal (default): each row = channel id followed by its 0/1 states
+    - vertical: first row = channel ids, each following row = one time step
+    matrix is (n_steps, n_channels) bool in both cases.
+    """
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        first_line = f.readline()
+        delimiter = '\t' if '\t' in first_line else ','
+        f.seek(0)
+        rows = [[x.strip() for x in row if x.strip() != ''] for row in csv.reader(f, delimiter=delimiter)]
+    rows = [row for row in rows if row]
+    if not rows:
+        return [], np.zeros((0, 0), dtype=bool)
+    width = len(rows[0]) if vertical else len(rows[0]) - 1
+    for i, row in enumerate(rows[1:] if vertical else rows):
+        if len(row) != (width if vertical else width + 1):
+            raise ValueError(f"{csv_path}: row {i + 1 if vertical else i} has {len(row)} values, expected a rectangular matrix")
+    if vertical:
+        ids = [int(x) for x in rows[0]]
+        matrix = np.array(rows[1:], dtype=np.int64).reshape(-1, len(ids)) == 1
+    else:
+        ids = [int(row[0]) for row in rows]
+        matrix = (np.array([row[1:] for row in rows], dtype=np.int64) == 1).T
+    return ids, matrix
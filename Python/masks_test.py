@@ -1,36 +1,154 @@
 '''
-Test script to generate a CSV file validating mask generation for all unique
-3-channel combinations from channels 0 to 31.
+Mask engine tests (run with pytest) and validation tool for mask generation.
+
+Streams every k-of-n channel combination, checks the vectorized masks against
+popcount / bit-membership and against Controller.Channel.mask on a sample,
+and writes combination + expected mask (binary + hex) to a CSV, gzip
+compressed when the file name ends with .gz. Memory use is bounded by the
+chunk size, so millions of rows are fine.
+
+    python masks_test.py                       # 3-of-32, like before
+    python masks_test.py -k 5 -o masks_5of32.csv.gz
+    python masks_test.py -n 128 -k 2            # wide register chain
 '''
 
-import csv
-from itertools import combinations
+import argparse
+import gzip
+import math
+import time
+import numpy as np
+import pytest
+import masks
 from controller import Controller
 
-def run_full_mask_test_csv(csv_path="mask_validation_log.csv"):
+HEX_DIGITS = np.frombuffer(b"0123456789ABCDEF", dtype=np.uint8)
+
+
+def _format_chunk(combos, mask_arr, width):
+    # binary: most significant bit first, as format(mask, "032b")
+    unpacked = masks.unpack(mask_arr, width)
+    bits = unpacked[:, ::-1].astype(np.uint8) + ord("0")
+    binary = np.ascontiguousarray(bits).view(f"S{width}").reshape(-1)
+    n_hex = (width + 3) // 4
+    # nibbles from the unpacked bits, so masks of any width work
+    padded = np.zeros((len(unpacked), 4 * n_hex), dtype=np.uint8)
+    padded[:, :width] = unpacked
+    nibbles = padded.reshape(-1, n_hex, 4) @ np.array([1, 2, 4, 8], dtype=np.uint8)
+    digits = HEX_DIGITS[nibbles[:, ::-1]]
+    hexes = np.ascontiguousarray(digits).view(f"S{n_hex}").reshape(-1)
+    lines = []
+    for combo, b, h in zip(combos.tolist(), binary.tolist(), hexes.tolist()):
+        lines.append(",".join(map(str, combo)) + f",{b.decode()},0x{h.decode()}\n")
+    return "".join(lines)
+
+
+def run_full_mask_test_csv(csv_path="mask_validation_log.csv", n=32, k=3, chunk=1 << 16, sample=1000):
     """
-    Generate all unique 3-channel combinations from 0–31.
-    Write each combination and its expected mask (binary + hex) to a CSV.
+    Generate all unique k-channel combinations from 0..n-1.
+    Validate each mask and write combination and expected mask (binary + hex) to a CSV.
     """
+    t0 = time.perf_counter()
     total = 0
-    with open(csv_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(["ch1", "ch2", "ch3", "mask_binary", "mask_hex"])
-
-        for combo in combinations(range(32), 3):
-            ch = Controller.Channel(ids=list(combo), hold_time_ms=100)
-            mask = ch.mask
-            writer.writerow([
-                combo[0],
-                combo[1],
-                combo[2],
-                format(mask, "032b"),
-                f"0x{mask:08X}",
-            ])
-            total += 1
-
-    print(f"Mask validation complete. {total} combinations saved to {csv_path}")
+    errors = 0
+    rng = np.random.default_rng(0)
+    if csv_path.endswith(".gz"):
+        # level 1: the csv is highly repetitive, higher levels cost far more time than they save space
+        f = gzip.open(csv_path, "wt", newline="", encoding="utf-8", compresslevel=1)
+    else:
+        f = open(csv_path, "w", newline="", encoding="utf-8")
+    with f:
+        f.write(",".join(f"ch{i + 1}" for i in range(k)) + ",mask_binary,mask_hex\n")
+        for combos, mask_arr in masks.combination_masks(n, k, chunk=chunk):
+            # every mask has exactly k bits, all of them from its combination
+            ok = masks.popcount(mask_arr) == k
+            for j in range(k):
+                ok &= masks.has_bit(mask_arr, combos[:, j])
+            # cross-check against the Channel class on a random sample
+            for i in rng.choice(len(combos), size=min(sample, len(combos)), replace=False):
+                ok[i] &= Controller.Channel(ids=combos[i].tolist(), hold_time_ms=100).mask == masks.to_ints(mask_arr[i:i + 1])[0]
+            errors += int((~ok).sum())
+            f.write(_format_chunk(combos, mask_arr, masks.width_for(range(n))))
+            total += len(combos)
+
+    dt = time.perf_counter() - t0
+    print(f"Mask validation complete. {total} combinations saved to {csv_path} ({dt:.1f} s), {errors} errors")
+    return errors
+
+
+# =============================================================================
+# TESTS
+# =============================================================================
+@pytest.mark.parametrize("n, k", [(32, 3), (64, 2), (128, 2)])
+def test_combination_masks_match_channel_mask(tmp_path, n, k):
+    path = tmp_path / "masks.csv.gz"
+    assert run_full_mask_test_csv(str(path), n=n, k=k, chunk=1000, sample=50) == 0
+    with gzip.open(path, "rt") as f:
+        rows = f.read().splitlines()
+    assert len(rows) == 1 + math.comb(n, k)
+    combo = [int(x) for x in rows[1].split(",")[:k]]
+    assert int(rows[1].rsplit(",", 1)[1], 16) == Controller.Channel(ids=combo).mask
+
+
+@pytest.mark.parametrize("width", [32, 64, 128])
+def test_pack_roundtrip_and_queries(width):
+    rng = np.random.default_rng(width)
+    bits = rng.random((200, width)) < 0.1
+    arr = masks.pack(bits, None, width)
+    ints = masks.to_ints(arr)
+    assert ints == [Controller.Channel(ids=np.flatnonzero(row).tolist()).mask for row in bits]
+    assert (masks.unpack(arr, width) == bits).all()
+    assert (masks.popcount(arr) == bits.sum(axis=1)).all()
+    ids = [0, width // 2, width - 1]
+    assert (masks.has_bit(arr, width - 1) == bits[:, width - 1]).all()
+    assert (masks.has_any(arr, ids) == bits[:, ids].any(axis=1)).all()
+    assert (masks.has_all(arr, ids) == bits[:, ids].all(axis=1)).all()
+
+
+def _write_horizontal(path, matrix, ids):
+    with open(path, "w") as f:
+        for ch, row in zip(ids, matrix.T.astype(int)):
+            f.write(",".join(map(str, [ch, *row])) + "\n")
+
+
+def _write_vertical(path, matrix, ids):
+    with open(path, "w") as f:
+        f.write(",".join(map(str, ids)) + "\n")
+        for row in matrix.astype(int):
+            f.write(",".join(map(str, row)) + "\n")
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_compile_matrix_matches_the_channel_path(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    n_cols = int(rng.integers(1, 12))
+    # duplicate ids in half of the cases
+    ids = rng.choice(40 if seed % 2 else n_cols, size=n_cols, replace=not seed % 2).tolist()
+    matrix = rng.random((int(rng.integers(1, 60)), n_cols)) < rng.uniform(0.1, 0.7)
+    col_ms = [100, 5, 2.5][seed % 3]
+    path = tmp_path / "stim.csv"
+    _write_horizontal(path, matrix, ids)
+    expected = Controller.Stimulus.from_csv_matrix(str(path), col_ms=col_ms).generate_timed_sequence()
+    assert masks.compile_matrix(matrix, ids, col_ms) == expected
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 7, 4096])
+def test_compile_csv_vertical_matches_compile_matrix(tmp_path, chunk_rows):
+    rng = np.random.default_rng(chunk_rows)
+    for _ in range(10):
+        n_cols = int(rng.integers(1, 10))
+        ids = rng.choice(64, size=n_cols, replace=False).tolist()
+        matrix = rng.random((int(rng.integers(1, 80)), n_cols)) < 0.3
+        path = tmp_path / "stim_vertical.csv"
+        _write_vertical(path, matrix, ids)
+        assert list(masks.compile_csv_vertical(str(path), 10, chunk_rows)) == masks.compile_matrix(matrix, ids, 10)
+
 
 if __name__ == "__main__":
-    run_full_mask_test_csv()
-    print("Done")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Validate masks for all k-of-n channel combinations")
+    parser.add_argument("-n", type=int, default=32, help="number of channels")
+    parser.add_argument("-k", type=int, default=3, help="channels per combination")
+    parser.add_argument("-o", "--out", default="mask_validation_log.csv", help="output csv (.gz to compress)")
+    parser.add_argument("--chunk", type=int, default=1 << 16, help="combinations per chunk")
+    args = parser.parse_args()
+    run_full_mask_test_csv(args.out, n=args.n, k=args.k, chunk=args.chunk)
+    print("Done")
@@ -0,0 +1,159 @@
+'''
+Binary stimulus matrix files.
+
+Text parsing dominates loading large CSV matrices. Two binary formats are
+memory-mapped instead and compiled block by block without reading the whole
+file:
+
+- .npy / .npz: boolean (or 0/1 uint8) matrix of shape (n_steps, n_channels),
+  the vertical layout. An .npz holds "matrix" and "channel_ids". It is only
+  memory-mapped when stored uncompressed (np.savez, not np.savez_compressed).
+  A plain .npy drives channels 0..n_channels-1 unless channel_ids are passed.
+- .u32: bit-packed, one little-endian uint32 per time step, bit b = channel b.
+  .u64 and .u128 hold 64 / 128 channels the same way (8 / 16 bytes per step).
+
+The converters write both from the CSV layouts. The compiled sequence is
+identical to the CSV path (Stimulus.from_csv_matrix*().generate_timed_sequence()).
+
+    matrix_io.csv_to_npz("stim_files/motion_stim.csv", "motion_stim.npz")
+    seq = matrix_io.compile_path("motion_stim.npz", col_ms=5)
+'''
+
+import os
+import zipfile
+import numpy as np
+import masks
+
+
+BLOCK_ROWS = 1 << 16
+# channels of the bit-packed formats
+PACKED_WIDTHS = {".u32": 32, ".u64": 64, ".u128": 128}
+
+
+# =============================================================================
+# LOADING
+# =============================================================================
+def _mmap_npz_member(path, name):
+    # np.load() reads .npz members into memory, an uncompressed member can be mapped in place
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(name + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        local = f.read(30)
+        # local file header: name and extra field lengths at bytes 26..29
+        f.seek(info.header_offset + 30 + int.from_bytes(local[26:28], "little") + int.from_bytes(local[28:30], "little"))
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran, dtype = read_header(f)
+        offset = f.tell()
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran else "C")
+
+
+def load_matrix(path, channel_ids=None):
+    """
+    Load a (n_steps, n_channels) matrix file as (channel_ids, matrix), memory-mapped where possible.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npy":
+        matrix = np.load(path, mmap_mode="r")
+        ids = channel_ids
+    elif ext == ".npz":
+        matrix = _mmap_npz_member(path, "matrix")
+        with np.load(path) as data:
+            if matrix is None:
+                matrix = data["matrix"]
+            ids = channel_ids if channel_ids is not None else (data["channel_ids"].tolist() if "channel_ids" in data else None)
+    else:
+        raise ValueError(f"{path}: unsupported matrix file, expected .npy or .npz")
+    if matrix.ndim != 2:
+        raise ValueError(f"{path}: expected a 2-D (n_steps, n_channels) matrix, got shape {matrix.shape}")
+    ids = list(range(matrix.shape[1])) if ids is None else list(ids)
+    if len(ids) != matrix.shape[1]:
+        raise ValueError(f"{path}: {len(ids)} channel ids for {matrix.shape[1]} columns")
+    return ids, matrix
+
+
+def load_packed(path):
+    """Memory-map a .u32 / .u64 / .u128 bit-packed file (one mask per time step, masks.mask_dtype)."""
+    dtype = masks.mask_dtype(PACKED_WIDTHS[os.path.splitext(path)[1].lower()])
+    if os.path.getsize(path) % dtype.itemsize:
+        raise ValueError(f"{path}: size is not a multiple of {dtype.itemsize} bytes")
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+def compile_path(path, col_ms=100, channel_ids=None):
+    """Compile a .csv (horizontal or vertical), .npy, .npz or bit-packed file into the (mask, dur) sequence."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in PACKED_WIDTHS:
+        return list(masks.compile_packed(load_packed(path), col_ms=col_ms))
+    if ext == ".csv":
+        from batch_compile import detect_layout
+        if detect_layout(path) == "vertical":
+            return list(masks.compile_csv_vertical(path, col_ms=col_ms))
+        ids, matrix = masks.read_csv_matrix(path)
+        return masks.compile_matrix(matrix, ids, col_ms=col_ms)
+    ids, matrix = load_matrix(path, channel_ids)
+    blocks = (matrix[i:i + BLOCK_ROWS] for i in range(0, matrix.shape[0], BLOCK_ROWS))
+    return list(masks.compile_blocks(blocks, ids, col_ms=col_ms))
+
+
+# =============================================================================
+# CONVERTERS
+# =============================================================================
+def csv_to_npz(csv_path, out_path, vertical=None):
+    """Convert a CSV matrix (layout detected if vertical is None) to an uncompressed .npz."""
+    if vertical is None:
+        from batch_compile import detect_layout
+        vertical = detect_layout(csv_path) == "vertical"
+    ids, matrix = masks.read_csv_matrix(csv_path, vertical=vertical)
+    np.savez(out_path, matrix=matrix, channel_ids=np.array(ids, dtype=np.int64))
+    return out_path if out_path.endswith(".npz") else out_path + ".npz"
+
+
+def csv_to_packed(csv_path, out_path, vertical=None):
+    """
+    Convert a CSV matrix to a bit-packed file, .u32, .u64 or .u128 after the
+    extension of out_path (.u32 if it has none of them). Needs unique channel ids:
+    with duplicates the compiled steps depend on the individual columns.
+    """
+    width = PACKED_WIDTHS.get(os.path.splitext(out_path)[1].lower(), masks.WIDTH)
+    if vertical is None:
+        from batch_compile import detect_layout
+        vertical = detect_layout(csv_path) == "vertical"
+    if vertical:
+        # streamed, long recordings are never loaded as a whole
+        ids, blocks = masks.iter_csv_vertical(csv_path, chunk_rows=BLOCK_ROWS)
+    else:
+        ids, matrix = masks.read_csv_matrix(csv_path)
+        blocks = (matrix[i:i + BLOCK_ROWS] for i in range(0, matrix.shape[0], BLOCK_ROWS))
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"{csv_path}: duplicate channel ids cannot be bit-packed, use csv_to_npz()")
+    if masks.width_for(ids) > width:
+        raise ValueError(f"{csv_path}: channel {max(ids)} does not fit {width} channels, use a wider format")
+    with open(out_path, "wb") as f:
+        for block in blocks:
+            f.write(masks.pack(block, ids, width).tobytes())
+    return out_path
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m matrix_io", description="Convert CSV stimulus matrices to binary files")
+    parser.add_argument("csv", nargs="+", help="CSV matrices")
+    parser.add_argument("--format", choices=("npz", "u32", "u64", "u128"), default="npz")
+    parser.add_argument("--layout", choices=("auto", "horizontal", "vertical"), default="auto")
+    args = parser.parse_args()
+    vertical = None if args.layout == "auto" else args.layout == "vertical"
+    for path in args.csv:
+        out = os.path.splitext(path)[0] + "." + args.format
+        if args.format == "npz":
+            csv_to_npz(path, out, vertical)
+        else:
+            csv_to_packed(path, out, vertical)
+        print(f"{path} -> {out}")
+    sys.exit(0)
@@ -0,0 +1,37 @@
+'''
+Binary matrix files against the CSV/Channel path, run with pytest.
+'''
+
+import numpy as np
+import pytest
+
+import matrix_io
+from controller import Controller
+
+
+def _random_csv(path, rng, n_cols, id_range, duplicates=False):
+    ids = rng.choice(id_range, size=n_cols, replace=duplicates).tolist()
+    matrix = rng.random((int(rng.integers(1, 120)), n_cols)) < 0.3
+    with open(path, "w") as f:
+        for ch, row in zip(ids, matrix.T.astype(int)):
+            f.write(",".join(map(str, [ch, *row])) + "\n")
+    return Controller.Stimulus.from_csv_matrix(str(path), col_ms=5).generate_timed_sequence()
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_npz_matches_the_csv_path(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    csv_path = tmp_path / "stim.csv"
+    expected = _random_csv(csv_path, rng, int(rng.integers(2, 10)), 12, duplicates=True)
+    npz = matrix_io.csv_to_npz(str(csv_path), str(tmp_path / "stim.npz"), vertical=False)
+    assert matrix_io.compile_path(npz, col_ms=5) == expected
+
+
+@pytest.mark.parametrize("ext, id_range", [(".u32", 32), (".u64", 64), (".u128", 128)])
+def test_packed_matches_the_csv_path(tmp_path, ext, id_range):
+    rng = np.random.default_rng(id_range)
+    for _ in range(5):
+        csv_path = tmp_path / "stim.csv"
+        expected = _random_csv(csv_path, rng, int(rng.integers(2, 10)), id_range)
+        packed = matrix_io.csv_to_packed(str(csv_path), str(tmp_path / ("stim" + ext)), vertical=False)
+        assert matrix_io.compile_path(packed, col_ms=5) == expected
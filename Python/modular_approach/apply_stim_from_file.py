@@ -8,8 +8,8 @@ Execution starts only after user confirmation.
 """
 
 arduino = ArduinoController("COM7", 115200)
+# waits for the ready banner of the board instead of a fixed sleep
 arduino.connect()
-time.sleep(2)
 
 # Load stimulation commands from file
 # arduino.send_file_line_by_line("sequential_stim.txt", delay=0.01)
@@ -13,10 +13,12 @@ class ArduinoController:
         self._running = False
 
     # --- Connection handling ---
-    def connect(self):
+    def connect(self, wait_ready=True, timeout=3.0):
         if self.ser and self.ser.is_open:
             self.ser.close()
         self.ser = serial.Serial(self.port, self.baud, timeout=1)
+        if wait_ready:
+            self._wait_ready(timeout)
         self._running = True
         self._start_print_thread()
         print(f"Connected {self.port} @ {self.baud} baud")
@@ -32,6 +34,17 @@ class ArduinoController:
         time.sleep(0.2)
         self.connect()
 
+    def _wait_ready(self, timeout):
+        # firmware prints "ready:<firmware>:<version>" from setup() after the auto-reset
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            line = self.ser.readline().decode(errors="ignore").strip()
+            if line.startswith("ready:"):
+                print("Arduino:", line)
+                return line
+        print(f"No ready banner from {self.port} within {timeout} s")
+        return None
+
     # --- Background serial monitor ---
     def _start_print_thread(self):
         if self._print_thread and self._print_thread.is_alive():
@@ -0,0 +1,240 @@
+'''
+Packed program encoding for the with_stop firmware (version 5).
+
+A plain step costs 6 bytes in the device buffer (uint32 state + uint16
+delay, chain bytes + 2 on a wider chain). In a packed program a step only
+stores the channels that switch against the previous state and its duration:
+
+    flip byte     bits 0-4 channel, bit 7 set on the last flip of the step
+    0x40          no flip (a step longer than 65535 ticks, continued)
+    0x41 + n      the whole state follows, n = chain bytes, LSB first (used
+                  when the flips would take more bytes)
+    0x42 | b << 2 bank: the following flips are channels 32 * b .. 32 * b + 31
+                  (version 8, chains wider than 32 channels; bank 0 at every step)
+    bit 5         on the last byte of the flips: same duration as the previous step
+    duration      LEB128 varint in ticks, only if bit 5 is not set
+
+so a step of a motion stimulus (one channel on, one off, same duration as the
+step before) takes 2 bytes instead of 6. Programs for 32 channels never
+contain a bank byte and are the same as for version 5. The firmware decodes
+the program step by step during exec. Upload with "clearcode", "packed" and "addbytes:<hex>"
+lines, or through the Controller:
+
+    controller.upload_sequence(seq, packed=True)
+    controller.load_slot("motion", seq, tick_us="auto", packed=True)
+
+    python -m packed_program stim_files/motion_stim.csv --col-ms 10 [--port COM7]
+'''
+
+import time
+
+from program_slots import capacity_bytes, step_bytes
+
+
+LAST = 0x80
+SPECIAL = 0x40
+SAME_DURATION = 0x20
+WHOLE_STATE = 0x01
+BANK = 0x02
+LINE_BYTES = 24         # bytes per addbytes line, the line stays below the 64-byte serial buffer
+
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return out
+
+
+def _flip_bytes(diff):
+    # flip bytes (without LAST) of the set bits of diff, ascending, with a bank byte where the bank changes
+    out, bank, base = bytearray(), 0, 0
+    while diff:
+        if diff & 0xFFFFFFFF:
+            low = diff & -diff
+            b = low.bit_length() - 1
+            if base // 32 != bank:
+                bank = base // 32
+                out.append(SPECIAL | BANK | bank << 2)
+            out.append(b)
+            diff ^= low
+        else:
+            diff >>= 32
+            base += 32
+    return out
+
+
+def encode_steps(seq, width=32):
+    """Encoded bytes of every step with dur > 0 of a (mask, dur) sequence, one bytes object per step."""
+    n_bytes = (width + 7) // 8
+    state, prev_dur = 0, None
+    for mask, dur in seq:
+        if dur <= 0:
+            continue
+        if dur != int(dur) or dur > 0xFFFFFFFF:
+            raise ValueError(f"Delay {dur} is not a whole number of ticks (use tick_us, timebase.py)")
+        dur = int(dur)
+        mask = int(mask)
+        if mask >> (8 * n_bytes):
+            raise ValueError(f"Mask 0x{mask:x} has channels beyond the {width}-channel chain")
+        same = SAME_DURATION if dur == prev_dur else 0
+        flips = _flip_bytes(state ^ mask)
+        if not flips:
+            out = bytearray([SPECIAL | same])
+        elif len(flips) > 1 + n_bytes:
+            out = bytearray([SPECIAL | WHOLE_STATE | same]) + mask.to_bytes(n_bytes, "little")
+        else:
+            flips[-1] |= LAST | same
+            out = flips
+        if not same:
+            out += _varint(dur)
+        state, prev_dur = mask, dur
+        yield bytes(out)
+
+
+def encode(seq, width=32):
+    """Packed program of a (mask, dur) sequence for a width-channel chain."""
+    return b"".join(encode_steps(seq, width))
+
+
+def decode(data, width=32):
+    """(mask, dur) sequence of a packed program, ending with (0, 0)."""
+    n_bytes = (width + 7) // 8
+    seq, state, dur, pos = [], 0, 0, 0
+    while pos < len(data):
+        bank = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            if b & SPECIAL:
+                if b & BANK:
+                    bank = (b >> 2) & 0x07
+                    if pos >= len(data):
+                        break
+                    continue
+                if b & WHOLE_STATE:
+                    state = int.from_bytes(data[pos:pos + n_bytes], "little")
+                    pos += n_bytes
+                break
+            state ^= 1 << (bank << 5 | b & 0x1F)
+            if b & LAST or pos >= len(data):
+                break
+        if not b & SAME_DURATION:
+            dur, shift = 0, 0
+            while pos < len(data):
+                c = data[pos]
+                pos += 1
+                dur |= (c & 0x7F) << shift
+                shift += 7
+                if not c & 0x80:
+                    break
+        if dur > 0:
+            seq.append((state, dur))
+    seq.append((0, 0))
+    return seq
+
+
+def upload_lines(data):
+    """addbytes:<hex> lines of a packed program."""
+    return [f"addbytes:{data[i:i + LINE_BYTES].hex()}" for i in range(0, len(data), LINE_BYTES)]
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+def steps_that_fit(sizes, capacity=capacity_bytes()):
+    """Number of leading steps whose sizes add up to at most capacity bytes."""
+    used = n = 0
+    for size in sizes:
+        used += size
+        if used > capacity:
+            break
+        n += 1
+    return n
+
+
+def benchmark(seq, controller=None, repeat=20, width=32):
+    """
+    Compare plain and packed storage of a (mask, dur) sequence.
+
+    Capacity is counted on the sequence repeated until the buffer is full, so
+    short stimuli are compared as well. With a connected controller (firmware 5)
+    both forms are uploaded to slot 0 and decoded on the device with "bench"
+    (programs loaded with load_slot() are cleared afterwards); the chain width
+    is then the board's.
+    Returns a dict.
+    """
+    if controller is not None:
+        width = controller.width
+    capacity, plain_step = capacity_bytes(width), step_bytes(width)
+    steps = [(m, d) for m, d in seq if d > 0]
+    sizes = [len(b) for b in encode_steps(steps, width)]
+    # every step takes at least one byte, so this many copies overfill the buffer
+    copies = capacity // max(1, len(steps)) + 1
+    long_sizes = [len(b) for b in encode_steps(steps * copies, width)]
+    result = {
+        "steps": len(steps),
+        "plain_bytes": plain_step * len(steps),
+        "packed_bytes": sum(sizes),
+        "plain_capacity_steps": capacity // plain_step,
+        "packed_capacity_steps": steps_that_fit(long_sizes, capacity),
+    }
+    data = encode(steps, width)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        decode(data, width)
+    result["host_decode_us_per_step"] = (time.perf_counter() - t0) / repeat / max(1, len(steps)) * 1e6
+    if controller is not None:
+        for name, packed in (("plain", False), ("packed", True)):
+            part = steps[:steps_that_fit(sizes, capacity)] if packed else steps[:capacity // plain_step]
+            controller.send("select:0")
+            controller.upload_sequence(part + [(0, 0)], delay=0.01, packed=packed)
+            waiter = controller.expect("bench:")
+            controller.send("bench")
+            reply = controller.wait_line(waiter, 5.0)
+            if reply is None:
+                raise TimeoutError("No bench: reply, is firmware version 5 loaded?")
+            n, us = (int(x) for x in reply[0].split(":", 1)[1].split("/"))
+            result[f"device_{name}_us_per_step"] = us / max(1, n)
+        controller.slots = None
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    import timebase
+    import matrix_io
+    parser = argparse.ArgumentParser(prog="python -m packed_program",
+                                     description="Capacity and decode time of plain vs packed programs")
+    parser.add_argument("files", nargs="+", help="stimulus matrices (.csv, .npy, .npz, .u32)")
+    parser.add_argument("--col-ms", type=float, default=10, help="duration of one matrix column")
+    parser.add_argument("--port", default=None, help="also decode on the board at this port")
+    parser.add_argument("--width", type=int, default=32, help="channels of the register chain (without --port)")
+    args = parser.parse_args()
+    controller = None
+    if args.port:
+        from controller import Controller
+        controller = Controller(args.port)
+        controller.connect()
+    try:
+        for path in args.files:
+            width = controller.width if controller is not None else args.width
+            tick_us, seq = timebase.to_ticks(matrix_io.compile_path(path, col_ms=args.col_ms), width=width)
+            r = benchmark(seq, controller, width=args.width)
+            print(f"{path}: tick {tick_us} us, {r['steps']} steps, {r['plain_bytes']} B plain, {r['packed_bytes']} B packed "
+                  f"({r['plain_bytes'] / max(1, r['packed_bytes']):.1f}x)")
+            print(f"  buffer capacity: {r['plain_capacity_steps']} plain steps, {r['packed_capacity_steps']} packed steps")
+            print(f"  host decode: {r['host_decode_us_per_step']:.2f} us/step")
+            if controller is not None:
+                print(f"  device decode: {r['device_plain_us_per_step']:.1f} us/step plain, "
+                      f"{r['device_packed_us_per_step']:.1f} us/step packed")
+    finally:
+        if controller is not None:
+            controller.disconnect()
+    sys.exit(0)
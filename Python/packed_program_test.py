@@ -0,0 +1,56 @@
+'''
+Packed program encoding, run with pytest.
+'''
+
+import numpy as np
+import pytest
+
+import packed_program
+from program_slots import step_bytes
+
+
+def _random_sequence(rng, width, n_steps):
+    seq, state = [], 0
+    for _ in range(n_steps):
+        kind = rng.random()
+        if kind < 0.6:
+            # a few channels switch, as in a motion stimulus
+            for c in rng.choice(width, size=int(rng.integers(0, 3)), replace=False):
+                state ^= 1 << int(c)
+        elif kind < 0.9:
+            # whole new state
+            state = int(sum(1 << int(c) for c in np.flatnonzero(rng.random(width) < 0.5)))
+        dur = int(rng.choice([1, 1, 5, 200, 70000, int(rng.integers(0, 1 << 32))]))
+        seq.append((state, dur))
+    return seq
+
+
+@pytest.mark.parametrize("width", [32, 64, 128])
+def test_decode_returns_the_encoded_sequence(width):
+    rng = np.random.default_rng(width)
+    for _ in range(50):
+        seq = _random_sequence(rng, width, int(rng.integers(0, 100)))
+        data = packed_program.encode(seq, width)
+        assert packed_program.decode(data, width) == [s for s in seq if s[1] > 0] + [(0, 0)]
+        assert len(data) == sum(len(b) for b in packed_program.encode_steps(seq, width))
+
+
+def test_motion_steps_take_two_bytes():
+    seq = [(1 << (i % 32), 10) for i in range(100)]
+    sizes = [len(b) for b in packed_program.encode_steps(seq)]
+    assert set(sizes) == {2}
+    assert sum(sizes) < step_bytes() * len(seq)
+
+
+def test_encode_rejects_masks_beyond_the_chain():
+    with pytest.raises(ValueError):
+        packed_program.encode([(1 << 32, 10)], 32)
+    with pytest.raises(ValueError):
+        packed_program.encode([(1, 2.5)], 32)
+
+
+def test_upload_lines_carry_the_program():
+    data = packed_program.encode([(i, 3) for i in range(1, 200)])
+    lines = packed_program.upload_lines(data)
+    assert bytes.fromhex("".join(line.split(":", 1)[1] for line in lines)) == data
+    assert all(len(line) < 64 for line in lines)
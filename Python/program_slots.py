@@ -0,0 +1,130 @@
+'''
+Host-side bookkeeping of the device program slots.
+
+The with_stop firmware (version 3 and later) keeps up to N_SLOTS programs in
+its code buffer at the same time. "select:k" picks the slot that clearcode/addcode
+write to, "exec:k" runs slot k and "free:k" drops it (later programs are
+moved down). SlotAllocator mirrors what is loaded where and picks a slot for
+a new program. When slots or buffer space run out it evicts the least
+recently used programs. Space is counted in bytes: step_bytes(width) per
+plain step (STEP_BYTES on the 32-channel chain), the encoded length for a
+packed program (packed_program.py, version 5).
+
+Used through Controller.load_slot() / Controller.exec_slot():
+
+    controller.load_slot("baseline", baseline_seq)
+    controller.load_slot("test", test_seq)
+    controller.exec_slot("baseline")      # one short command, no re-upload
+'''
+
+import struct
+import hashlib
+from collections import OrderedDict
+
+
+N_SLOTS = 8
+BUFFER_BYTES = 1200     # state_mem of the firmware
+STEP_BYTES = 6          # uint32 state + uint16 delay
+CAPACITY_BYTES = 1194   # 1200-byte buffer, addcode accepts a step while 6 * (steps + 1) < 1200
+
+
+def step_bytes(width=32):
+    """Bytes of a plain step on a width-channel chain: one byte per 8 channels + uint16 delay."""
+    return (width + 7) // 8 + 2
+
+
+def capacity_bytes(width=32):
+    """Bytes usable by programs on a width-channel chain (the firmware keeps one step free)."""
+    return BUFFER_BYTES - step_bytes(width)
+
+
+def sequence_digest(seq):
+    """Hash of the uploaded lines of a (mask, dur) sequence."""
+    h = hashlib.sha1()
+    for mask, dur in seq:
+        if dur > 0:
+            h.update(f"{int(mask):x}/{dur};".encode())
+    return h.hexdigest()
+
+
+def plain_bytes(seq, width=32):
+    """Device memory image of the plain steps (addcode) of a (mask, dur) sequence."""
+    n = (width + 7) // 8
+    return b"".join(int(mask).to_bytes(n, "little") + struct.pack("<H", int(dur) & 0xFFFF) for mask, dur in seq if dur > 0)
+
+
+def fletcher16(data):
+    """Checksum the firmware reports in "status" (version 6) for the bytes of a slot."""
+    s1 = s2 = 0
+    for b in data:
+        s1 = (s1 + b) % 255
+        s2 = (s2 + s1) % 255
+    return s2 << 8 | s1
+
+
+class SlotAllocator:
+    def __init__(self, n_slots=N_SLOTS, capacity=CAPACITY_BYTES):
+        self.n_slots = n_slots
+        self.capacity = capacity
+        # key -> (slot, size in bytes, digest), least recently used first
+        self.entries = OrderedDict()
+
+    @property
+    def used_bytes(self):
+        return sum(size for _, size, _ in self.entries.values())
+
+    def lookup(self, key, digest=None):
+        """Slot holding `key` (with the same content if digest is given) or None. Marks it as used."""
+        entry = self.entries.get(key)
+        if entry is None or (digest is not None and entry[2] != digest):
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def allocate(self, key, size, digest=None):
+        """
+        Reserve a slot for a program of `size` bytes under key. Returns (slot, evicted) where
+        evicted lists (key, slot) of the programs that have to be freed on the device first.
+        """
+        if size > self.capacity:
+            raise ValueError(f"Program of {size} bytes does not fit the device buffer ({self.capacity} bytes)")
+        evicted = []
+        if key in self.entries:
+            # replaced in place, its old bytes are freed by clearcode
+            slot = self.entries.pop(key)[0]
+        else:
+            slot = None
+        while self.entries and (self.used_bytes + size > self.capacity
+                                or (slot is None and len(self.entries) >= self.n_slots)):
+            old_key, (old_slot, _, _) = self.entries.popitem(last=False)
+            evicted.append((old_key, old_slot))
+        if slot is None:
+            taken = {s for s, _, _ in self.entries.values()}
+            slot = min(s for s in range(self.n_slots) if s not in taken)
+        self.entries[key] = (slot, size, digest)
+        return slot, evicted
+
+    def claim(self, key, slot, size, digest=None):
+        """
+        Reserve a given slot for key, replacing whatever it holds. Returns the
+        evicted (key, slot) that have to be freed on the device first.
+        """
+        if size > self.capacity:
+            raise ValueError(f"Program of {size} bytes does not fit the device buffer ({self.capacity} bytes)")
+        for old_key, (old_slot, _, _) in list(self.entries.items()):
+            if old_slot == slot:
+                # its bytes are freed by clearcode
+                del self.entries[old_key]
+        evicted = []
+        while self.entries and self.used_bytes + size > self.capacity:
+            old_key, (old_slot, _, _) = self.entries.popitem(last=False)
+            evicted.append((old_key, old_slot))
+        self.entries[key] = (slot, size, digest)
+        return evicted
+
+    def forget(self, key):
+        entry = self.entries.pop(key, None)
+        return None if entry is None else entry[0]
+
+    def reset(self):
+        self.entries.clear()
@@ -0,0 +1,80 @@
+'''
+SlotAllocator on its own and against the slot table of the serial emulator
+(emulator.py, needs pty), run with pytest.
+'''
+
+import numpy as np
+import pytest
+
+from controller import Controller
+from packed_program import encode
+from program_slots import SlotAllocator, fletcher16, plain_bytes, step_bytes
+
+
+def _programs(rng, n, width=32):
+    return {f"p{i}": [(int(rng.integers(1, 1 << width)), int(rng.integers(1, 50)))
+                      for _ in range(int(rng.integers(1, 60)))] for i in range(n)}
+
+
+def test_allocator_stays_within_slots_and_capacity():
+    rng = np.random.default_rng(0)
+    alloc = SlotAllocator(n_slots=4, capacity=600)
+    loaded = {}
+    for _ in range(500):
+        key = f"p{int(rng.integers(12))}"
+        if alloc.lookup(key) is None:
+            slot, evicted = alloc.allocate(key, int(rng.integers(6, 300)))
+            for old_key, old_slot in evicted:
+                assert loaded.pop(old_key) == old_slot
+            loaded[key] = slot
+        slots = [s for s, _, _ in alloc.entries.values()]
+        assert len(set(slots)) == len(slots) and all(0 <= s < 4 for s in slots)
+        assert alloc.used_bytes <= 600
+        assert loaded == {k: s for k, (s, _, _) in alloc.entries.items()}
+
+
+def test_allocator_evicts_the_least_recently_used():
+    alloc = SlotAllocator(n_slots=2, capacity=1000)
+    alloc.allocate("a", 10)
+    alloc.allocate("b", 10)
+    alloc.lookup("a")
+    slot, evicted = alloc.allocate("c", 10)
+    assert evicted == [("b", 1)] and slot == 1
+    with pytest.raises(ValueError):
+        alloc.allocate("d", 1001)
+
+
+@pytest.fixture
+def board():
+    pytest.importorskip("pty")
+    from emulator import Emulator
+    with Emulator() as emu:
+        controller = Controller(emu.port)
+        controller.connect(reset=False)
+        try:
+            yield controller
+        finally:
+            controller.disconnect()
+
+
+def test_allocator_mirrors_the_device_slots(board):
+    rng = np.random.default_rng(1)
+    programs = _programs(rng, 12)
+    for _ in range(200):
+        key = f"p{int(rng.integers(12))}"
+        board.load_slot(key, programs[key], delay=0)
+        used, _, slots = board.query_slots()
+        assert slots == {s: size for s, size, _ in board.slots.entries.values()}
+        assert used == board.slots.used_bytes
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_device_checksum_matches_the_uploaded_bytes(board, packed):
+    seq = _programs(np.random.default_rng(2), 1)["p0"]
+    board.load_slot("stim", seq, delay=0, packed=packed)
+    status = board.query_status()
+    data = encode(seq, board.width) if packed else plain_bytes(seq, board.width)
+    assert status["packed"] == packed
+    assert status["bytes"] == len(data) and status["checksum"] == fletcher16(data)
+    if not packed:
+        assert len(data) == step_bytes(board.width) * len(seq)
@@ -0,0 +1,147 @@
+'''
+Operations on compiled (mask, dur) sequences.
+
+Compound stimuli are built from compiled sequences directly, without going
+back to Channel objects or a per-ms grid. Every operation walks the runs
+once (overlay merges the step boundaries of its inputs), so the cost grows with
+the number of runs and not with the duration:
+
+    seq = concat(baseline, overlay(sweep, shift(remap(sweep, {i: i + 16 for i in range(16)}), 250)))
+    seq = repeat(scale(seq, 0.5), 10, gap_ms=1000)
+    controller.upload_sequence(seq, tick_us="auto")
+
+Sequences are lists of (mask, dur_ms) as produced by Stimulus.generate_timed_sequence()
+or masks.compile_matrix(). Steps with dur <= 0 (the (0, 0) terminator) are
+ignored on input. Every result follows the same form: adjacent steps with the
+same mask are merged, a trailing all-off run is dropped and (0, 0) is
+appended. A sequence therefore lasts until its last channel switches off;
+concat() and repeat() take gap_ms for silence between the parts.
+'''
+
+import heapq
+
+
+# cumulative times are rounded to this many decimals (ms), so boundaries that
+# add up from different float durations still meet
+_DECIMALS = 9
+
+
+def steps(seq):
+    """(mask, dur) steps of seq with dur > 0, as plain ints/floats."""
+    for mask, dur in seq:
+        if dur > 0:
+            yield int(mask), dur
+
+
+def duration(seq):
+    """Total duration of seq in ms."""
+    return sum(dur for _, dur in steps(seq))
+
+
+def normalize(seq):
+    """seq in the form every operation returns: merged runs, no trailing off run, (0, 0) at the end."""
+    out = []
+    for mask, dur in steps(seq):
+        if out and out[-1][0] == mask:
+            out[-1] = (mask, out[-1][1] + dur)
+        else:
+            out.append((mask, dur))
+    while out and out[-1][0] == 0:
+        out.pop()
+    out.append((0, 0))
+    return out
+
+
+def concat(*seqs, gap_ms=0):
+    """seqs one after the other, gap_ms of silence between them."""
+    out = []
+    for i, seq in enumerate(seqs):
+        if i and gap_ms > 0:
+            out.append((0, gap_ms))
+        out.extend(steps(seq))
+    return normalize(out)
+
+
+def _boundaries(seq, index):
+    # (start time, index, mask) of every step, then (end, index, 0)
+    t = 0
+    for mask, dur in steps(seq):
+        yield round(t, _DECIMALS), index, mask
+        t += dur
+    yield round(t, _DECIMALS), index, 0
+
+
+def overlay(*seqs):
+    """
+    seqs at the same time, OR-ed: a step starts wherever one of them switches.
+    Lasts as long as the longest input.
+    """
+    current = [0] * len(seqs)
+    out = []
+    t_prev, mask_prev = 0, 0
+    for t, index, mask in heapq.merge(*(_boundaries(seq, i) for i, seq in enumerate(seqs))):
+        if t > t_prev:
+            out.append((mask_prev, round(t - t_prev, _DECIMALS)))
+            t_prev = t
+        current[index] = mask
+        mask_prev = 0
+        for m in current:
+            mask_prev |= m
+    return normalize(out)
+
+
+def repeat(seq, n, gap_ms=0):
+    """seq n times, gap_ms of silence between the repetitions."""
+    if n < 0:
+        raise ValueError(f"Repeat count must not be negative, got {n}")
+    return concat(*([seq] * n), gap_ms=gap_ms)
+
+
+def shift(seq, offset_ms):
+    """
+    seq delayed by offset_ms (silence before it). A negative offset cuts
+    -offset_ms from the start instead.
+    """
+    if offset_ms >= 0:
+        return normalize([(0, offset_ms)] + list(steps(seq)))
+    cut = -offset_ms
+    out, t = [], 0
+    for mask, dur in steps(seq):
+        end = t + dur
+        if round(end, _DECIMALS) > round(cut, _DECIMALS):
+            out.append((mask, end - max(t, cut)))
+        t = end
+    return normalize(out)
+
+
+def scale(seq, factor):
+    """seq played factor times slower (factor < 1: faster), every duration multiplied."""
+    if factor <= 0:
+        raise ValueError(f"Scale factor must be positive, got {factor}")
+    return normalize([(mask, dur * factor) for mask, dur in steps(seq)])
+
+
+def remap(seq, mapping):
+    """
+    seq with channel ids moved: mapping = {old id: new id}. Channels that are
+    not in mapping are dropped (so remap also selects channels); several old
+    channels may go to the same new one.
+    """
+    # one 256-entry table per source byte: OR of the new bits for every byte value
+    tables = {}
+    for old, new in mapping.items():
+        if old < 0 or new < 0:
+            raise ValueError(f"Channel ids must not be negative, got {old} -> {new}")
+        table = tables.setdefault(old // 8, [0] * 256)
+        bit, new_mask = 1 << (old % 8), 1 << new
+        for value in range(256):
+            if value & bit:
+                table[value] |= new_mask
+    tables = sorted(tables.items())
+    out = []
+    for mask, dur in steps(seq):
+        new = 0
+        for byte, table in tables:
+            new |= table[(mask >> (8 * byte)) & 0xFF]
+        out.append((new, dur))
+    return normalize(out)
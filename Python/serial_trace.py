@@ -0,0 +1,338 @@
+'''
+Binary traces of serial sessions: record, replay and compare.
+
+A Controller opened with trace="session.trace" (or after start_trace()) writes
+every chunk of bytes it sends or receives, with a microsecond timestamp:
+
+    header   b"SERTRACE", uint32 version, float64 wall-clock start,
+             uint16 length + JSON (port, baud, banner)
+    record   uint8 direction (0 = host -> device, 1 = device -> host),
+             uint32 µs since the previous record, uint16 length, bytes
+
+so an hour of uploads and runs stays in the low megabytes.
+
+replay() sends the host side of a trace again, with the recorded timing (or
+faster), to the firmware emulator (emulator.py) or a real board, and records
+the new session as a trace. diff() compares two traces: throughput of the
+uploads and latencies of replies, exec and stop.
+
+    python -m serial_trace show lab.trace
+    python -m serial_trace replay lab.trace --speed 10 --out replay.trace
+    python -m serial_trace diff lab.trace replay.trace
+'''
+
+import os
+import json
+import time
+import struct
+import threading
+
+
+MAGIC = b"SERTRACE"
+VERSION = 1
+HEADER = struct.Struct("<8sIdH")
+RECORD = struct.Struct("<BIH")
+TX, RX = 0, 1
+MAX_CHUNK = 0xFFFF
+
+# request -> prefix of its reply, for the latency statistics
+REPLIES = {
+    "version": "ready:",
+    "time": "time:",
+    "slots": "slots:",
+    "tick": "tick:",
+    "bench": "bench:",
+    "status": "status:",
+}
+
+
+class TraceWriter:
+    def __init__(self, path, meta=None):
+        """Start a trace file; meta is stored as JSON in the header."""
+        self.path = path
+        self._lock = threading.Lock()
+        self._f = open(path, "wb")
+        meta_bytes = json.dumps(meta or {}).encode()
+        self._f.write(HEADER.pack(MAGIC, VERSION, time.time(), len(meta_bytes)) + meta_bytes)
+        self._t_last = time.perf_counter()
+        self.t0 = self._t_last
+
+    def record(self, direction, data, t=None):
+        """Append bytes sent (TX) or received (RX) at host time t (time.perf_counter(), default now)."""
+        if not data:
+            return
+        with self._lock:
+            if self._f is None:
+                return
+            t = time.perf_counter() if t is None else t
+            # records stay in file order, a late timestamp counts as simultaneous
+            dt_us = max(0, int(round((t - self._t_last) * 1e6)))
+            self._t_last = max(t, self._t_last)
+            for i in range(0, len(data), MAX_CHUNK):
+                chunk = bytes(data[i:i + MAX_CHUNK])
+                self._f.write(RECORD.pack(direction, min(dt_us, 0xFFFFFFFF), len(chunk)) + chunk)
+                dt_us = 0
+
+    def flush(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.flush()
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+
+def read_trace(path):
+    """(meta, records) of a trace file; records are (t seconds from the start, direction, bytes)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, wall_start, meta_len = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a serial trace")
+    pos = HEADER.size
+    meta = json.loads(data[pos:pos + meta_len].decode() or "{}")
+    meta["wall_start"] = wall_start
+    pos += meta_len
+    records, t_us = [], 0
+    while pos + RECORD.size <= len(data):
+        direction, dt_us, n = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        t_us += dt_us
+        records.append((t_us / 1e6, direction, data[pos:pos + n]))
+        pos += n
+    return meta, records
+
+
+def lines(records, direction):
+    """Complete lines in one direction as (t of the chunk that ended the line, text)."""
+    out, buf = [], b""
+    for t, d, chunk in records:
+        if d != direction:
+            continue
+        buf += chunk
+        while b"\n" in buf:
+            line, buf = buf.split(b"\n", 1)
+            out.append((t, line.decode(errors="replace").strip()))
+    return out
+
+
+# =============================================================================
+# STATISTICS / DIFF
+# =============================================================================
+def summarize(records, speed=1.0):
+    """
+    Throughput and latency figures of a trace, as a dict:
+
+    - duration_s, tx_bytes, rx_bytes, tx_lines, rx_lines
+    - upload_lines_per_s / upload_bytes_per_s: program lines (addcode/addbytes)
+      over the time from clearcode to the last program line of each upload
+    - reply_ms: request -> reply latencies (version, time, slots, tick, bench, status)
+    - exec_start_ms: exec -> evt:exec, run_ms: evt:exec -> evt:done (in device
+      time, multiplied by the speed of a replay on the emulator)
+    - stop_ms: interrupt byte -> "Execution Interrupted!"
+    """
+    tx, rx = lines(records, TX), lines(records, RX)
+    events = sorted([(t, TX, line) for t, line in tx] + [(t, RX, line) for t, line in rx],
+                    key=lambda e: (e[0], e[1]))
+    out = {
+        "duration_s": records[-1][0] if records else 0.0,
+        "tx_bytes": sum(len(c) for _, d, c in records if d == TX),
+        "rx_bytes": sum(len(c) for _, d, c in records if d == RX),
+        "tx_lines": len(tx),
+        "rx_lines": len(rx),
+        "reply_ms": [], "exec_start_ms": [], "run_ms": [], "stop_ms": [],
+    }
+    upload_time = upload_lines = upload_bytes = 0.0
+    upload_start = upload_last = None
+    pending = []            # (reply prefix, t) waiting for their reply
+    exec_sent = exec_started = stop_sent = None
+    for t, direction, line in events:
+        if direction == TX:
+            cmd = line.split(":", 1)[0]
+            if line == "clearcode":
+                if upload_start is not None and upload_last is not None:
+                    upload_time += upload_last - upload_start
+                upload_start, upload_last = t, None
+            elif cmd in ("addcode", "addbytes") and upload_start is not None:
+                upload_lines += 1
+                upload_bytes += len(line) + 1
+                upload_last = t
+            if line in REPLIES or cmd == "bench":
+                pending.append((REPLIES[cmd], t))
+            elif cmd == "exec":
+                exec_sent = t
+            elif line == "" and exec_started is not None:
+                stop_sent = t
+        else:
+            for i, (prefix, t_req) in enumerate(pending):
+                if line.startswith(prefix):
+                    out["reply_ms"].append((t - t_req) * 1e3)
+                    del pending[i]
+                    break
+            if line.startswith("evt:exec") and exec_sent is not None:
+                out["exec_start_ms"].append((t - exec_sent) * 1e3)
+                exec_sent, exec_started = None, t
+            elif line.startswith("evt:done") and exec_started is not None:
+                out["run_ms"].append((t - exec_started) * 1e3 * speed)
+                exec_started = None
+            elif line.startswith("Execution Interrupted!"):
+                if stop_sent is not None:
+                    out["stop_ms"].append((t - stop_sent) * 1e3)
+                exec_started = stop_sent = None
+    if upload_start is not None and upload_last is not None:
+        upload_time += upload_last - upload_start
+    out["upload_lines_per_s"] = upload_lines / upload_time if upload_time > 0 else 0.0
+    out["upload_bytes_per_s"] = upload_bytes / upload_time if upload_time > 0 else 0.0
+    return out
+
+
+def _stats(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {"n": len(values), "mean": sum(values) / len(values),
+            "median": values[len(values) // 2], "max": values[-1]}
+
+
+def diff(path_a, path_b, log=print):
+    """
+    Compare two traces, e.g. before and after a host-side change.
+    Returns {metric: (a, b)} with latency lists reduced to n/mean/median/max,
+    plus "tx_same" (the host sent the same lines) and "first_tx_difference".
+    """
+    (meta_a, rec_a), (meta_b, rec_b) = read_trace(path_a), read_trace(path_b)
+    a = summarize(rec_a, meta_a.get("speed", 1.0) if meta_a.get("emulated") else 1.0)
+    b = summarize(rec_b, meta_b.get("speed", 1.0) if meta_b.get("emulated") else 1.0)
+    result = {}
+    for key in a:
+        if isinstance(a[key], list):
+            result[key] = (_stats(a[key]), _stats(b[key]))
+        else:
+            result[key] = (a[key], b[key])
+    tx_a = [line for _, line in lines(rec_a, TX)]
+    tx_b = [line for _, line in lines(rec_b, TX)]
+    result["tx_same"] = tx_a == tx_b
+    result["first_tx_difference"] = next((i for i, (x, y) in enumerate(zip(tx_a, tx_b)) if x != y),
+                                         None if len(tx_a) == len(tx_b) else min(len(tx_a), len(tx_b)))
+    if log:
+        log(f"{'':22s} {os.path.basename(path_a):>18s} {os.path.basename(path_b):>18s} {'change':>9s}")
+        for key, (va, vb) in ((k, v) for k, v in result.items() if k not in ("tx_same", "first_tx_difference")):
+            if isinstance(va, dict) or isinstance(vb, dict):
+                for stat in ("mean", "median", "max"):
+                    xa = va[stat] if va else None
+                    xb = vb[stat] if vb else None
+                    log(_diff_row(f"{key} {stat}", xa, xb))
+            else:
+                log(_diff_row(key, va, vb))
+        if result["tx_same"]:
+            log("host sent the same lines")
+        else:
+            log(f"host lines differ from line {result['first_tx_difference']}")
+    return result
+
+
+def _diff_row(name, a, b):
+    def fmt(x):
+        return "-" if x is None else f"{x:.3f}" if isinstance(x, float) else str(x)
+    change = ""
+    if a not in (None, 0) and b is not None:
+        change = f"{(b - a) / a * 100:+.1f}%"
+    return f"{name:22s} {fmt(a):>18s} {fmt(b):>18s} {change:>9s}"
+
+
+# =============================================================================
+# REPLAY
+# =============================================================================
+def replay(path, port=None, speed=1.0, out_path=None, baud=115200, settle=1.0):
+    """
+    Send the host side of a trace again with its recorded timing.
+
+    - port: serial port of a real board; default: a fresh Emulator (emulator.py)
+    - speed: time scale, 10 = ten times faster (the emulator runs programs
+      at the same speed, so a run is not interrupted by bytes sent early)
+    - out_path: trace of the replayed session (default: <path>.replay)
+    - settle: seconds to keep listening after the last byte
+    Returns out_path.
+    """
+    import serial
+    meta, records = read_trace(path)
+    out_path = out_path or path + ".replay"
+    emu = None
+    if port is None:
+        from emulator import Emulator
+        emu = Emulator(speed=speed, width=meta.get("width", 32)).start()
+        port = emu.port
+    ser = serial.Serial(port, baud, timeout=0.05)
+    writer = TraceWriter(out_path, {"port": port, "baud": baud, "replay_of": os.path.basename(path),
+                                   "speed": speed, "emulated": emu is not None})
+    running = True
+
+    def read_loop():
+        while running:
+            try:
+                data = ser.read(ser.in_waiting or 1)
+            except (serial.SerialException, OSError):
+                return
+            if data:
+                writer.record(RX, data)
+
+    reader = threading.Thread(target=read_loop, daemon=True)
+    reader.start()
+    try:
+        if emu is None:
+            # a real board resets on open, give it the time the original session had before its first byte
+            time.sleep(next((t for t, d, _ in records if d == TX), 0.0) / speed)
+        t_start = time.perf_counter()
+        t_first = next((t for t, d, _ in records if d == TX), 0.0) if emu is not None else 0.0
+        for t, direction, chunk in records:
+            if direction != TX:
+                continue
+            deadline = t_start + (t - t_first) / speed
+            while time.perf_counter() < deadline:
+                time.sleep(min(0.001, max(0.0, deadline - time.perf_counter())))
+            writer.record(TX, chunk)
+            ser.write(chunk)
+        time.sleep(settle)
+    finally:
+        running = False
+        reader.join(1.0)
+        ser.close()
+        writer.close()
+        if emu is not None:
+            emu.close()
+    return out_path
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m serial_trace", description="Show, replay and compare serial traces")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_show = sub.add_parser("show", help="print the lines of a trace with their times")
+    p_show.add_argument("trace")
+    p_replay = sub.add_parser("replay", help="send the host side of a trace again")
+    p_replay.add_argument("trace")
+    p_replay.add_argument("--port", default=None, help="real board (default: emulator)")
+    p_replay.add_argument("--speed", type=float, default=1.0)
+    p_replay.add_argument("--out", default=None)
+    p_diff = sub.add_parser("diff", help="compare throughput and latency of two traces")
+    p_diff.add_argument("a")
+    p_diff.add_argument("b")
+    args = parser.parse_args()
+    if args.command == "show":
+        meta, records = read_trace(args.trace)
+        print(json.dumps(meta))
+        events = sorted([(t, ">", line) for t, line in lines(records, TX)] +
+                        [(t, "<", line) for t, line in lines(records, RX)], key=lambda e: e[0])
+        for t, arrow, line in events:
+            print(f"{t:12.6f} {arrow} {line}")
+    elif args.command == "replay":
+        out = replay(args.trace, port=args.port, speed=args.speed, out_path=args.out)
+        print(f"replayed to {out}")
+        diff(args.trace, out)
+    else:
+        diff(args.a, args.b)
+    sys.exit(0)
@@ -0,0 +1,175 @@
+'''
+Editable stimulus with incremental recompilation.
+
+Stimulus.generate_timed_sequence() sorts every onset/offset event and rebuilds
+the whole (mask, dur) sequence, which is slow to repeat on every edit of a
+large stimulus. EditableStimulus keeps the events indexed by time, together
+with the device state after each event time, and the compiled steps. Adding,
+removing or moving one channel recomputes states only from the first changed
+event time until the state matches the old one again. Only that span of the
+sequence is rewritten.
+
+The result is always identical to generate_timed_sequence() on the same
+channels in the same order (OFF before ON at equal times, otherwise the later
+channel decides when channels share a bit).
+
+    edit = EditableStimulus.from_stimulus(stim)
+    ch = Controller.Channel(ids=11, onset_ms=200, offset_ms=700)
+    lo, hi = edit.add(ch)          # steps lo..hi-1 changed
+    edit.move(ch, 300, 800)
+    edit.remove(ch)
+    controller.upload_sequence(edit.sequence())
+'''
+
+from bisect import bisect_left, insort
+
+
+class EditableStimulus:
+    def __init__(self, channels=()):
+        """
+        channels: Channel objects with onset/offset times (timed mode), in Stimulus order
+        """
+        self._order = {}            # id(channel) -> (key, channel); key keeps the Stimulus order
+        self._next_key = 0
+        self._events = {0: []}      # time -> sorted [(0=off / 1=on, key, mask), ...]
+        self._times = [0]           # sorted event times, 0 is always present
+        self._states = [0]          # state after the events at _times[i]
+        self._steps = []            # _steps[i] = (_states[i], _times[i+1] - _times[i])
+        for ch in channels:
+            self._index(ch)
+        self._times = sorted(self._events)
+        self._states = [None] * len(self._times)
+        self._recompute(0, 0)
+        self._steps = [(self._states[i], self._times[i + 1] - self._times[i])
+                       for i in range(len(self._times) - 1)]
+
+    @classmethod
+    def from_stimulus(cls, stimulus):
+        return cls(stimulus.channels)
+
+    def to_stimulus(self):
+        from controller import Controller
+        return Controller.Stimulus(self.channels)
+
+    @property
+    def channels(self):
+        return [ch for _, ch in self._order.values()]
+
+    def __len__(self):
+        return len(self._steps) + 1
+
+    def sequence(self):
+        """Compiled (mask, dur) sequence, same as Stimulus.generate_timed_sequence()."""
+        return self._steps + [(0, 0)]
+
+    # =========================================================================
+    # EDITS (each returns the (lo, hi) range of sequence indices rewritten)
+    # =========================================================================
+    def add(self, channel):
+        """Append a channel, as if it was added at the end of Stimulus.channels."""
+        if id(channel) in self._order:
+            raise ValueError(f"{channel} is already part of the stimulus")
+        return self._apply(self._index(channel), [])
+
+    def remove(self, channel):
+        return self._apply([], self._unindex(channel))
+
+    def move(self, channel, onset_ms, offset_ms):
+        """Change onset/offset of a channel in place, it keeps its position in the channel order."""
+        self._check_times(onset_ms, offset_ms)
+        removed = self._unindex(channel, keep_order=True)
+        channel.onset_ms, channel.offset_ms = onset_ms, offset_ms
+        channel.hold_time_ms = offset_ms - onset_ms
+        return self._apply(self._index(channel), removed)
+
+    # =========================================================================
+    # INTERNALS
+    # =========================================================================
+    @staticmethod
+    def _check_times(onset_ms, offset_ms):
+        if onset_ms is None or offset_ms is None:
+            raise ValueError("EditableStimulus needs channels with onset_ms/offset_ms")
+        if onset_ms < 0 or offset_ms < 0:
+            raise ValueError("Channel times must not be negative")
+
+    def _index(self, channel):
+        # add the channel's events to _events, returns the new event times
+        self._check_times(channel.onset_ms, channel.offset_ms)
+        if id(channel) in self._order:
+            key = self._order[id(channel)][0]
+        else:
+            key = self._next_key
+            self._next_key += 1
+            self._order[id(channel)] = (key, channel)
+        mask = channel.mask
+        for t, ev in ((channel.onset_ms, (1, key, mask)), (channel.offset_ms, (0, key, mask))):
+            events = self._events.get(t)
+            if events is None:
+                self._events[t] = [ev]
+            else:
+                insort(events, ev)
+        return [channel.onset_ms, channel.offset_ms]
+
+    def _unindex(self, channel, keep_order=False):
+        # remove the channel's events from _events, returns their times
+        entry = self._order.get(id(channel))
+        if entry is None:
+            raise ValueError(f"{channel} is not part of the stimulus")
+        key = entry[0]
+        if not keep_order:
+            del self._order[id(channel)]
+        times = []
+        for t in {channel.onset_ms, channel.offset_ms}:
+            events = self._events[t]
+            events[:] = [ev for ev in events if ev[1] != key]
+            times.append(t)
+        return times
+
+    def _apply(self, added, removed):
+        """Update times/states/steps for the event times touched by an edit."""
+        changed = added + removed
+        for t in changed:
+            pos = bisect_left(self._times, t)
+            present = pos < len(self._times) and self._times[pos] == t
+            if self._events.get(t) or t == 0:
+                if not present:
+                    # new time splits step pos-1
+                    self._times.insert(pos, t)
+                    self._states.insert(pos, None)
+                    self._steps.insert(pos - 1, None)
+            elif present:
+                # no events left at t: steps pos-1 and pos merge
+                del self._events[t]
+                del self._times[pos]
+                del self._states[pos]
+                self._steps.pop(pos - 1)
+        # recompute around each changed time, clusters far apart are handled separately
+        first = last = None
+        done = -1
+        for t in sorted(set(changed)):
+            lo = bisect_left(self._times, t)
+            if lo <= done:
+                continue
+            done = self._recompute(lo, lo)
+            a, b = max(lo - 1, 0), min(done, len(self._steps) - 1)
+            times, states = self._times, self._states
+            for i in range(a, b + 1):
+                self._steps[i] = (states[i], times[i + 1] - times[i])
+            first = a if first is None else first
+            last = b
+        return first, max(last + 1, first)
+
+    def _recompute(self, lo, hi):
+        """
+        Recompute _states from index lo. Stops at the first index >= hi whose
+        state equals the old one, later states cannot change. Returns that index.
+        """
+        times, states, events = self._times, self._states, self._events
+        state = states[lo - 1] if lo > 0 else 0
+        for j in range(lo, len(times)):
+            for on, _, mask in events[times[j]]:
+                state = (state | mask) if on else (state & ~mask)
+            if j >= hi and states[j] == state:
+                return j
+            states[j] = state
+        return len(times) - 1
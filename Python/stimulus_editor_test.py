@@ -0,0 +1,48 @@
+'''
+EditableStimulus against a full generate_timed_sequence(), run with pytest.
+'''
+
+import numpy as np
+import pytest
+
+from controller import Controller
+from stimulus_editor import EditableStimulus
+
+
+def _random_channel(rng):
+    # few bits so channels share them, zero-length and reversed intervals included
+    ids = rng.choice(6, size=int(rng.integers(1, 3)), replace=False).tolist()
+    onset, offset = (int(x) for x in rng.integers(0, 50, size=2))
+    return Controller.Channel(ids=ids, onset_ms=onset, offset_ms=offset)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_edits_match_a_full_compile(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(30):
+        stim = Controller.Stimulus([_random_channel(rng) for _ in range(int(rng.integers(0, 8)))])
+        edit = EditableStimulus.from_stimulus(stim)
+        assert edit.sequence() == stim.generate_timed_sequence()
+        for _ in range(10):
+            before = edit.sequence()
+            channels = edit.channels
+            action = rng.integers(3) if channels else 0
+            if action == 0:
+                lo, hi = edit.add(_random_channel(rng))
+            elif action == 1:
+                lo, hi = edit.remove(channels[int(rng.integers(len(channels)))])
+            else:
+                lo, hi = edit.move(channels[int(rng.integers(len(channels)))],
+                                   *(int(x) for x in rng.integers(0, 50, size=2)))
+            after = edit.sequence()
+            assert after == Controller.Stimulus(edit.channels).generate_timed_sequence()
+            # only steps lo..hi-1 were rewritten
+            assert before[:lo] == after[:lo]
+            tail = len(after) - hi
+            assert after[hi:] == before[len(before) - tail:]
+
+
+def test_edit_rejects_negative_times():
+    edit = EditableStimulus()
+    with pytest.raises(ValueError):
+        edit.add(Controller.Channel(ids=1, onset_ms=-5, offset_ms=10))
@@ -0,0 +1,156 @@
+'''
+Time queries and per-channel statistics over a compiled stimulus.
+
+StimulusIndex is built once from a (mask, dur) sequence (NumPy). It holds
+the step start times, per-channel prefix sums of on-time and a sparse table
+of the number of active channels, so that
+
+- point queries (which channels are on at t) take O(log n),
+- range queries (on-time / duty cycle of every channel in [t0, t1), peak
+  concurrency in [t0, t1)) take O(log n) + O(channels),
+
+without expanding the sequence to a per-ms grid. check_limits() uses them for
+a safety check before upload.
+
+    index = stim.index()
+    index.channels_at(12300)             # [3, 11]
+    index.on_time(11)                    # total ms channel 11 is on
+    index.peak_concurrency()             # max simultaneously active MOSFETs
+    problems = index.check_limits(max_concurrent=6, max_on_ms=5000)
+'''
+
+import numpy as np
+import masks
+
+
+class StimulusIndex:
+    def __init__(self, seq, width=None):
+        """
+        seq: compiled (mask, dur) sequence (generate_timed_sequence(), compile_matrix(), ...)
+        width: channels of the per-channel arrays (default: 32, or as many as seq uses)
+        """
+        steps = [(int(m), d) for m, d in seq if d > 0]
+        used = 0
+        for m, _ in steps:
+            used |= m
+        self.width = masks.width_for([used.bit_length() - 1]) if width is None else width
+        self.masks = masks.to_array([m for m, _ in steps], self.width)
+        self.durations = np.array([d for _, d in steps], dtype=np.float64)
+        edges = np.concatenate([[0.0], np.cumsum(self.durations)])
+        self.starts = edges[:-1]
+        self.total_ms = float(edges[-1])
+        # bits[i, c] = channel c on during step i
+        self.bits = masks.unpack(self.masks, self.width) if len(steps) else np.zeros((0, self.width), dtype=bool)
+        # prefix[i, c] = on-time of channel c before step i
+        self._prefix = np.zeros((len(steps) + 1, self.width))
+        np.cumsum(self.bits * self.durations[:, None], axis=0, out=self._prefix[1:])
+        self.concurrency = masks.popcount(self.masks) if len(steps) else np.zeros(0, dtype=np.int64)
+        # sparse table: _table[k][i] = max concurrency of steps i .. i + 2**k - 1
+        self._table = [self.concurrency]
+        while 2 ** len(self._table) <= len(steps):
+            prev, half = self._table[-1], 2 ** (len(self._table) - 1)
+            self._table.append(np.maximum(prev[:-half], prev[half:]))
+
+    def __len__(self):
+        return len(self.masks)
+
+    # =========================================================================
+    # POINT QUERIES
+    # =========================================================================
+    def step_at(self, t):
+        """Index of the step running at time t (ms), -1 outside the stimulus. Accepts arrays."""
+        i = np.searchsorted(self.starts, t, side="right") - 1
+        return np.where((np.asarray(t) < 0) | (np.asarray(t) >= self.total_ms), -1, i)
+
+    def mask_at(self, t):
+        """State mask at time t (ms), 0 outside the stimulus. Accepts arrays, masks.to_ints() gives plain ints."""
+        i = np.asarray(self.step_at(t))
+        out = np.zeros(i.shape, dtype=self.masks.dtype)
+        inside = i >= 0
+        out[inside] = self.masks[i[inside]]
+        return out
+
+    def channels_at(self, t):
+        """Channel ids on at time t (ms)."""
+        return np.flatnonzero(masks.unpack(self.mask_at(t), self.width)[0]).tolist()
+
+    # =========================================================================
+    # RANGE QUERIES
+    # =========================================================================
+    def _on_before(self, t):
+        # on-time of every channel in [0, t)
+        t = min(max(t, 0.0), self.total_ms)
+        i = int(np.searchsorted(self.starts, t, side="right")) - 1
+        if i < 0:
+            return self._prefix[0]
+        return self._prefix[i] + self.bits[i] * (t - self.starts[i])
+
+    def on_times(self, t0=0.0, t1=None):
+        """On-time in ms of every channel (array indexed by channel id) within [t0, t1)."""
+        t1 = self.total_ms if t1 is None else t1
+        return self._on_before(t1) - self._on_before(t0)
+
+    def on_time(self, channel, t0=0.0, t1=None):
+        return float(self.on_times(t0, t1)[channel])
+
+    def duty_cycle(self, t0=0.0, t1=None):
+        """Fraction of [t0, t1) every channel is on (array indexed by channel id)."""
+        t1 = self.total_ms if t1 is None else t1
+        if t1 <= t0:
+            return np.zeros(self.width)
+        return self.on_times(t0, t1) / (t1 - t0)
+
+    def active_in(self, t0, t1):
+        """Channel ids that are on at some time within [t0, t1)."""
+        return np.flatnonzero(self.on_times(t0, t1) > 0).tolist()
+
+    def peak_concurrency(self, t0=0.0, t1=None):
+        """Maximum number of channels on at the same time within [t0, t1)."""
+        t1 = self.total_ms if t1 is None else t1
+        lo = max(int(np.searchsorted(self.starts, t0, side="right")) - 1, 0)
+        hi = int(np.searchsorted(self.starts, t1, side="left"))
+        if hi <= lo or t1 <= t0 or t1 <= 0 or t0 >= self.total_ms:
+            return 0
+        k = (hi - lo).bit_length() - 1
+        return int(max(self._table[k][lo], self._table[k][hi - 2 ** k]))
+
+    # =========================================================================
+    # SUMMARIES
+    # =========================================================================
+    def max_on_ms(self):
+        """Longest uninterrupted on-time of every channel (array indexed by channel id)."""
+        if not len(self.masks):
+            return np.zeros(self.width)
+        on = self.bits * self.durations[:, None]
+        total = np.cumsum(on, axis=0)
+        # running total at the last step the channel was off, subtracted to restart each run
+        restart = np.maximum.accumulate(np.where(self.bits, 0.0, total), axis=0)
+        return (total - restart).max(axis=0)
+
+    def concurrency_histogram(self):
+        """Time in ms spent with exactly k channels on, index k = 0 .. width."""
+        return np.bincount(self.concurrency, weights=self.durations, minlength=self.width + 1)
+
+    def check_limits(self, max_concurrent=None, max_duty=None, max_on_ms=None):
+        """
+        Safety check before upload. Returns a list of problems (empty if all limits hold).
+
+        - max_concurrent: max number of channels on at the same time
+        - max_duty: max fraction of the stimulus any channel may be on
+        - max_on_ms: max uninterrupted on-time of any channel
+        """
+        problems = []
+        if max_concurrent is not None:
+            peak = self.peak_concurrency()
+            if peak > max_concurrent:
+                i = int(np.argmax(self.concurrency))
+                problems.append(f"{peak} channels on at {self.starts[i]:g} ms (limit {max_concurrent})")
+        if max_duty is not None:
+            duty = self.duty_cycle()
+            for c in np.flatnonzero(duty > max_duty):
+                problems.append(f"channel {c} on {duty[c]:.0%} of the time (limit {max_duty:.0%})")
+        if max_on_ms is not None:
+            longest = self.max_on_ms()
+            for c in np.flatnonzero(longest > max_on_ms):
+                problems.append(f"channel {c} on for {longest[c]:g} ms in one go (limit {max_on_ms:g} ms)")
+        return problems
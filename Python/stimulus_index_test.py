@@ -0,0 +1,47 @@
+'''
+StimulusIndex against a brute-force per-ms expansion, run with pytest.
+'''
+
+import numpy as np
+import pytest
+
+import masks
+from controller import Controller
+from stimulus_index import StimulusIndex
+
+
+def _random_stimulus(rng, width):
+    channels = []
+    for _ in range(int(rng.integers(1, 15))):
+        onset = int(rng.integers(0, 200))
+        channels.append(Controller.Channel(ids=rng.choice(width, size=int(rng.integers(1, 3)), replace=False).tolist(),
+                                           onset_ms=onset, offset_ms=onset + int(rng.integers(1, 100))))
+    return Controller.Stimulus(channels).generate_timed_sequence()
+
+
+def _expand(seq, width):
+    # bits[t, c] = channel c on during ms t
+    rows = []
+    for mask, dur in seq:
+        rows += [[(mask >> c) & 1 for c in range(width)]] * dur
+    return np.array(rows, dtype=bool).reshape(-1, width)
+
+
+@pytest.mark.parametrize("width", [32, 128])
+def test_queries_match_the_expanded_stimulus(width):
+    rng = np.random.default_rng(width)
+    for _ in range(30):
+        seq = _random_stimulus(rng, width)
+        index = StimulusIndex(seq, width)
+        bits = _expand(seq, width)
+        t = np.arange(len(bits)) + 0.5
+        assert index.total_ms == len(bits)
+        assert masks.to_ints(index.mask_at(t)) == [m for m, dur in seq for _ in range(dur)]
+        assert [index.channels_at(x) for x in t[::7]] == [np.flatnonzero(bits[int(x)]).tolist() for x in t[::7]]
+        assert masks.to_ints(index.mask_at([-1, len(bits)])) == [0, 0]
+        t0, t1 = sorted(int(x) for x in rng.integers(0, len(bits) + 1, size=2))
+        assert np.allclose(index.on_times(t0, t1), bits[t0:t1].sum(axis=0))
+        assert index.active_in(t0, t1) == np.flatnonzero(bits[t0:t1].any(axis=0)).tolist()
+        expected_peak = int(bits[t0:t1].sum(axis=1).max()) if t1 > t0 else 0
+        assert index.peak_concurrency(t0, t1) == expected_peak
+        assert np.allclose(index.concurrency_histogram(), np.bincount(bits.sum(axis=1), minlength=width + 1))
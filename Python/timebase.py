@@ -0,0 +1,111 @@
+'''
+Timer tick time base for the with_stop firmware (version 4).
+
+The firmware runs a program from a timer interrupt: every step lasts a whole
+number of ticks, the 16-bit delay field counts ticks, and the tick of each
+program slot is set with "tick:<us>" after clearcode (default 1000 us, so
+plain millisecond uploads behave as before). Because steps switch on tick
+boundaries of a hardware timer, the delays do not drift with the loop
+overhead, and with a tick below 1 ms col_ms can be fractional.
+
+to_ticks() converts a (mask, dur_ms) sequence to (mask, n_ticks) steps. The
+step boundaries (cumulative times) are rounded to the tick, not the single
+durations, so rounding errors never add up. choose_tick() picks the largest
+tick that still hits every boundary exactly: the larger the tick, the fewer
+steps have to be split to fit the 16-bit delay field.
+
+    tick_us, steps = to_ticks(stim.generate_timed_sequence())
+    controller.upload_sequence(stim.generate_timed_sequence(), tick_us="auto")
+'''
+
+from functools import reduce
+from math import gcd
+
+
+DEFAULT_TICK_US = 1000
+TICK_MIN_US = 100       # the firmware needs ~40 us to shift out a state from the interrupt
+TICK_US_PER_BYTE = 25   # on wider chains the shortest tick grows with the bytes shifted out
+TICK_MAX_US = 32767     # 16-bit timer compare register at 2 counts per us
+MAX_TICKS = 0xFFFF      # delay field of a step
+
+
+def boundaries_us(seq):
+    """Cumulative end times (µs, rounded) of the steps with dur > 0."""
+    out, t = [], 0.0
+    for _, dur in seq:
+        if dur > 0:
+            t += dur
+            out.append(int(round(t * 1000.0)))
+    return out
+
+
+def min_tick_us(width=32):
+    """Shortest tick (µs) the firmware accepts on a width-channel chain (min_tick_us)."""
+    return max(TICK_MIN_US, TICK_US_PER_BYTE * ((width + 7) // 8))
+
+
+def choose_tick(seq, width=32):
+    """
+    Tick (µs) for a (mask, dur_ms) sequence: the largest tick in
+    [min_tick_us(width), TICK_MAX_US] that divides every step boundary, or
+    the shortest tick (finest resolution) if there is none.
+    """
+    g = reduce(gcd, boundaries_us(seq), 0)
+    if g == 0:
+        return DEFAULT_TICK_US
+    shortest = min_tick_us(width)
+    for tick in range(min(g, TICK_MAX_US), shortest - 1, -1):
+        if g % tick == 0:
+            return tick
+    return shortest
+
+
+def to_ticks(seq, tick_us=None, width=32):
+    """
+    Convert a (mask, dur_ms) sequence to (tick_us, [(mask, n_ticks), ..., (0, 0)]).
+
+    - tick_us: timer tick in µs (default: choose_tick(seq, width))
+    - width: channels of the register chain, wider chains need a longer tick
+    Steps that round to zero ticks are dropped, steps longer than MAX_TICKS
+    ticks are split into several steps with the same mask.
+    """
+    if tick_us is None:
+        tick_us = choose_tick(seq, width)
+    tick_us = int(tick_us)
+    shortest = min_tick_us(width)
+    if not shortest <= tick_us <= TICK_MAX_US:
+        raise ValueError(f"Tick of {tick_us} us is outside {shortest}..{TICK_MAX_US} us")
+    runs = []
+    prev = 0
+    t = 0.0
+    for mask, dur in seq:
+        if dur <= 0:
+            continue
+        t += dur
+        end = int(t * 1000.0 / tick_us + 0.5)
+        n = end - prev
+        prev = end
+        if n <= 0:
+            continue
+        if runs and runs[-1][0] == mask:
+            runs[-1][1] += n
+        else:
+            runs.append([mask, n])
+    steps = []
+    for mask, n in runs:
+        while n > MAX_TICKS:
+            steps.append((mask, MAX_TICKS))
+            n -= MAX_TICKS
+        steps.append((mask, n))
+    steps.append((0, 0))
+    return tick_us, steps
+
+
+def max_error_us(seq, tick_us):
+    """Largest shift (µs) of a step boundary of a (mask, dur_ms) sequence when it runs with tick_us."""
+    error, t = 0.0, 0.0
+    for _, dur in seq:
+        if dur > 0:
+            t += dur * 1000.0
+            error = max(error, abs(int(t / tick_us + 0.5) * tick_us - t))
+    return error
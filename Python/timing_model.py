@@ -0,0 +1,156 @@
+'''
+Device timing model and latency-compensating compilation.
+
+Every step on the device costs more than its delay: write_chain() shifts out
+one byte per 8 channels and the exec loop polls millis()/Serial.available(). For a
+sequence of n steps with delays d_i (ms) the device takes
+
+    T = rate * sum(d_i) + n * per_step_us + per_exec_us
+
+where per_step_us covers write_chain() plus loop overhead and the millis()
+rounding, and per_exec_us is the final write_chain(chain_off). The coefficients are
+fitted from calibration runs (timed on the device with the evt:exec/evt:done
+lines of the with_stop firmware) and stored per board in boards/<board>.json.
+
+compensate() shortens each step so that the cumulative end times match the
+requested ones, carrying the rounding error forward, so long dense sequences
+end on time instead of drifting late.
+
+    model = TimingModel.calibrate(controller, board_id="lab_board_1")
+    model.save()
+    seq = stim.generate_timed_sequence(timing_model=TimingModel.load("lab_board_1"))
+'''
+
+import os
+import json
+import numpy as np
+
+
+BOARDS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "boards")
+MAX_DELAY_MS = 0xFFFF
+
+
+def board_id_for_port(port):
+    """USB serial number of the board on `port` (falls back to the port name)."""
+    from serial.tools import list_ports
+    for info in list_ports.comports():
+        if info.device == port and info.serial_number:
+            return info.serial_number
+    return port.replace("/", "_")
+
+
+class TimingModel:
+    def __init__(self, board_id="default", rate=1.0, per_step_us=0.0, per_exec_us=0.0, residual_us=None):
+        """
+        - rate: device time per requested ms of delay (1.0 = exact)
+        - per_step_us: extra time every step takes (write_chain + exec loop)
+        - per_exec_us: fixed extra time per exec (final write_chain(chain_off))
+        - residual_us: RMS error of the fit, for information
+        """
+        self.board_id = board_id
+        self.rate = rate
+        self.per_step_us = per_step_us
+        self.per_exec_us = per_exec_us
+        self.residual_us = residual_us
+
+    def __repr__(self):
+        return (f"<TimingModel board={self.board_id} rate={self.rate:.6f} "
+                f"per_step={self.per_step_us:.1f}us per_exec={self.per_exec_us:.1f}us>")
+
+    # =========================================================================
+    # PREDICTION / COMPENSATION
+    # =========================================================================
+    def predict_us(self, seq):
+        """Predicted device run time of a (mask, dur) sequence in µs (steps with dur 0 are not uploaded)."""
+        durs = [dur for _, dur in seq if dur > 0]
+        return self.rate * sum(durs) * 1000.0 + len(durs) * self.per_step_us + self.per_exec_us
+
+    def compensate(self, seq):
+        """
+        Return a copy of seq with delays shortened by the modelled overhead.
+
+        Each delay is chosen so the modelled end of the step is as close as
+        possible to the requested end; rounding errors are carried to the next
+        step. Steps keep at least 1 ms so no state is dropped, if the requested
+        step is shorter than the overhead the time is caught up on later steps.
+        """
+        out = []
+        target_end = 0.0   # requested end of the current step (ms)
+        actual_end = 0.0   # modelled end of the compensated steps (ms)
+        overhead_ms = self.per_step_us / 1000.0
+        for mask, dur in seq:
+            if dur <= 0:
+                out.append((mask, dur))
+                continue
+            target_end += dur
+            d = int(round((target_end - actual_end - overhead_ms) / self.rate))
+            d = min(max(d, 1), MAX_DELAY_MS)
+            actual_end += self.rate * d + overhead_ms
+            out.append((mask, d))
+        return out
+
+    # =========================================================================
+    # FITTING
+    # =========================================================================
+    @classmethod
+    def fit(cls, measurements, board_id="default"):
+        """
+        Fit the model from measurements [(n_steps, sum_delay_ms, measured_us), ...].
+        Needs at least three runs with different step counts and total delays.
+        """
+        A = np.array([[total_ms * 1000.0, n, 1.0] for n, total_ms, _ in measurements])
+        y = np.array([m for _, _, m in measurements], dtype=float)
+        (rate_us, per_step, per_exec), *_ = np.linalg.lstsq(A, y, rcond=None)
+        residual = float(np.sqrt(np.mean((A @ np.array([rate_us, per_step, per_exec]) - y) ** 2)))
+        return cls(board_id, float(rate_us), float(per_step), float(per_exec), residual)
+
+    @classmethod
+    def calibrate(cls, controller, board_id=None, step_counts=(1, 20, 50, 100, 190),
+                  delays_ms=(1, 3), repeats=3, timeout=30.0):
+        """
+        Measure the connected board and fit a model.
+
+        Uploads sequences of n alternating steps with a fixed delay and times
+        them with the device's own evt:exec / evt:done timestamps.
+        """
+        if board_id is None:
+            board_id = board_id_for_port(controller.port)
+        measurements = []
+        for n in step_counts:
+            for d in delays_ms:
+                seq = [((0x1 if i % 2 == 0 else 0x2), d) for i in range(n)]
+                for _ in range(repeats):
+                    controller.upload_sequence(seq, delay=0.005, log_path=None)
+                    controller.wait_sent()
+                    start = controller.expect("evt:exec:")
+                    done = controller.expect("evt:done:")
+                    controller.exec()
+                    r_start = controller.wait_line(start, timeout)
+                    r_done = controller.wait_line(done, timeout)
+                    if r_start is None or r_done is None:
+                        raise TimeoutError("No evt:exec/evt:done from the device, is the with_stop firmware loaded?")
+                    t0 = int(r_start[0].rsplit(":", 1)[1])
+                    t1 = int(r_done[0].rsplit(":", 1)[1])
+                    measurements.append((n, n * d, (t1 - t0) % (1 << 32)))
+        model = cls.fit(measurements, board_id)
+        print(f"Calibrated {model} (fit RMS {model.residual_us:.1f} us)")
+        return model
+
+    # =========================================================================
+    # STORAGE (one file per board)
+    # =========================================================================
+    def to_dict(self):
+        return {"board_id": self.board_id, "rate": self.rate, "per_step_us": self.per_step_us,
+                "per_exec_us": self.per_exec_us, "residual_us": self.residual_us}
+
+    def save(self, boards_dir=BOARDS_DIR):
+        os.makedirs(boards_dir, exist_ok=True)
+        path = os.path.join(boards_dir, f"{self.board_id}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+    @classmethod
+    def load(cls, board_id, boards_dir=BOARDS_DIR):
+        with open(os.path.join(boards_dir, f"{board_id}.json"), encoding="utf-8") as f:
+            return cls(**json.load(f))
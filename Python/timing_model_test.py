@@ -0,0 +1,49 @@
+'''
+TimingModel fitting and compensation, run with pytest.
+'''
+
+import numpy as np
+import pytest
+
+from timing_model import TimingModel
+
+
+def _modelled_ends(model, seq):
+    # modelled device end time (ms) of every step with dur > 0
+    return np.cumsum([model.rate * d + model.per_step_us / 1000.0 for _, d in seq if d > 0])
+
+
+def test_fit_recovers_the_board_parameters():
+    true = TimingModel("board", rate=1.0004, per_step_us=180.0, per_exec_us=60.0)
+    rng = np.random.default_rng(0)
+    measurements = []
+    for n in (1, 20, 50, 100, 190):
+        for d in (1, 3):
+            seq = [(1, d)] * n
+            measurements.append((n, n * d, true.predict_us(seq) + rng.normal(0, 2.0)))
+    model = TimingModel.fit(measurements, "board")
+    assert model.rate == pytest.approx(true.rate, abs=1e-4)
+    assert model.per_step_us == pytest.approx(true.per_step_us, abs=5.0)
+    assert model.per_exec_us == pytest.approx(true.per_exec_us, abs=20.0)
+    assert model.residual_us < 5.0
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_compensated_steps_end_on_time(seed):
+    rng = np.random.default_rng(seed)
+    model = TimingModel(rate=float(rng.uniform(0.999, 1.001)), per_step_us=float(rng.uniform(50, 400)))
+    seq = [(int(rng.integers(1, 16)), int(rng.choice([1, 2, 5, 20, 300]))) for _ in range(500)] + [(0, 0)]
+    out = model.compensate(seq)
+    assert [m for m, _ in out] == [m for m, _ in seq]
+    assert all(d >= 1 for _, d in out[:-1]) and out[-1] == (0, 0)
+    requested = np.cumsum([d for _, d in seq if d > 0])
+    ends = _modelled_ends(model, out)
+    # never more than half a rounded ms early, late only while short steps catch up the overhead
+    assert (ends - requested >= -model.rate / 2 - 1e-9).all()
+    assert abs(ends[-1] - requested[-1]) <= model.rate / 2
+
+
+def test_save_and_load_roundtrip(tmp_path):
+    model = TimingModel("lab_board_1", 1.0002, 150.0, 40.0, 3.5)
+    model.save(str(tmp_path))
+    assert TimingModel.load("lab_board_1", str(tmp_path)).to_dict() == model.to_dict()
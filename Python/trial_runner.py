@@ -0,0 +1,137 @@
+'''
+Pipelined trial runner: uploads the next stimulus while the participant rates the current one.
+
+The device holds one program, so trial N+1 can only be uploaded once trial N
+has finished executing. In a VAS session that is exactly the "..." interval
+plus the rating time, during which the device is otherwise idle. The runner
+compiles and uploads trial N+1 in a background thread as soon as trial N is
+done, so run_trial() can send exec right away.
+
+Usage (vas_only.py style):
+    runner = TrialRunner(controller, stimuli)
+    runner.start()
+    for i in range(len(stimuli)):
+        runner.run_trial(i)
+        ...  # "..." interval and VAS ratings
+    runner.close()
+    runner.print_report()
+'''
+
+import time
+import threading
+
+
+class TrialRunner:
+    def __init__(self, controller, trials, delay=0.01, margin_ms=2000):
+        """
+        - controller: a connected Controller
+        - trials: list of stimuli, each a Controller.Stimulus or a compiled (mask, dur) sequence
+        - delay: pause between uploaded lines (see Controller.upload_sequence)
+        - margin_ms: how long after the expected end of a trial the device may take to
+          report it done (evt:done) before the next upload goes out anyway; any byte
+          arriving during exec would interrupt it
+        """
+        self.controller = controller
+        self.trials = list(trials)
+        self.delay = delay
+        self.margin_ms = margin_ms
+        n = len(self.trials)
+        self._ready = [threading.Event() for _ in range(n)]
+        self._started = [threading.Event() for _ in range(n)]
+        self._ok = [False] * n
+        self._busy_until = 0.0
+        self._closed = False
+        self._thread = None
+        self.stats = [{"trial": i} for i in range(n)]
+
+    @staticmethod
+    def compile(trial):
+        """Return the (mask, dur) sequence for a trial."""
+        if hasattr(trial, "generate_timed_sequence"):
+            return trial.generate_timed_sequence()
+        return list(trial)
+
+    # =========================================================================
+    # RUNNING
+    # =========================================================================
+    def start(self):
+        """Start the background uploader, trial 0 is uploaded immediately."""
+        self._thread = threading.Thread(target=self._upload_loop, daemon=True)
+        self._thread.start()
+
+    def run_trial(self, i, timeout=None):
+        """
+        Execute trial i as soon as its upload is done.
+        Returns the time waited for the upload in ms (0 when it was already loaded).
+        """
+        t_request = time.perf_counter()
+        if not self._ready[i].wait(timeout):
+            raise TimeoutError(f"Trial {i} was not uploaded in time")
+        if not self._ok[i]:
+            raise RuntimeError(f"Upload of trial {i} was cancelled")
+        t_exec = time.perf_counter()
+        self.controller.exec()
+        duration_ms = sum(dur for _, dur in self.stats[i]["seq"])
+        self._busy_until = t_exec + (duration_ms + self.margin_ms) / 1000.0
+        st = self.stats[i]
+        st["requested"] = t_request
+        st["exec"] = t_exec
+        st["duration_ms"] = duration_ms
+        st["idle_ms"] = (t_exec - t_request) * 1000.0
+        # how much of the upload was hidden behind the previous trial's rating
+        hidden = min(st["upload_end"], t_request) - st["upload_start"]
+        st["overlap_ms"] = max(0.0, hidden) * 1000.0
+        self._started[i].set()
+        return st["idle_ms"]
+
+    def close(self):
+        self._closed = True
+        for ev in self._started:
+            ev.set()
+
+    def _upload_loop(self):
+        for i, trial in enumerate(self.trials):
+            seq = self.compile(trial)
+            self.stats[i]["seq"] = seq
+            if i > 0:
+                # the device program can only be replaced once the previous trial is done
+                self._started[i - 1].wait()
+                self._wait_done(i - 1)
+            if self._closed:
+                return
+            t0 = time.perf_counter()
+            self._ok[i] = self.controller.upload_sequence(seq, delay=self.delay, log_path=None)
+            self.controller.wait_sent()
+            t1 = time.perf_counter()
+            self.stats[i]["upload_start"] = t0
+            self.stats[i]["upload_end"] = t1
+            self.stats[i]["upload_ms"] = (t1 - t0) * 1000.0
+            self._ready[i].set()
+
+    def _wait_done(self, i):
+        # executing is cleared by the device's evt:done (or interrupt), the
+        # expected end of the trial is only the timeout
+        while self.controller.executing and not self._closed:
+            if time.perf_counter() > self._busy_until:
+                print(f"Trial {i} not reported done within {self.margin_ms} ms of its expected end, uploading anyway")
+                return
+            time.sleep(0.002)
+
+    # =========================================================================
+    # REPORT
+    # =========================================================================
+    def report(self):
+        """Per-trial idle time, upload time and upload overlap (ms) for executed trials."""
+        keys = ("trial", "idle_ms", "upload_ms", "overlap_ms", "duration_ms")
+        return [{k: st[k] for k in keys} for st in self.stats if "exec" in st]
+
+    def print_report(self):
+        rows = self.report()
+        print("trial   idle_ms  upload_ms  overlap_ms  duration_ms")
+        for r in rows:
+            print(f"{r['trial']:5d} {r['idle_ms']:9.1f} {r['upload_ms']:10.1f} {r['overlap_ms']:11.1f} {r['duration_ms']:12}")
+        if rows:
+            idle = sum(r["idle_ms"] for r in rows)
+            hidden = sum(r["overlap_ms"] for r in rows)
+            upload = sum(r["upload_ms"] for r in rows)
+            print(f"total idle {idle:.1f} ms, {hidden:.1f} of {upload:.1f} ms upload hidden behind ratings")
@@ -0,0 +1,174 @@
+'''
+Adaptive threshold estimation (Psi method, Kontsevich & Tyler 1999).
+
+Keeps a posterior over a dense threshold x slope grid of a logistic
+psychometric function
+
+    p(yes | x) = guess + (1 - guess - lapse) / (1 + exp(-slope * (x - threshold)))
+
+and picks the next stimulus level by minimum expected posterior entropy, i.e.
+maximum expected information gain. Everything is vectorized with NumPy.
+The per-level likelihood tables are computed once, so update() is a single
+(threshold x slope) addition and next_level() is one pass over
+(levels x threshold x slope).
+
+Levels are plain numbers: pump target pressures (raw units) in
+pain_threshold_no_dev.py, or an intensity per stimulus for the Controller:
+
+    psi = PsiStaircase(levels=range(0, 118))
+    for trial in range(20):
+        x = psi.next_level()
+        ...  # present x, ask "painful?"
+        psi.update(x, answered_yes)
+    threshold, sd = psi.threshold()
+
+    # stimuli for the MOSFET array, level = number of active channels by default
+    selector = PsiStimulusSelector(controller, stimuli)
+    for trial in range(20):
+        selector.present()              # load_slot() + exec_slot() of the chosen stimulus
+        ...  # ask "painful?"
+        selector.respond(answered_yes)
+    threshold, sd = selector.psi.threshold()
+'''
+
+import numpy as np
+
+
+class PsiStaircase:
+    def __init__(self, levels, thresholds=None, slopes=None, guess=0.0, lapse=0.02,
+                 prior_mean=None, prior_sd=None):
+        """
+        - levels: candidate stimulus levels (sorted or not, numeric)
+        - thresholds: threshold grid (default: 101 points over the level range)
+        - slopes: slope grid (default: 30 log-spaced points, from very shallow to a step)
+        - guess / lapse: lower / upper asymptote of the yes rate
+        - prior_mean / prior_sd: optional Gaussian prior on the threshold
+          (e.g. from the ramp thresholds), otherwise uniform
+        """
+        self.levels = np.asarray(list(levels), dtype=float)
+        lo, hi = self.levels.min(), self.levels.max()
+        span = max(hi - lo, 1e-9)
+        self.thresholds = np.linspace(lo, hi, 101) if thresholds is None else np.asarray(thresholds, dtype=float)
+        self.slopes = np.geomspace(0.5 / span, 50.0 / span, 30) if slopes is None else np.asarray(slopes, dtype=float)
+        self.guess = guess
+        self.lapse = lapse
+
+        # p_yes[l, t, s] for every level / threshold / slope, with its logs
+        z = self.slopes[None, None, :] * (self.levels[:, None, None] - self.thresholds[None, :, None])
+        p_yes = guess + (1.0 - guess - lapse) / (1.0 + np.exp(-z))
+        self._p_yes = p_yes
+        self._log_yes = np.log(p_yes)
+        self._log_no = np.log1p(-p_yes)
+
+        log_prior = np.zeros((len(self.thresholds), len(self.slopes)))
+        if prior_mean is not None:
+            sd = prior_sd if prior_sd is not None else span / 4.0
+            log_prior += (-0.5 * ((self.thresholds - prior_mean) / sd) ** 2)[:, None]
+        self.log_post = log_prior - np.logaddexp.reduce(log_prior, axis=None)
+        self.history = []
+
+    # =========================================================================
+    # TRIALS
+    # =========================================================================
+    def _level_index(self, level):
+        return int(np.argmin(np.abs(self.levels - level)))
+
+    def update(self, level, yes):
+        """Add one response (yes = True if the stimulus at `level` was reported, e.g. painful)."""
+        i = self._level_index(level)
+        self.log_post += self._log_yes[i] if yes else self._log_no[i]
+        self.log_post -= self.log_post.max()
+        self.history.append((float(self.levels[i]), bool(yes)))
+
+    def next_index(self):
+        """Index into levels with the lowest expected posterior entropy after the next response."""
+        post = np.exp(self.log_post - np.logaddexp.reduce(self.log_post, axis=None))
+        log_post = np.log(np.maximum(post, 1e-300))
+        # joint probability of (response, parameters) per level
+        joint_yes = post * self._p_yes
+        p_yes = joint_yes.sum(axis=(1, 2))
+        p_no = 1.0 - p_yes
+        # entropy of the normalized posterior after each response, H = log p - sum(joint * log joint) / p
+        s_yes = (joint_yes * (log_post + self._log_yes)).sum(axis=(1, 2))
+        s_no = ((post - joint_yes) * (log_post + self._log_no)).sum(axis=(1, 2))
+        h_yes = np.log(p_yes) - s_yes / p_yes
+        h_no = np.log(p_no) - s_no / p_no
+        return int(np.argmin(p_yes * h_yes + p_no * h_no))
+
+    def next_level(self):
+        return float(self.levels[self.next_index()])
+
+    # =========================================================================
+    # ESTIMATES
+    # =========================================================================
+    def posterior(self):
+        """Normalized posterior, shape (len(thresholds), len(slopes))."""
+        post = np.exp(self.log_post - self.log_post.max())
+        return post / post.sum()
+
+    def threshold(self):
+        """Posterior mean and standard deviation of the threshold."""
+        marginal = self.posterior().sum(axis=1)
+        mean = float(marginal @ self.thresholds)
+        return mean, float(np.sqrt(marginal @ (self.thresholds - mean) ** 2))
+
+    def slope(self):
+        """Posterior mean and standard deviation of the slope."""
+        marginal = self.posterior().sum(axis=0)
+        mean = float(marginal @ self.slopes)
+        return mean, float(np.sqrt(marginal @ (self.slopes - mean) ** 2))
+
+
+# =============================================================================
+# CONTROLLER
+# =============================================================================
+class PsiStimulusSelector:
+    """
+    Psi-driven stimulus selection for the MOSFET array Controller: each trial
+    runs the stimulus whose level PsiStaircase.next_index() picks. Programs are
+    kept on the device with Controller.load_slot(), so a stimulus that comes
+    up again starts with a single exec:<slot>.
+    """
+
+    def __init__(self, controller, stimuli, levels=None, tick_us=None, delay=0.01, **psi_kwargs):
+        """
+        - controller: a connected Controller (program slots, firmware version 3)
+        - stimuli: Controller.Stimulus objects or compiled (mask, dur) sequences
+        - levels: one number per stimulus (default: number of active channels)
+        - tick_us / delay: passed on to load_slot()
+        - psi_kwargs: passed on to PsiStaircase
+        """
+        self.controller = controller
+        self.stimuli = list(stimuli)
+        if levels is None:
+            levels = [len(s.channels) if hasattr(s, "channels") else _active_channels(s) for s in self.stimuli]
+        self.psi = PsiStaircase(levels, **psi_kwargs)
+        self.tick_us = tick_us
+        self.delay = delay
+        self.current = None
+
+    def present(self):
+        """Load (if needed) and run the next stimulus, returns its index."""
+        i = self.psi.next_index()
+        stim = self.stimuli[i]
+        seq = stim.generate_timed_sequence() if hasattr(stim, "generate_timed_sequence") else list(stim)
+        if self.controller.load_slot(i, seq, delay=self.delay, tick_us=self.tick_us) is None:
+            raise RuntimeError(f"Upload of stimulus {i} was cancelled")
+        self.controller.exec_slot(i)
+        self.current = i
+        return i
+
+    def respond(self, yes):
+        """Response to the stimulus last presented (yes = e.g. painful)."""
+        if self.current is None:
+            raise RuntimeError("No stimulus presented")
+        self.psi.update(self.psi.levels[self.current], yes)
+        self.current = None
+
+
+def _active_channels(seq):
+    # channels switched on anywhere in a (mask, dur) sequence
+    mask = 0
+    for m, _ in seq:
+        mask |= int(m)
+    return bin(mask).count("1")
@@ -0,0 +1,60 @@
+'''
+PsiStaircase and PsiStimulusSelector, run with pytest.
+'''
+
+import numpy as np
+
+from adaptive_threshold import PsiStaircase, PsiStimulusSelector
+
+
+class FakeController:
+    """Records the slot calls of Controller.load_slot() / exec_slot()."""
+
+    def __init__(self):
+        self.loaded = {}
+        self.uploads = 0
+        self.executed = []
+
+    def load_slot(self, key, seq, delay=0.01, log_path=None, tick_us=None, packed=False):
+        if self.loaded.get(key) != seq:
+            self.loaded[key] = seq
+            self.uploads += 1
+        return key
+
+    def exec_slot(self, key):
+        self.executed.append(key)
+        return key
+
+
+def _observer(threshold, slope, rng):
+    return lambda level: rng.random() < 1.0 / (1.0 + np.exp(-slope * (level - threshold)))
+
+
+def test_psi_converges_on_a_simulated_observer():
+    rng = np.random.default_rng(1)
+    answer = _observer(60.0, 0.3, rng)
+    psi = PsiStaircase(levels=range(0, 118))
+    for _ in range(60):
+        x = psi.next_level()
+        psi.update(x, answer(x))
+    threshold, sd = psi.threshold()
+    assert abs(threshold - 60.0) < 2 * sd + 3
+
+
+def test_selector_runs_the_stimulus_psi_picks():
+    # stimulus i switches on channels 0..i, its level is i + 1 active channels
+    stimuli = [[((1 << (i + 1)) - 1, 100), (0, 1)] for i in range(16)]
+    controller = FakeController()
+    selector = PsiStimulusSelector(controller, stimuli)
+    assert list(selector.psi.levels) == list(range(1, 17))
+    rng = np.random.default_rng(2)
+    answer = _observer(8.0, 1.0, rng)
+    for _ in range(30):
+        expected = selector.psi.next_index()
+        i = selector.present()
+        assert i == expected and controller.executed[-1] == i
+        assert controller.loaded[i] == stimuli[i]
+        selector.respond(answer(selector.psi.levels[i]))
+    # a stimulus that comes up again is not uploaded again
+    assert controller.uploads == len(set(controller.executed))
+    assert len(selector.psi.history) == 30
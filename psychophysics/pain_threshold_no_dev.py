@@ -8,6 +8,9 @@ from PyQt5 import QtGui, QtCore
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot
 from statistics import mean 
+from pump_controller import PumpController, RAW_TO_MMHG
+from adaptive_threshold import PsiStaircase
+from pressure_control import PressureHold
 
 
 LOG_FOLDER = "_PUMP_THRESHOLD_LOGs"
@@ -17,12 +20,18 @@ BAUDRATE = 115200
 # how often pump sends a value
 SAMPLE_RATE_MS = 100 
 TARGET_PRESSURE_HOLD_TIME_SEC = 5
+# pain pressure is held within this many raw units, and has to be reached within the timeout
+TARGET_PRESSURE_TOLERANCE = 2
+TARGET_PRESSURE_TIMEOUT_SEC = 20
 MAX_PRESSURE = 117
-# from  pump spec file: 1 = start code  , 255 = stop code
-COMMAND_START_CODE = 1                           
-COMMAND_STOP_CODE = 255     
 NO_TRIALS = 3
 WAIT_DEFLATE = 4000
+# set to True when the pump is connected
+USE_PUMP = False
+# yes/no trials after the ramp trials, levels chosen by the Psi staircase (0 = off)
+ADAPTIVE_TRIALS = 0
+# how long the pump inflates towards the chosen level before asking
+ADAPTIVE_STIM_MS = 3000
 ###############################################################################
 # MY APP CLASSES
 
@@ -95,6 +104,7 @@ class PresentationWidget(QMainWindow):
     stop_pump_signal = pyqtSignal()
     wait_signal = pyqtSignal()
     apply_pain_signal = pyqtSignal()
+    pain_done_signal = pyqtSignal()
     def __init__(self,params):
         super(PresentationWidget, self).__init__()
         self.name = "Test"
@@ -112,6 +122,15 @@ class PresentationWidget(QMainWindow):
 
         self.thresholds = []
         self.trial = 0
+        self.stop_key_time = None
+        # adaptive (Psi) trials
+        self.psi = None
+        self.adaptive_trial = 0
+        self.adaptive_level = None
+        self.adaptive_question = False
+        # closed-loop hold of the pain pressure
+        self.hold = None
+        self.ended = False
 
         # configure logging
         self.current_path = os.path.dirname(os.path.abspath(__file__))
@@ -129,6 +148,13 @@ class PresentationWidget(QMainWindow):
         f.write("Participant ID: "+str(self.participant_id)+"\n\n")
         f.close()
 
+        # the pump port stays open for the whole session, serial I/O runs in its own thread
+        self.pump = None
+        if USE_PUMP:
+            self.pump = PumpController(self.com_port, BAUDRATE)
+            self.pump.error.connect(lambda msg: print("Pump error:", msg))
+            self.pump.open()
+
         # keep track of what is displayed
         self.start_on = True
         self.threshold_on = False
@@ -154,6 +180,8 @@ class PresentationWidget(QMainWindow):
         self.stop_pump_signal.connect(self.write_pump_data)
         self.wait_signal.connect(self.wait)
         self.apply_pain_signal.connect(self.pump_apply_pain)
+        # emitted from the pump thread when the hold ends, handled in the GUI thread
+        self.pain_done_signal.connect(self.the_end)
 
     # define keypress events
     def keyPressEvent(self,event):
@@ -163,11 +191,15 @@ class PresentationWidget(QMainWindow):
             self.start_threshold_measure()
         # wait for Spacebar to stop the pump
         elif event.key() == Qt.Key_Space and self.threshold_on == True:
+            self.stop_key_time = time.perf_counter()
             print("Stop pumping")
             self.stop_pump_signal.emit()
         # wait for S to start pain
         elif event.key() == Qt.Key_S and self.apply_pain == True:
             self.apply_pain_signal.emit()
+        # J (ja) / N (nej) answers an adaptive trial
+        elif event.key() in (Qt.Key_J, Qt.Key_N) and self.adaptive_question == True:
+            self.adaptive_answer(event.key() == Qt.Key_J)
             
         super(PresentationWidget, self).keyPressEvent(event)
 
@@ -184,45 +216,80 @@ class PresentationWidget(QMainWindow):
             self.main_layout.replaceWidget(self.init_widget,stop_widget)
             self.init_widget.deleteLater()
             self.init_widget = stop_widget
-            # bytes read from pump
-            # self.pumpBytes = bytearray([])
-            # # initialize serial      
-            # if not serial.Serial(self.com_port, BAUDRATE, timeout = 0.5).is_open:   
-            #     # print("Port was closed")                           
-            #     self.pumpController = serial.Serial(self.com_port, BAUDRATE, timeout = 0.5) 
-            # else:
-            #     # print("Port was already opened") 
-            #     serial.Serial(self.com_port, BAUDRATE, timeout = 0.5).close()  
-            #     self.pumpController = serial.Serial(self.com_port, BAUDRATE, timeout = 0.5) 
-            #         
-            # # This is the rate of inflation and speed of the motor. 
-            # # It progresses stepwise where this value indicates 
-            # # how many seconds it remains on this step before accelerating again. 
-            # # Value is in seconds. This is required for the motor to be able to handle 
-            # # the pressure inside the system, otherwise it would slow down to a halt.                                 
-            # outputLevel = 3                                                  
-            # # prepare the start and stop bytes
-            # start_command_list = [ord('S'), COMMAND_START_CODE, MAX_PRESSURE, outputLevel, 1, 0]
-            # # to start the pump
-            # # send one command at a time with a delay in order for the pump not to miss anything
-            # for i in range(len(start_command_list)):
-            #     self.pumpController.write(bytearray([start_command_list[i]]))
-            #     time.sleep(0.02)
-            # # log time when pump starts sending data
-            # self.send_pump_start_command_time = datetime.datetime.now()
+            if self.pump is not None:
+                # This is the rate of inflation and speed of the motor. 
+                # It progresses stepwise where this value indicates 
+                # how many seconds it remains on this step before accelerating again. 
+                # Value is in seconds. This is required for the motor to be able to handle 
+                # the pressure inside the system, otherwise it would slow down to a halt.                                 
+                outputLevel = 3
+                self.pump.start_pump(MAX_PRESSURE, outputLevel, 1)
+            # log time when pump starts sending data
             self.send_pump_start_command_time = datetime.datetime.now()
             self.trial +=1
+        elif self.adaptive_trial < ADAPTIVE_TRIALS:
+            self.start_adaptive_trial()
         else:
             self.apply_pain = True
             self.prepare_pain()
 
+    def show_text(self, text):
+        widget = QWidget()
+        layout = QVBoxLayout()
+        label = QLabel(text)
+        label.setAlignment(Qt.AlignCenter)
+        label.setStyleSheet(self.big_label_stylesheet)
+        layout.addWidget(label)
+        widget.setLayout(layout)
+        self.main_layout.replaceWidget(self.init_widget,widget)
+        self.init_widget.deleteLater()
+        self.init_widget = widget
+
+    ###########################################################################
+    # ADAPTIVE TRIALS: inflate to a level chosen by the Psi staircase, ask "painful?"
+    def start_adaptive_trial(self):
+        if self.psi is None:
+            # centre the prior on the ramp thresholds if there are any
+            prior_mean = mean(self.thresholds) if self.thresholds else None
+            self.psi = PsiStaircase(range(0, MAX_PRESSURE + 1), prior_mean=prior_mean)
+        self.adaptive_level = self.psi.next_level()
+        self.adaptive_trial += 1
+        self.show_text("Vänta")
+        if self.pump is not None:
+            outputLevel = 1
+            self.pump.start_pump(round(self.adaptive_level), outputLevel, 1)
+        self.send_pump_start_command_time = datetime.datetime.now()
+        PyQt5.QtCore.QTimer.singleShot(ADAPTIVE_STIM_MS, self.ask_adaptive)
+
+    def ask_adaptive(self):
+        if self.pump is not None:
+            self.pump.stop_pump()
+        self.write_pump_samples("_pumpAdaptive"+str(self.adaptive_trial), "_pumpHgAdaptive"+str(self.adaptive_trial))
+        self.show_text("Gjorde det ont?\nJ = ja   N = nej")
+        self.adaptive_question = True
+
+    def adaptive_answer(self, painful):
+        self.adaptive_question = False
+        self.psi.update(self.adaptive_level, painful)
+        threshold, sd = self.psi.threshold()
+        f = open(self.log_path, "a")
+        f.write("Adaptive " + str(self.adaptive_trial)+":    level "+str(round(self.adaptive_level))+
+                " -> "+("painful" if painful else "not painful")+
+                ", threshold estimate "+str(round(threshold,1))+" +- "+str(round(sd,1))+"\n")
+        f.close()
+        self.show_text("Vänta")
+        PyQt5.QtCore.QTimer.singleShot(WAIT_DEFLATE, self.start_threshold_measure)
+
     @pyqtSlot()
     def write_pump_data(self):
         self.threshold_on = False
         try:
-            # # stop the pump
-            # commandStop = bytearray([ord('S'), COMMAND_STOP_CODE, 0, 0, 0, 0])
-            # self.pumpController.write(commandStop)
+            # stop the pump
+            if self.pump is not None:
+                latency_ms = self.pump.stop_pump(self.stop_key_time)
+                f = open(self.log_path, "a")
+                f.write("Stop latency " + str(self.trial)+":    "+str(round(latency_ms,3))+" ms (keypress to stop byte)\n")
+                f.close()
             # send a signal to wait for pump to deflate
             self.wait_signal.emit()
         except:
@@ -244,49 +311,38 @@ class PresentationWidget(QMainWindow):
 
         #################################
         # WRITE PUMP DATA TO A FILE
-        # read all data that was sent by the pump
-        # pump_data= self.pumpController.read(size=self.pumpController.in_waiting)
-        # if len(pump_data) > 0:
-        #     self.pumpBytes += bytearray(pump_data)
-        #     # what the bytes look like unmodified 
-        #     self.pumpBytes = struct.unpack( "=" + "B" * len(self.pumpBytes), self.pumpBytes)
-        #
-        # previous_t = self.send_pump_start_command_time   
-        # if len(self.pumpBytes) != 0:   
-        #     # create files for pump data
-        #     self.pump_data_file_name = self.log_file_name.split(".")[0]+"_pump"+"Trial"+str(self.trial)+".txt"
-        #     pump_data_dump = open(os.path.join(self.dump_path,self.pump_data_file_name),"w")
-        #     self.pump_Hg_data_file_name = self.log_file_name.split(".")[0]+"_pumpHg"+"Trial"+str(self.trial)+".txt"
-        #     pump_Hg_data_dump = open(os.path.join(self.dump_path,self.pump_Hg_data_file_name),"w")
-        #     for i in range(0,len(self.pumpBytes)):
-        #         previous_t_text = previous_t.strftime("%Y-%m-%d %H:%M:%S.%f")
-        #         row_pump_data = previous_t_text + "    " + str(self.pumpBytes[i]) + "\n"
-        #         pump_data_dump.write(row_pump_data)
-        #         row_pump_dataHg =  previous_t_text + "    " + str(float(self.pumpBytes[i])*1.01372549) + "\n"
-        #         pump_Hg_data_dump.write(row_pump_dataHg)
-        #         # pump sends value every 100ms, therefore samples should be 100ms apart
-        #         tt = previous_t + datetime.timedelta(milliseconds=SAMPLE_RATE_MS)
-        #         previous_t = tt
-        #     pump_data_dump.close()
-        #     pump_Hg_data_dump.close()
-        #     # save threshold
-        #     current_threshold = self.pumpBytes[i]
-        #     current_threshold_mmHg =float(self.pumpBytes[i])*1.01372549
-        #     self.thresholds.append(current_threshold)
-        #     print("Thresholds",self.thresholds)
-        #     # write that to main log file
-        #     f = open(self.log_path, "a")
-        #     f.write("Threshold " + str(self.trial)+":    "+str(current_threshold)+"\n")
-        #     f.write("Threshold " + str(self.trial)+":    "+str(current_threshold_mmHg)+" mmHg\n\n")
-        #     f.close()
-        # else:
-        #     # print("No valid data found :(")
-        #     pass
-        # # close serial connection
-        # self.pumpController.close()
+        current_threshold = self.write_pump_samples("_pump"+"Trial"+str(self.trial), "_pumpHg"+"Trial"+str(self.trial))
+        if current_threshold is not None:
+            # save threshold
+            current_threshold_mmHg = float(current_threshold)*RAW_TO_MMHG
+            self.thresholds.append(current_threshold)
+            print("Thresholds",self.thresholds)
+            # write that to main log file
+            f = open(self.log_path, "a")
+            f.write("Threshold " + str(self.trial)+":    "+str(current_threshold)+"\n")
+            f.write("Threshold " + str(self.trial)+":    "+str(current_threshold_mmHg)+" mmHg\n\n")
+            f.close()
         # wait a bit before next pumping
         PyQt5.QtCore.QTimer.singleShot(WAIT_DEFLATE, self.start_threshold_measure)
 
+    def write_pump_samples(self, raw_suffix, hg_suffix):
+        """Dump samples received since the last pump start, return the last raw value (or None)."""
+        if self.pump is None:
+            return None
+        samples = self.pump.samples()
+        if len(samples) == 0:
+            # print("No valid data found :(")
+            return None
+        pump_data_file_name = self.log_file_name.split(".")[0]+raw_suffix+".txt"
+        pump_Hg_data_file_name = self.log_file_name.split(".")[0]+hg_suffix+".txt"
+        with open(os.path.join(self.dump_path,pump_data_file_name),"w") as pump_data_dump, \
+             open(os.path.join(self.dump_path,pump_Hg_data_file_name),"w") as pump_Hg_data_dump:
+            for t, value in samples:
+                t_text = t.strftime("%Y-%m-%d %H:%M:%S.%f")
+                pump_data_dump.write(t_text + "    " + str(value) + "\n")
+                pump_Hg_data_dump.write(t_text + "    " + str(float(value)*RAW_TO_MMHG) + "\n")
+        return samples[-1][1]
+
     def prepare_pain(self):
         pain_widget = QWidget()
         pain_layout = QVBoxLayout()
@@ -314,55 +370,66 @@ class PresentationWidget(QMainWindow):
 
         self.apply_pain = False
 
-        # # calculate threshold values
-        # pain_from_pump = mean(self.thresholds)
-        # # increment by 10%
-        # pain = pain_from_pump + pain_from_pump*0.1
-        # pain_mmHg = round(float(pain)*1.01372549,2)
-        # # get pressure by subtracting 50%
-        # pressure = pain_from_pump - pain_from_pump*0.5
-        # print(round(pain))
-        # print(round(pressure))
-        # write thresholds to main log file
-        # f = open(self.log_path, "a")
-        # f.write("\nPain Threshold:    "+str(round(pain))+"\n")
-        # f.write("Pain Threshold:    "+str(pain_mmHg)+" mmHg\n")
-        # f.write("\n\nFormula for pain threshold:    (threshold1+threshold2+threshold3)/3 + ((threshold1+threshold2+threshold3)/3)*0.1")
-        # f.write("\nFormula for pain threshold mmHg:    pain threshold*"+str(1.01372549))
-        # # f.write("Pressure Threshold:    "+str(round(pressure))+"\n")
-        # f.close()
-
-        # bytes read from pump
-        # self.pumpBytes = bytearray([])
-        # # initialize serial      
-        # if not serial.Serial(self.com_port, BAUDRATE, timeout = 0.5).is_open:   
-        #     print("Port was closed")                           
-        #     self.pumpController = serial.Serial(self.com_port, BAUDRATE, timeout = 0.5) 
-        # else:
-        #     print("Port was already opened") 
-        #     serial.Serial(self.com_port, BAUDRATE, timeout = 0.5).close()  
-        #     self.pumpController = serial.Serial(self.com_port, BAUDRATE, timeout = 0.5) 
-        #         
-        # # This is the rate of inflation and speed of the motor. 
-        # # It progresses stepwise where this value indicates 
-        # # how many seconds it remains on this step before accelerating again. 
-        # # Value is in seconds. This is required for the motor to be able to handle 
-        # # the pressure inside the system, otherwise it would slow down to a halt.                                 
-        # outputLevel = 1                                                 
-        # # prepare the start and stop bytes
-        # start_command_list = [ord('S'), COMMAND_START_CODE, round(pain), outputLevel, 5, 0]
-        # # to start the pump
-        # # send one command at a time with a delay in order for the pump not to miss anything
-        # for i in range(len(start_command_list)):
-        #     self.pumpController.write(bytearray([start_command_list[i]]))
-        #     time.sleep(0.02)
-        # # log time when pump starts sending data
-        # self.send_pump_start_command_time = datetime.datetime.now()
+        if self.pump is not None and (self.thresholds or self.psi is not None):
+            # calculate threshold values
+            if self.psi is not None:
+                # posterior mean of the Psi staircase replaces the mean of the ramp thresholds
+                pain_from_pump, _ = self.psi.threshold()
+            else:
+                pain_from_pump = mean(self.thresholds)
+            # increment by 10%
+            pain = pain_from_pump + pain_from_pump*0.1
+            pain_mmHg = round(float(pain)*RAW_TO_MMHG,2)
+            print(round(pain))
+            # write thresholds to main log file
+            f = open(self.log_path, "a")
+            f.write("\nPain Threshold:    "+str(round(pain))+"\n")
+            f.write("Pain Threshold:    "+str(pain_mmHg)+" mmHg\n")
+            if self.psi is not None:
+                f.write("\n\nFormula for pain threshold:    adaptive threshold estimate + adaptive threshold estimate*0.1")
+            else:
+                f.write("\n\nFormula for pain threshold:    (threshold1+threshold2+threshold3)/3 + ((threshold1+threshold2+threshold3)/3)*0.1")
+            f.write("\nFormula for pain threshold mmHg:    pain threshold*"+str(RAW_TO_MMHG))
+            f.close()
+            outputLevel = 1
+            # reach the pain pressure and hold it, corrected on every pump sample
+            self.hold = PressureHold(self.pump, round(pain), tolerance=TARGET_PRESSURE_TOLERANCE,
+                                     hold_s=TARGET_PRESSURE_HOLD_TIME_SEC, output_level=outputLevel, param=5,
+                                     timeout_s=TARGET_PRESSURE_TIMEOUT_SEC,
+                                     on_done=lambda hold: self.pain_done_signal.emit())
+            self.pump.sample_received.connect(self.hold.on_sample, Qt.DirectConnection)
+            self.hold.start()
+        # log time when pump starts sending data
         self.send_pump_start_command_time = datetime.datetime.now()
-        # wait a bit before next pumping
-        PyQt5.QtCore.QTimer.singleShot(5000, self.the_end)
+        if self.hold is not None:
+            # the hold ends itself, this only fires if the pump stops sending samples
+            PyQt5.QtCore.QTimer.singleShot((TARGET_PRESSURE_TIMEOUT_SEC + TARGET_PRESSURE_HOLD_TIME_SEC + 2) * 1000, self.end_hold)
+        else:
+            PyQt5.QtCore.QTimer.singleShot(TARGET_PRESSURE_HOLD_TIME_SEC * 1000, self.the_end)
+
+    def end_hold(self):
+        if self.hold is not None and self.hold.result is None:
+            print("No pump samples, pain hold stopped")
+            self.hold.stop()
+
+    def write_hold_log(self):
+        """Per-sample target vs achieved pressure of the pain hold, and a summary in the session log."""
+        self.pump.sample_received.disconnect(self.hold.on_sample)
+        hold_file_name = self.log_file_name.split(".")[0]+"_pumpHoldPain.txt"
+        self.hold.write_log(os.path.join(self.dump_path,hold_file_name))
+        summary = self.hold.summary()
+        f = open(self.log_path, "a")
+        f.write("\n\nPain hold:    "+str(summary["result"])+"\n")
+        if summary["reach_s"] is not None:
+            f.write("Pain hold reached after:    "+str(round(summary["reach_s"],1))+" s\n")
+            f.write("Pain hold within +-"+str(TARGET_PRESSURE_TOLERANCE)+":    "+str(round(summary["in_tolerance"]*100))+" %\n")
+        f.write("Pain hold max control latency:    "+str(round(summary["max_latency_ms"] or 0.0,3))+" ms\n")
+        f.close()
 
     def the_end(self):
+        if self.ended:
+            return
+        self.ended = True
         tack_widget = QWidget()
         tack_layout = QVBoxLayout()
         tack_label = QLabel("Tack")
@@ -376,36 +443,12 @@ class PresentationWidget(QMainWindow):
 
         #################################
         # WRITE PUMP DATA TO A FILE
-        # read all data that was sent by the pump
-        # pump_data= self.pumpController.read(size=self.pumpController.in_waiting)
-        # if len(pump_data) > 0:
-        #     self.pumpBytes += bytearray(pump_data)
-        #     # what the bytes look like unmodified 
-        #     self.pumpBytes = struct.unpack( "=" + "B" * len(self.pumpBytes), self.pumpBytes)
-
-        # previous_t = self.send_pump_start_command_time   
-        # if len(self.pumpBytes) != 0:   
-        #     # create files for pump data
-        #     self.pump_data_file_name = self.log_file_name.split(".")[0]+"_pumpPain.txt"
-        #     pump_data_dump = open(os.path.join(self.dump_path,self.pump_data_file_name),"w")
-        #     self.pump_Hg_data_file_name = self.log_file_name.split(".")[0]+"_pumpHgPain.txt"
-        #     pump_Hg_data_dump = open(os.path.join(self.dump_path,self.pump_Hg_data_file_name),"w")
-        #     for i in range(0,len(self.pumpBytes)):
-        #         previous_t_text = previous_t.strftime("%Y-%m-%d %H:%M:%S.%f")
-        #         row_pump_data = previous_t_text + "    " + str(self.pumpBytes[i]) + "\n"
-        #         pump_data_dump.write(row_pump_data)
-        #         row_pump_dataHg =  previous_t_text + "    " + str(float(self.pumpBytes[i])*1.01372549) + "\n"
-        #         pump_Hg_data_dump.write(row_pump_dataHg)
-        #         # pump sends value every 100ms, therefore samples should be 100ms apart
-        #         tt = previous_t + datetime.timedelta(milliseconds=SAMPLE_RATE_MS)
-        #         previous_t = tt
-        #     pump_data_dump.close()
-        #     pump_Hg_data_dump.close()
-        # else:
-        #     # print("No valid data found :(") 
-        #     pass
-        # # close serial connection
-        # self.pumpController.close()
+        self.write_pump_samples("_pumpPain", "_pumpHgPain")
+        if self.hold is not None:
+            self.write_hold_log()
+        # close serial connection
+        if self.pump is not None:
+            self.pump.close()
 #                                                              #
 # EXECUTE GUI FROM MAIN                                        #
 #                                                              #
@@ -0,0 +1,329 @@
+'''
+Closed-loop pressure hold for the cuff pump.
+
+A start frame makes the pump inflate towards its target, but where the cuff
+settles depends on the fit, on leaks and on the pump's own overshoot.
+PressureHold reads the pressure samples the pump streams every SAMPLE_RATE_MS
+and corrects the commanded target until the cuff is within tolerance of the
+wanted pressure. It then holds it there for hold_s and deflates:
+
+- command = target + kp * error + ki * integral of the error, rounded and
+  limited to target +- max_correction. A new start frame is only sent when
+  the command changes, at most one per sample. The error is integrated only
+  while the pressure is not rising and is less than max_correction away, so
+  the ramp does not wind it up. On the ramp only the integral term is used.
+- above target + overshoot the pump is stopped (it can only release pressure
+  by deflating) and started again, with the command lowered by the overshoot
+  and the integral gathered on the way up dropped, once the pressure is back
+  within tolerance
+- the target counts as reached after settle_samples samples within tolerance
+  without rising, and has to be reached within timeout_s. The hold time counts
+  from there; the result is "unstable" instead of "held" when less than
+  min_in_tolerance of the hold samples were within tolerance
+
+on_sample() runs in the pump worker thread (connect it to
+PumpController.sample_received with Qt.DirectConnection). The frame it queues
+is written in the same worker loop, so a correction leaves at most one port
+read timeout (50 ms) after its sample arrived. Every sample is logged with
+target, achieved pressure, command and the time on_sample took.
+
+    hold = PressureHold(pump, target=round(pain), hold_s=TARGET_PRESSURE_HOLD_TIME_SEC, on_done=...)
+    pump.sample_received.connect(hold.on_sample, Qt.DirectConnection)
+    hold.start()
+
+SimulatedPump has the same methods as PumpController and a simple cuff model,
+so the loop can be tried without hardware:
+
+    python pressure_control.py --target 60 --bias -5
+    python pressure_control.py --check      # pain pressures against a range of cuff offsets
+'''
+
+import time
+import random
+import datetime
+from collections import deque
+
+
+# how often the pump sends a value
+SAMPLE_RATE_MS = 100
+MAX_COMMAND = 255
+
+
+class PressureHold:
+    def __init__(self, pump, target, tolerance=2, hold_s=5, output_level=1, param=5,
+                 kp=0.3, ki=1.0, max_correction=15, overshoot=None, timeout_s=20,
+                 settle_samples=3, min_in_tolerance=0.8, on_done=None, clock=time.perf_counter):
+        """
+        - pump: PumpController or SimulatedPump
+        - target / tolerance: wanted pressure and allowed deviation (raw pump units)
+        - hold_s: how long the pressure is held once reached
+        - output_level / param: passed on in every start frame
+        - kp / ki: proportional gain and integral gain (per second) of the correction
+        - max_correction: largest difference between command and target
+        - overshoot: deflate above target + overshoot (default 2 * tolerance)
+        - timeout_s: give up if the target is not reached within this time
+        - settle_samples: consecutive samples within tolerance that count as reached
+        - min_in_tolerance: smallest fraction of hold samples within tolerance for "held"
+        - on_done: called with this object when the hold ends (from the pump thread)
+        """
+        self.pump = pump
+        self.target = target
+        self.tolerance = tolerance
+        self.hold_s = hold_s
+        self.output_level = output_level
+        self.param = param
+        self.kp = kp
+        self.ki = ki
+        self.max_correction = max_correction
+        self.overshoot = 2 * tolerance if overshoot is None else overshoot
+        self.timeout_s = timeout_s
+        self.settle_samples = settle_samples
+        self.min_in_tolerance = min_in_tolerance
+        self.on_done = on_done
+        self.clock = clock
+        self.phase = "idle"         # idle -> reach -> hold -> done
+        self.result = None          # "held", "unstable", "timeout" or "stopped"
+        self.command = None
+        self.n_commands = 0
+        # one row per sample: (time, target, pressure, command, phase, latency_ms)
+        self.log = []
+        self._integral = 0.0
+        self._recent = deque(maxlen=2)
+        self._n = 0
+        self._hold_from = None
+        self._settled = 0
+        self._deflating = False
+
+    def start(self):
+        """Send the first start frame, towards the target."""
+        self.phase = "reach"
+        self.command = self.target
+        self.pump.start_pump(self.command, self.output_level, self.param)
+        self.n_commands = 1
+
+    def stop(self):
+        """End the hold early (e.g. the participant pressed the stop key) and deflate."""
+        if self.phase in ("reach", "hold"):
+            self._finish("stopped")
+
+    def on_sample(self, t, value):
+        """Handle one pressure sample (raw units), t = its timestamp."""
+        if self.phase not in ("reach", "hold"):
+            return
+        t0 = self.clock()
+        self._n += 1
+        elapsed_s = self._n * SAMPLE_RATE_MS / 1000.0
+        error = self.target - value
+        # compared over two samples, so the sensor noise does not stop a ramp
+        rising = len(self._recent) == 2 and value > self._recent[0]
+        if self.phase == "reach":
+            # passing through the tolerance band on the way up is not reaching it
+            self._settled = self._settled + 1 if abs(error) <= self.tolerance and not rising else 0
+            if self._settled >= self.settle_samples:
+                self.phase = "hold"
+                self._hold_from = elapsed_s
+        if self._deflating:
+            # the pressure keeps falling until the start frame takes effect
+            if value <= self.target + self.tolerance:
+                self._deflating = False
+                self._send(self.command)
+        elif value > self.target + self.overshoot:
+            self._deflating = True
+            self.pump.stop_pump()
+            self.n_commands += 1
+            # what the integral gathered on the way up caused this, drop it and
+            # inflate to less than the target after the deflation instead
+            if self.ki:
+                self._integral = max(-self.max_correction / self.ki, min(0.0, self._integral) + error / self.ki)
+            self.command = max(0, min(MAX_COMMAND, int(round(self.target + self.ki * self._integral))))
+        else:
+            # errors larger than max_correction are the ramp or a deflation, not an offset of the cuff
+            if len(self._recent) == 2 and not rising and abs(error) <= self.max_correction:
+                self._integral += error * SAMPLE_RATE_MS / 1000.0
+                # anti-windup: the integral alone never asks for more than max_correction
+                limit = self.max_correction / self.ki if self.ki else 0.0
+                self._integral = max(-limit, min(limit, self._integral))
+            correction = self.ki * self._integral
+            if self.phase == "hold":
+                # on the ramp the error is the whole distance to go, a proportional
+                # term on it would only command the pump past the target
+                correction += self.kp * error
+            correction = max(-self.max_correction, min(self.max_correction, correction))
+            command = max(0, min(MAX_COMMAND, int(round(self.target + correction))))
+            if command != self.command:
+                self._send(command)
+        self._recent.append(value)
+        self.log.append((t, self.target, value, self.command, self.phase, (self.clock() - t0) * 1000.0))
+        if self.phase == "hold" and elapsed_s - self._hold_from >= self.hold_s:
+            self._finish("held" if self.summary()["in_tolerance"] >= self.min_in_tolerance else "unstable")
+        elif self.phase == "reach" and elapsed_s >= self.timeout_s:
+            self._finish("timeout")
+
+    def _send(self, command):
+        self.command = command
+        # the samples of this pressure trace are kept, only the target changes
+        self.pump.start_pump(command, self.output_level, self.param, clear_samples=False)
+        self.n_commands += 1
+
+    def _finish(self, result):
+        self.phase = "done"
+        self.result = result
+        self.pump.stop_pump()
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def summary(self):
+        """
+        dict with result, reach_s (time until the pressure settled within tolerance),
+        hold statistics (in_tolerance fraction, rms_error, max_error), n_commands
+        and max_latency_ms.
+        """
+        held = [p - target for _, target, p, _, phase, _ in self.log if phase == "hold"]
+        return {
+            "result": self.result,
+            "reach_s": self._hold_from,
+            "in_tolerance": sum(abs(e) <= self.tolerance for e in held) / len(held) if held else 0.0,
+            "rms_error": (sum(e * e for e in held) / len(held)) ** 0.5 if held else None,
+            "max_error": max((abs(e) for e in held), default=None),
+            "n_commands": self.n_commands,
+            "max_latency_ms": max((row[5] for row in self.log), default=None),
+        }
+
+    def write_log(self, path):
+        """Write the per-sample log: time, target, achieved, command (raw units), phase, latency in ms."""
+        with open(path, "w") as f:
+            f.write("time    target    achieved    command    phase    latency_ms\n")
+            for t, target, p, command, phase, latency_ms in self.log:
+                t_text = t.strftime("%Y-%m-%d %H:%M:%S.%f") if isinstance(t, datetime.datetime) else str(t)
+                f.write(f"{t_text}    {target}    {p}    {command}    {phase}    {latency_ms:.3f}\n")
+
+
+# =============================================================================
+# SIMULATED PUMP
+# =============================================================================
+class SimulatedPump:
+    """
+    Cuff and pump model with the PumpController methods, for testing PressureHold.
+
+    - inflates at rate_per_s / output_level raw units per second until the
+      pressure reaches the commanded target + bias (fit of the cuff, sensor offset)
+    - loses leak_per_s raw units per second while not inflating
+    - a stop frame deflates with time constant deflate_s
+    - frames take effect latency_samples samples after they are sent
+    - every SAMPLE_RATE_MS a rounded value (+ gaussian noise) goes to every listener
+
+    run(seconds) advances simulated time without sleeping.
+    """
+
+    def __init__(self, rate_per_s=20.0, bias=-4.0, leak_per_s=0.5, deflate_s=1.0, noise=0.4,
+                 latency_samples=1, seed=0):
+        self.rate_per_s = rate_per_s
+        self.bias = bias
+        self.leak_per_s = leak_per_s
+        self.deflate_s = deflate_s
+        self.noise = noise
+        self.latency_samples = latency_samples
+        self.pressure = 0.0
+        self.listeners = []
+        self.frames = []                # (sample number, frame) of every frame sent
+        self._rng = random.Random(seed)
+        self._pending = deque()         # (due sample, frame)
+        self._target = None             # None = deflating
+        self._rate = 0.0
+        self._n = 0
+        self._t0 = datetime.datetime(2000, 1, 1)
+        self._samples = []
+
+    def start_pump(self, target, output_level, param=1, clear_samples=True):
+        if clear_samples:
+            self._samples = []
+        self._queue(("start", int(target), int(output_level)))
+
+    def stop_pump(self, key_time=None):
+        self._queue(("stop",))
+        return 0.0
+
+    def samples(self):
+        return list(self._samples)
+
+    def _queue(self, frame):
+        self.frames.append((self._n, frame))
+        self._pending.append((self._n + self.latency_samples, frame))
+
+    def run(self, seconds):
+        dt = SAMPLE_RATE_MS / 1000.0
+        for _ in range(int(round(seconds / dt))):
+            while self._pending and self._pending[0][0] <= self._n:
+                frame = self._pending.popleft()[1]
+                if frame[0] == "start":
+                    self._target = frame[1] + self.bias
+                    self._rate = self.rate_per_s / max(1, frame[2])
+                else:
+                    self._target = None
+            if self._target is None:
+                self.pressure -= self.pressure * min(1.0, dt / self.deflate_s)
+            elif self.pressure < self._target:
+                self.pressure = min(self._target, self.pressure + self._rate * dt)
+            else:
+                self.pressure = max(0.0, self.pressure - self.leak_per_s * dt)
+            self._n += 1
+            value = max(0, min(MAX_COMMAND, int(round(self.pressure + self._rng.gauss(0, self.noise)))))
+            t = self._t0 + datetime.timedelta(milliseconds=SAMPLE_RATE_MS * self._n)
+            self._samples.append((t, value))
+            for listener in list(self.listeners):
+                listener(t, value)
+
+
+def simulate(target, seconds=30, hold_kwargs=None, **pump_kwargs):
+    """Run a PressureHold against a SimulatedPump, returns the hold."""
+    pump = SimulatedPump(**pump_kwargs)
+    hold = PressureHold(pump, target, **(hold_kwargs or {}))
+    pump.listeners.append(hold.on_sample)
+    hold.start()
+    pump.run(seconds)
+    return hold
+
+
+def check(targets=(60, 120, 200), biases=(-6, -4, 0, 2, 4, 6), **hold_kwargs):
+    """
+    Simulated holds for every target and cuff offset, returns the ones that did
+    not end "held" with at least min_in_tolerance: [(target, bias, summary)].
+    """
+    failed = []
+    for target in targets:
+        for bias in biases:
+            hold = simulate(target, hold_kwargs=hold_kwargs, bias=bias)
+            summary = hold.summary()
+            if summary["result"] != "held" or summary["in_tolerance"] < hold.min_in_tolerance:
+                failed.append((target, bias, summary))
+    return failed
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description="Closed-loop pressure hold against the simulated pump")
+    parser.add_argument("--target", type=int, default=60)
+    parser.add_argument("--tolerance", type=float, default=2)
+    parser.add_argument("--hold", type=float, default=5, help="hold time in s")
+    parser.add_argument("--bias", type=float, default=-4.0, help="where the pump settles against its target")
+    parser.add_argument("--leak", type=float, default=0.5, help="raw units per second")
+    parser.add_argument("--log", default=None, help="write the per-sample log here")
+    parser.add_argument("--check", action="store_true", help="hold targets 60, 120 and 200 against offsets -6 to +6")
+    args = parser.parse_args()
+    if args.check:
+        failed = check(tolerance=args.tolerance, hold_s=args.hold)
+        for target, bias, summary in failed:
+            print(f"target {target} bias {bias:+}: {summary['result']}, in_tolerance {summary['in_tolerance']:.3f}")
+        print("ok" if not failed else f"{len(failed)} holds failed")
+        sys.exit(1 if failed else 0)
+    hold = simulate(args.target, hold_kwargs={"tolerance": args.tolerance, "hold_s": args.hold},
+                    bias=args.bias, leak_per_s=args.leak)
+    open_loop = SimulatedPump(bias=args.bias, leak_per_s=args.leak)
+    open_loop.start_pump(args.target, 1)
+    open_loop.run(10)
+    print(f"open loop after 10 s: {open_loop.samples()[-1][1]} (target {args.target})")
+    for key, value in hold.summary().items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+    if args.log:
+        hold.write_log(args.log)
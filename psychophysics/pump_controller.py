@@ -0,0 +1,152 @@
+import time
+import queue
+import threading
+import datetime
+import serial
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+# baudrate from pump spec file
+BAUDRATE = 115200
+# how often pump sends a value
+SAMPLE_RATE_MS = 100
+# from  pump spec file: 1 = start code  , 255 = stop code
+COMMAND_START_CODE = 1
+COMMAND_STOP_CODE = 255
+# raw pump value -> mmHg
+RAW_TO_MMHG = 1.01372549
+
+STOP_FRAME = bytes([ord('S'), COMMAND_STOP_CODE, 0, 0, 0, 0])
+
+
+def start_frame(target, output_level, param):
+    """
+    Build the 6-byte start frame for the pump.
+
+    - target: target pressure (raw pump units, 0-255)
+    - output_level: rate of inflation, i.e. how many seconds the motor stays on
+      each step before accelerating again
+    - param: 5th byte of the frame as given in the pump spec file
+    """
+    return bytes([ord('S'), COMMAND_START_CODE, int(target), int(output_level), int(param), 0])
+
+
+class PumpController(QThread):
+    """
+    Owns the serial connection to the pump and runs all serial I/O off the GUI thread.
+
+    - start_pump() queues a start frame, written by the worker in a single write
+    - stop_pump() is the priority path: it drops queued frames, flushes pending
+      output and writes the stop frame directly, without waiting for the worker
+    - every byte sent back by the pump is timestamped and emitted as sample_received
+    """
+
+    sample_received = pyqtSignal(object, int)   # (datetime, raw value)
+    stop_sent = pyqtSignal(float)               # keypress-to-stop-byte latency in ms
+    error = pyqtSignal(str)
+
+    def __init__(self, port, baudrate=BAUDRATE, parent=None):
+        super(PumpController, self).__init__(parent)
+        self.port = port
+        self.baudrate = baudrate
+        self.ser = None
+        self._frames = queue.Queue()
+        self._write_lock = threading.Lock()
+        self._running = False
+        self._samples = []
+        self._samples_lock = threading.Lock()
+        self.last_stop_latency_ms = None
+
+    # =========================================================================
+    # CONNECTION HANDLING
+    # =========================================================================
+    def open(self):
+        """Open the port once for the whole session and start the worker."""
+        self.ser = serial.Serial(self.port, self.baudrate, timeout=0.05, write_timeout=0.5)
+        self._running = True
+        self.start()
+
+    def close(self):
+        """Stop the worker and close the port."""
+        self._running = False
+        self.wait(1000)
+        if self.ser and self.ser.is_open:
+            self.ser.close()
+
+    # =========================================================================
+    # COMMANDS
+    # =========================================================================
+    def start_pump(self, target, output_level, param=1, clear_samples=True):
+        """
+        Queue a start frame and clear samples collected in the previous trial.
+
+        - clear_samples: False for a new target within the same trial
+          (corrections of pressure_control.PressureHold)
+        """
+        if clear_samples:
+            with self._samples_lock:
+                self._samples = []
+        self._frames.put(start_frame(target, output_level, param))
+
+    def stop_pump(self, key_time=None):
+        """
+        Send the stop frame immediately from the calling thread.
+
+        - key_time: time.perf_counter() value taken when the key was pressed;
+          if given, the keypress-to-stop-byte latency is returned (ms)
+        """
+        if key_time is None:
+            key_time = time.perf_counter()
+        with self._write_lock:
+            # drop anything that has not been sent yet
+            while True:
+                try:
+                    self._frames.get_nowait()
+                except queue.Empty:
+                    break
+            if self.ser is None or not self.ser.is_open:
+                raise ConnectionError("Pump port not open")
+            self.ser.reset_output_buffer()
+            self.ser.write(STOP_FRAME)
+            latency_ms = (time.perf_counter() - key_time) * 1000.0
+        self.last_stop_latency_ms = latency_ms
+        self.stop_sent.emit(latency_ms)
+        return latency_ms
+
+    def samples(self):
+        """Return the (datetime, raw value) samples received since the last start."""
+        with self._samples_lock:
+            return list(self._samples)
+
+    # =========================================================================
+    # WORKER LOOP
+    # =========================================================================
+    def run(self):
+        while self._running:
+            try:
+                # taken and written under the lock stop_pump() drains the queue with,
+                # so a start frame queued before a stop is never written after it
+                with self._write_lock:
+                    try:
+                        frame = self._frames.get_nowait()
+                    except queue.Empty:
+                        frame = None
+                    if frame is not None:
+                        self.ser.write(frame)
+                # blocks for at most the port timeout
+                data = self.ser.read(self.ser.in_waiting or 1)
+                if data:
+                    self._store(data)
+            except serial.SerialException as e:
+                self._running = False
+                self.error.emit(str(e))
+
+    def _store(self, data):
+        # bytes that arrived together are back-dated at the pump sample rate
+        now = datetime.datetime.now()
+        n = len(data)
+        with self._samples_lock:
+            for i, value in enumerate(data):
+                t = now - datetime.timedelta(milliseconds=SAMPLE_RATE_MS * (n - 1 - i))
+                self._samples.append((t, value))
+                self.sample_received.emit(t, value)
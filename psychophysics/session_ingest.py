@@ -0,0 +1,572 @@
+'''
+Offline ingestion of session output into one columnar dataset.
+
+Reads everything the experiment scripts leave behind under a root folder
+(searched recursively, so several lab machines can be copied side by side):
+
+    _PUMP_THRESHOLD_LOGs/<id>_participant_<YYYY_mm_dd_HH_MM_SS>.txt     session log (pain_threshold_no_dev.py)
+    _PUMP_THRESHOLD_LOGs/<log>_pumpTrialN.txt / _pumpAdaptiveN / _pumpPain   pump samples (raw units)
+    data/<YYYY-mm-dd_HH-MM-SS>_<code>_info.csv                        session details (vas_only.py)
+    data/<...>_vas-data.bin / _pleasantness-data.bin                   ratings (session_store.py)
+    data/<...>_vas-data.csv / _pleasantness-data.csv                   ratings, used when there is no .bin
+
+The _pumpHg* files are skipped, they are the raw samples times RAW_TO_MMHG.
+Files are parsed in parallel in a process pool. Every table is stored as one
+.npy file per column, so a query only reads the columns it needs:
+
+    <dataset>/manifest.json                   ingested files (size, mtime, source id, chunk)
+    <dataset>/chunks/<n>/<table>/<column>.npy
+    <dataset>/sessions/<column>.npy           joined per-session table, rebuilt on every ingest
+
+Tables: pump_sessions, thresholds, pump_samples, vas_sessions, vas and sessions.
+Every row carries the participant and session it belongs to. Participants are
+joined on the number in the code ("P07" and participant id 7 are both "7");
+a VAS session is joined with the last pump session of the same participant on
+the same day that started before it.
+
+Ingesting again only parses new files. Changed or deleted files have their
+rows removed from the chunks that hold them before the new rows are added.
+
+    python session_ingest.py <root> <dataset> [--workers N]
+
+    from session_ingest import Dataset
+    ds = Dataset("dataset")
+    sessions = ds.table("sessions")
+    baseline = sessions["condition"] == "baseline"
+    print(sessions["pain_threshold"][baseline].mean())
+'''
+
+import os
+import re
+import sys
+import json
+import shutil
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+MANIFEST = "manifest.json"
+MAX_CHUNKS = 32             # more chunks than this are merged into one on ingest
+
+# column name -> dtype, "U" are strings
+SCHEMA = {
+    "pump_sessions": [("source", "i8"), ("participant", "U"), ("session", "U"), ("date", "U"),
+                      ("n_trials", "i8"), ("threshold_mean", "f8"), ("n_adaptive", "i8"),
+                      ("psi_threshold", "f8"), ("psi_sd", "f8"), ("stop_latency_ms", "f8"),
+                      ("pain_threshold", "f8"), ("pain_threshold_mmhg", "f8")],
+    # kind is "ramp" (level = threshold at the keypress) or "adaptive" (painful = 1 / 0, else -1)
+    "thresholds": [("source", "i8"), ("participant", "U"), ("session", "U"), ("kind", "U"),
+                   ("trial", "i8"), ("level", "f8"), ("painful", "i8"),
+                   ("estimate", "f8"), ("sd", "f8"), ("stop_latency_ms", "f8")],
+    # trace is "Trial1", "Adaptive2", "Pain", ...; t is seconds since the epoch
+    "pump_samples": [("source", "i8"), ("participant", "U"), ("session", "U"), ("trace", "U"),
+                     ("t", "f8"), ("raw", "f8")],
+    "vas_sessions": [("source", "i8"), ("participant", "U"), ("session", "U"), ("date", "U"),
+                     ("code", "U"), ("condition", "U"), ("site", "U"), ("language", "U"),
+                     ("repeats", "i8")],
+    # task is "vas" or "pleasantness", the two ratings in the order vas_only.py stores them
+    "vas": [("source", "i8"), ("participant", "U"), ("session", "U"), ("task", "U"),
+            ("trial", "i8"), ("wall_time", "f8"), ("onset", "f8"), ("rating_time", "f8"),
+            ("intensity", "f8"), ("pleasantness", "f8")],
+    "sessions": [("participant", "U"), ("date", "U"), ("pump_session", "U"), ("vas_session", "U"),
+                 ("condition", "U"), ("threshold_mean", "f8"), ("psi_threshold", "f8"),
+                 ("pain_threshold", "f8"), ("pain_threshold_mmhg", "f8"), ("n_ratings", "i8"),
+                 ("mean_intensity", "f8"), ("mean_pleasantness", "f8")],
+}
+CHUNK_TABLES = ["pump_sessions", "thresholds", "pump_samples", "vas_sessions", "vas"]
+
+TS = r"\d{4}_\d\d_\d\d_\d\d_\d\d_\d\d"
+PUMP_LOG_RE = re.compile(r"^(?P<pid>.+)_participant_(?P<ts>" + TS + r")\.txt$")
+PUMP_SAMPLES_RE = re.compile(r"^(?P<pid>.+)_participant_(?P<ts>" + TS + r")_pump(?P<trace>Trial\d+|Adaptive\d+|Pain)\.txt$")
+VAS_TS = r"\d{4}-\d\d-\d\d_\d\d-\d\d-\d\d"
+VAS_INFO_RE = re.compile(r"^(?P<ts>" + VAS_TS + r")_(?P<code>.+)_info\.csv$")
+VAS_DATA_RE = re.compile(r"^(?P<ts>" + VAS_TS + r")_(?P<code>.+)_(?P<task>vas|pleasantness)-data\.(?P<ext>bin|csv)$")
+
+THRESHOLD_RE = re.compile(r"^Threshold (\d+):\s+(-?[\d.]+)$")
+LATENCY_RE = re.compile(r"^Stop latency (\d+):\s+(-?[\d.]+) ms")
+ADAPTIVE_RE = re.compile(r"^Adaptive (\d+):\s+level (-?[\d.]+) -> (painful|not painful), "
+                         r"threshold estimate (-?[\d.]+) \+- (-?[\d.]+)")
+PAIN_RE = re.compile(r"^Pain Threshold:\s+(-?[\d.]+)( mmHg)?$")
+
+
+def participant_key(code):
+    """Join key of a participant: the number in the code without leading zeros, else the lower-case code."""
+    m = re.search(r"\d+", str(code))
+    return str(int(m.group())) if m else str(code).strip().lower()
+
+
+def classify(name):
+    """Kind of session file ("pump_log", "pump_samples", "vas_info", "vas_data") or None."""
+    if PUMP_SAMPLES_RE.match(name):
+        return "pump_samples"
+    if PUMP_LOG_RE.match(name):
+        return "pump_log"
+    if VAS_INFO_RE.match(name):
+        return "vas_info"
+    if VAS_DATA_RE.match(name):
+        return "vas_data"
+    return None
+
+
+def find_session_files(root):
+    """Relative paths of all session files under root. A ratings .csv is dropped if its .bin exists."""
+    found = {}
+    for folder, _, names in os.walk(root):
+        for name in names:
+            kind = classify(name)
+            if kind is not None:
+                found[os.path.relpath(os.path.join(folder, name), root)] = kind
+    for rel in [r for r, kind in found.items() if kind == "vas_data" and r.endswith(".csv")]:
+        if rel[:-4] + ".bin" in found:
+            del found[rel]
+    return found
+
+
+# =============================================================================
+# PARSERS (run in the worker processes)
+# =============================================================================
+def _empty_rows():
+    return {table: {col: [] for col, _ in SCHEMA[table]} for table in CHUNK_TABLES}
+
+
+def _add_row(rows, table, **values):
+    for col, _ in SCHEMA[table]:
+        if col != "source":
+            rows[table][col].append(values[col])
+
+
+def _pump_session(ts):
+    t = datetime.datetime.strptime(ts, "%Y_%m_%d_%H_%M_%S")
+    return t.strftime("%Y-%m-%d_%H-%M-%S"), t.strftime("%Y-%m-%d")
+
+
+def _parse_pump_log(path, rows):
+    m = PUMP_LOG_RE.match(os.path.basename(path))
+    participant = participant_key(m.group("pid"))
+    session, date = _pump_session(m.group("ts"))
+    thresholds, latencies, adaptive = {}, {}, []
+    pain = pain_mmhg = float("nan")
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            m = THRESHOLD_RE.match(line)
+            if m:
+                thresholds[int(m.group(1))] = float(m.group(2))
+                continue
+            m = LATENCY_RE.match(line)
+            if m:
+                latencies[int(m.group(1))] = float(m.group(2))
+                continue
+            m = ADAPTIVE_RE.match(line)
+            if m:
+                adaptive.append((int(m.group(1)), float(m.group(2)), m.group(3) == "painful",
+                                 float(m.group(4)), float(m.group(5))))
+                continue
+            m = PAIN_RE.match(line)
+            if m:
+                if m.group(2):
+                    pain_mmhg = float(m.group(1))
+                else:
+                    pain = float(m.group(1))
+    nan = float("nan")
+    for trial, level in sorted(thresholds.items()):
+        _add_row(rows, "thresholds", participant=participant, session=session, kind="ramp", trial=trial,
+                 level=level, painful=-1, estimate=nan, sd=nan, stop_latency_ms=latencies.get(trial, nan))
+    for trial, level, painful, estimate, sd in adaptive:
+        _add_row(rows, "thresholds", participant=participant, session=session, kind="adaptive", trial=trial,
+                 level=level, painful=int(painful), estimate=estimate, sd=sd, stop_latency_ms=nan)
+    _add_row(rows, "pump_sessions", participant=participant, session=session, date=date,
+             n_trials=len(thresholds),
+             threshold_mean=float(np.mean(list(thresholds.values()))) if thresholds else nan,
+             n_adaptive=len(adaptive),
+             psi_threshold=adaptive[-1][3] if adaptive else nan,
+             psi_sd=adaptive[-1][4] if adaptive else nan,
+             stop_latency_ms=float(np.mean(list(latencies.values()))) if latencies else nan,
+             pain_threshold=pain, pain_threshold_mmhg=pain_mmhg)
+
+
+def _parse_pump_samples(path, rows):
+    m = PUMP_SAMPLES_RE.match(os.path.basename(path))
+    participant = participant_key(m.group("pid"))
+    session, _ = _pump_session(m.group("ts"))
+    out = rows["pump_samples"]
+    n = 0
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != 3:
+                continue
+            try:
+                t = datetime.datetime.fromisoformat(parts[0] + " " + parts[1]).timestamp()
+                value = float(parts[2])
+            except ValueError:
+                continue
+            out["t"].append(t)
+            out["raw"].append(value)
+            n += 1
+    out["participant"].extend([participant] * n)
+    out["session"].extend([session] * n)
+    out["trace"].extend([m.group("trace")] * n)
+
+
+def _parse_vas_info(path, rows):
+    m = VAS_INFO_RE.match(os.path.basename(path))
+    info = {}
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            key, _, value = line.rstrip("\r\n").partition(",")
+            # keys are numbered ("02. Condition"), match on the name only
+            info[key.split(".", 1)[-1].strip().lower()] = value.strip()
+    try:
+        repeats = int(float(info.get("number of repeats", "")))
+    except ValueError:
+        repeats = -1
+    code = info.get("participant code", m.group("code"))
+    _add_row(rows, "vas_sessions", participant=participant_key(code), session=m.group("ts"),
+             date=m.group("ts")[:10], code=code, condition=info.get("condition", ""),
+             site=info.get("stimulation site", ""), language=info.get("participant language", ""),
+             repeats=repeats)
+
+
+def _rating(text):
+    try:
+        return float(text)
+    except ValueError:
+        # "None" for a missing rating
+        return float("nan")
+
+
+def _parse_vas_data(path, rows):
+    m = VAS_DATA_RE.match(os.path.basename(path))
+    participant, session, task = participant_key(m.group("code")), m.group("ts"), m.group("task")
+    nan = float("nan")
+    if m.group("ext") == "bin":
+        from session_store import read_records
+        # read-only, ingest never changes (or creates) a session file
+        records = read_records(path)
+        for rec in records:
+            _add_row(rows, "vas", participant=participant, session=session, task=task, trial=rec["trial"],
+                     wall_time=rec["wall_time"], onset=rec["onset"], rating_time=rec["rating_time"],
+                     intensity=rec["intensity"], pleasantness=rec["pleasantness"])
+        return
+    with open(path, encoding="utf-8", errors="replace") as f:
+        lines = f.read().splitlines()[1:]
+    for trial, line in enumerate(lines, start=1):
+        values = line.split(",")
+        if len(values) < 2:
+            continue
+        _add_row(rows, "vas", participant=participant, session=session, task=task, trial=trial,
+                 wall_time=nan, onset=nan, rating_time=nan,
+                 intensity=_rating(values[0]), pleasantness=_rating(values[1]))
+
+
+PARSERS = {
+    "pump_log": _parse_pump_log,
+    "pump_samples": _parse_pump_samples,
+    "vas_info": _parse_vas_info,
+    "vas_data": _parse_vas_data,
+}
+
+
+def parse_file(path, kind):
+    """Rows of one session file as {table: {column: list}} (without the source column)."""
+    rows = _empty_rows()
+    PARSERS[kind](path, rows)
+    return rows
+
+
+def _parse_job(job):
+    rel, path, kind = job
+    try:
+        return rel, parse_file(path, kind), None
+    except Exception as e:
+        return rel, None, f"{type(e).__name__}: {e}"
+
+
+# =============================================================================
+# COLUMNS
+# =============================================================================
+def _to_array(values, dtype):
+    if dtype == "U":
+        return np.array(values, dtype=str) if len(values) else np.zeros(0, dtype="<U1")
+    return np.array(values, dtype=dtype)
+
+
+def _concat(arrays, dtype):
+    arrays = [a for a in arrays if len(a)]
+    if not arrays:
+        return _to_array([], dtype)
+    return np.concatenate(arrays)
+
+
+def _write_table(folder, columns):
+    os.makedirs(folder, exist_ok=True)
+    for col, values in columns.items():
+        np.save(os.path.join(folder, col + ".npy"), values)
+
+
+def _read_table(folder, table, columns=None, mmap=True):
+    names = columns if columns is not None else [col for col, _ in SCHEMA[table]]
+    dtypes = dict(SCHEMA[table])
+    out = {}
+    for col in names:
+        if col not in dtypes:
+            raise KeyError(f"No column {col} in table {table}")
+        path = os.path.join(folder, col + ".npy")
+        out[col] = np.load(path, mmap_mode="r" if mmap else None) if os.path.exists(path) else _to_array([], dtypes[col])
+    return out
+
+
+# =============================================================================
+# DATASET
+# =============================================================================
+class Dataset:
+    def __init__(self, path):
+        """Open (or start) a dataset directory."""
+        self.path = path
+        manifest = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"version": 1, "next_source": 0, "next_chunk": 0, "files": {}}
+
+    @property
+    def files(self):
+        """Ingested files: relative path -> {"size", "mtime_ns", "source", "chunk"}."""
+        return self.manifest["files"]
+
+    def chunks(self):
+        folder = os.path.join(self.path, "chunks")
+        if not os.path.isdir(folder):
+            return []
+        return sorted(os.listdir(folder))
+
+    # =========================================================================
+    # QUERIES
+    # =========================================================================
+    def table(self, name, columns=None):
+        """
+        All rows of a table as {column: array}.
+
+        - columns: only load these columns (default: all)
+        Single-chunk columns are memory-mapped, otherwise the chunks are concatenated.
+        """
+        if name not in SCHEMA:
+            raise KeyError(f"Unknown table {name}, one of {', '.join(SCHEMA)}")
+        if name == "sessions":
+            return _read_table(os.path.join(self.path, "sessions"), name, columns)
+        parts = [_read_table(os.path.join(self.path, "chunks", c, name), name, columns) for c in self.chunks()]
+        dtypes = dict(SCHEMA[name])
+        names = columns if columns is not None else [col for col, _ in SCHEMA[name]]
+        if len(parts) == 1:
+            return parts[0]
+        return {col: _concat([p[col] for p in parts], dtypes[col]) for col in names}
+
+    def count(self, name):
+        return len(self.table(name, ["source"] if name != "sessions" else ["participant"]).popitem()[1])
+
+    # =========================================================================
+    # INGEST
+    # =========================================================================
+    def ingest(self, root, workers=None, log=print):
+        """
+        Parse the session files under root that are new or changed since the last ingest.
+
+        - workers: size of the process pool (default: CPU count)
+        Returns the number of files parsed. Files that fail to parse are reported and
+        retried on the next ingest.
+        """
+        found = find_session_files(root)
+        stats = {}
+        for rel in found:
+            st = os.stat(os.path.join(root, rel))
+            stats[rel] = (st.st_size, st.st_mtime_ns)
+        stale = [rel for rel, entry in self.files.items()
+                 if stats.get(rel) != (entry["size"], entry["mtime_ns"])]
+        todo = [rel for rel in sorted(found) if rel not in self.files or rel in stale]
+
+        if stale:
+            self._drop_sources({self.files[rel]["source"] for rel in stale})
+            for rel in stale:
+                del self.files[rel]
+
+        results = []
+        if todo:
+            jobs = [(rel, os.path.join(root, rel), found[rel]) for rel in todo]
+            workers = workers or os.cpu_count() or 1
+            if workers == 1 or len(jobs) == 1:
+                results = [_parse_job(job) for job in jobs]
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    chunksize = max(1, len(jobs) // (4 * workers))
+                    results = list(pool.map(_parse_job, jobs, chunksize=chunksize))
+
+        parsed = [(rel, rows) for rel, rows, error in results if error is None]
+        for rel, _, error in results:
+            if error is not None and log:
+                log(f"{rel}: not ingested ({error})")
+        if parsed:
+            self._write_chunk(parsed, stats)
+        if len(self.chunks()) > MAX_CHUNKS:
+            self.compact()
+        if parsed or stale:
+            self._build_sessions()
+        self._save_manifest()
+        if log:
+            log(f"{len(parsed)} files ingested, {len(stale)} changed or removed, {len(self.files)} in {self.path}")
+        return len(parsed)
+
+    def compact(self):
+        """Merge all chunks into one."""
+        chunks = self.chunks()
+        if len(chunks) <= 1:
+            return
+        merged = {table: self.table(table) for table in CHUNK_TABLES}
+        name = self._new_chunk_name()
+        tmp = os.path.join(self.path, "chunks", name + ".tmp")
+        for table, columns in merged.items():
+            _write_table(os.path.join(tmp, table), columns)
+        del merged
+        os.replace(tmp, os.path.join(self.path, "chunks", name))
+        for old in chunks:
+            shutil.rmtree(os.path.join(self.path, "chunks", old))
+        for entry in self.files.values():
+            entry["chunk"] = name
+        self._save_manifest()
+
+    # =========================================================================
+    # INTERNALS
+    # =========================================================================
+    def _new_chunk_name(self):
+        name = f"{self.manifest['next_chunk']:05d}"
+        self.manifest["next_chunk"] += 1
+        return name
+
+    def _write_chunk(self, parsed, stats):
+        name = self._new_chunk_name()
+        columns = {table: {col: [] for col, _ in SCHEMA[table]} for table in CHUNK_TABLES}
+        for rel, rows in parsed:
+            source = self.manifest["next_source"]
+            self.manifest["next_source"] += 1
+            for table in CHUNK_TABLES:
+                n = len(rows[table]["participant"])
+                if n == 0:
+                    continue
+                columns[table]["source"].append(np.full(n, source, dtype="i8"))
+                for col, dtype in SCHEMA[table][1:]:
+                    columns[table][col].append(_to_array(rows[table][col], dtype))
+            size, mtime_ns = stats[rel]
+            self.files[rel] = {"size": size, "mtime_ns": mtime_ns, "source": source, "chunk": name}
+        tmp = os.path.join(self.path, "chunks", name + ".tmp")
+        for table in CHUNK_TABLES:
+            dtypes = dict(SCHEMA[table])
+            _write_table(os.path.join(tmp, table),
+                         {col: _concat(arrays, dtypes[col]) for col, arrays in columns[table].items()})
+        os.replace(tmp, os.path.join(self.path, "chunks", name))
+
+    def _drop_sources(self, sources):
+        """Rewrite the chunks holding rows of the given sources without them."""
+        chunks = {entry["chunk"] for entry in self.files.values() if entry["source"] in sources}
+        drop = np.array(sorted(sources), dtype="i8")
+        for chunk in chunks:
+            folder = os.path.join(self.path, "chunks", chunk)
+            for table in CHUNK_TABLES:
+                columns = _read_table(os.path.join(folder, table), table, mmap=False)
+                keep = ~np.isin(columns["source"], drop)
+                if not keep.all():
+                    _write_table(os.path.join(folder, table), {col: a[keep] for col, a in columns.items()})
+
+    def _build_sessions(self):
+        """Join pump sessions, VAS session details and rating means on participant and day."""
+        pump = self.table("pump_sessions")
+        info = self.table("vas_sessions")
+        vas = self.table("vas", ["participant", "session", "intensity", "pleasantness"])
+
+        # mean ratings per (participant, VAS session)
+        ratings = {}
+        if len(vas["session"]):
+            keys = np.char.add(np.char.add(vas["participant"].astype(str), "|"), vas["session"].astype(str))
+            uniq, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse, minlength=len(uniq))
+            means = []
+            for col in ("intensity", "pleasantness"):
+                values = np.asarray(vas[col], dtype=float)
+                valid = ~np.isnan(values)
+                sums = np.bincount(inverse[valid], weights=values[valid], minlength=len(uniq))
+                n = np.bincount(inverse[valid], minlength=len(uniq))
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    means.append(sums / n)
+            for i, key in enumerate(uniq):
+                ratings[str(key)] = (int(counts[i]), float(means[0][i]), float(means[1][i]))
+
+        # pump sessions per (participant, day), in start order
+        by_day = {}
+        for i in np.argsort(pump["session"], kind="stable"):
+            by_day.setdefault((str(pump["participant"][i]), str(pump["date"][i])), []).append(int(i))
+
+        nan = float("nan")
+        out = {col: [] for col, _ in SCHEMA["sessions"]}
+
+        def add(participant, date, p, v):
+            out["participant"].append(participant)
+            out["date"].append(date)
+            out["pump_session"].append("" if p is None else str(pump["session"][p]))
+            out["vas_session"].append("" if v is None else str(info["session"][v]))
+            out["condition"].append("" if v is None else str(info["condition"][v]))
+            for col in ("threshold_mean", "psi_threshold", "pain_threshold", "pain_threshold_mmhg"):
+                out[col].append(nan if p is None else float(pump[col][p]))
+            key = "" if v is None else f"{participant}|{info['session'][v]}"
+            n, intensity, pleasantness = ratings.get(key, (0, nan, nan))
+            out["n_ratings"].append(n)
+            out["mean_intensity"].append(intensity)
+            out["mean_pleasantness"].append(pleasantness)
+
+        used = set()
+        for v in np.argsort(info["session"], kind="stable"):
+            participant, date, session = str(info["participant"][v]), str(info["date"][v]), str(info["session"][v])
+            candidates = by_day.get((participant, date), [])
+            before = [p for p in candidates if str(pump["session"][p]) <= session]
+            p = before[-1] if before else (candidates[0] if candidates else None)
+            if p is not None:
+                used.add(p)
+            add(participant, date, p, int(v))
+        for (participant, date), candidates in sorted(by_day.items()):
+            for p in candidates:
+                if p not in used:
+                    add(participant, date, p, None)
+
+        dtypes = dict(SCHEMA["sessions"])
+        folder = os.path.join(self.path, "sessions")
+        tmp = folder + ".tmp"
+        _write_table(tmp, {col: _to_array(values, dtypes[col]) for col, values in out.items()})
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.replace(tmp, folder)
+
+    def _save_manifest(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog="python session_ingest.py",
+                                     description="Ingest session logs and ratings into a columnar dataset")
+    parser.add_argument("root", help="folder with _PUMP_THRESHOLD_LOGs / data folders (searched recursively)")
+    parser.add_argument("dataset", help="dataset folder, created or updated")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes (default: CPU count)")
+    parser.add_argument("--compact", action="store_true", help="merge all chunks into one afterwards")
+    args = parser.parse_args()
+    ds = Dataset(args.dataset)
+    ds.ingest(args.root, workers=args.workers)
+    if args.compact:
+        ds.compact()
+    for table in SCHEMA:
+        print(f"{table:14s} {ds.count(table)} rows")
+    sys.exit(0)
@@ -0,0 +1,251 @@
+'''
+Crash-safe, append-only store for trial ratings.
+
+Records have a fixed 64-byte layout and are written into a preallocated,
+memory-mapped file, so appending one inside the frame loop is a plain memory
+copy. A background thread flushes dirty pages to disk in batches. Each record
+carries a CRC, so after an abrupt end the valid trials are recovered by
+scanning until the first record that does not check out.
+
+Usage:
+    store = SessionStore("data/P00_vas-data.bin")
+    store.append(trial, onset, rating_time, intensity, pleasantness, stimulus_hash("stim_a"))
+    store.export_csv("data/P00_vas-data.csv")
+    store.close()
+
+Read a store without opening it for writing (never creates or changes the file):
+    records = read_records("data/P00_vas-data.bin")
+
+Recover a session from the command line:
+    python session_store.py data/P00_vas-data.bin [out.csv]
+'''
+
+import os
+import sys
+import mmap
+import time
+import zlib
+import struct
+import hashlib
+import threading
+
+
+MAGIC = b"VASSTOR1"
+VERSION = 1
+# magic, version, record size, reserved
+HEADER = struct.Struct("<8sIIQ")
+HEADER_SIZE = 64
+# trial, wall time, onset, rating time, stimulus hash, intensity, pleasantness, crc32
+RECORD = struct.Struct("<Iddd16sddI")
+FIELDS = ["trial", "wall_time", "onset", "rating_time", "stimulus_hash", "intensity", "pleasantness"]
+VAS_HEADER = "intensity-rating,pleasantness-rating"
+
+
+def stimulus_hash(stimulus):
+    """16-byte digest identifying a stimulus (bytes, str, or anything with a stable repr)."""
+    if isinstance(stimulus, str):
+        stimulus = stimulus.encode("utf-8")
+    elif not isinstance(stimulus, (bytes, bytearray)):
+        stimulus = repr(stimulus).encode("utf-8")
+    return hashlib.blake2b(stimulus, digest_size=16).digest()
+
+
+def _fmt(value):
+    # same text as writing the rating with '{}'.format(), whole numbers without '.0'
+    if value != value:
+        return "None"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _check_header(mm, path):
+    magic, version, record_size, _ = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError(f"{path} is not a session store (version {VERSION})")
+
+
+def _scan(mm):
+    """Number of records before the first one whose CRC does not check out."""
+    n = (len(mm) - HEADER_SIZE) // RECORD.size
+    for i in range(n):
+        offset = HEADER_SIZE + i * RECORD.size
+        raw = mm[offset:offset + RECORD.size]
+        if struct.unpack_from("<I", raw, RECORD.size - 4)[0] != zlib.crc32(raw[:-4]):
+            return i
+    return n
+
+
+def _records(mm, count):
+    out = []
+    for i in range(count):
+        values = RECORD.unpack_from(mm, HEADER_SIZE + i * RECORD.size)[:-1]
+        rec = dict(zip(FIELDS, values))
+        rec["stimulus_hash"] = rec["stimulus_hash"].hex()
+        out.append(rec)
+    return out
+
+
+def read_records(path):
+    """
+    Valid records of a store file as dicts (stimulus_hash as hex), opened
+    read-only: the file is never created or changed. ValueError if it is not
+    a session store (also when it is shorter than the header).
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < HEADER_SIZE:
+            raise ValueError(f"{path} is too short for a session store header")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            _check_header(mm, path)
+            return _records(mm, _scan(mm))
+
+
+def write_csv(records, csv_path, header=VAS_HEADER, full=False):
+    """
+    Write records to CSV.
+
+    - default: the existing '<intensity>,<pleasantness>' VAS data layout
+    - full=True: every field of the record
+    """
+    with open(csv_path, "w", encoding="utf-8") as f:
+        if full:
+            f.write(",".join(FIELDS) + "\n")
+            for rec in records:
+                f.write(",".join(_fmt(rec[k]) if isinstance(rec[k], float) else str(rec[k])
+                                 for k in FIELDS) + "\n")
+        else:
+            f.write(header + "\n")
+            for rec in records:
+                f.write("{},{}\n".format(_fmt(rec["intensity"]), _fmt(rec["pleasantness"])))
+    return csv_path
+
+
+class SessionStore:
+    def __init__(self, path, capacity=1024, flush_interval=0.5, flush_every=8):
+        """
+        Open (or create) a store.
+
+        - capacity: records preallocated up front, the file grows by the same amount when full
+        - flush_interval: seconds between background flushes
+        - flush_every: number of appended records that triggers an early flush
+
+        An existing file is reopened and appending continues after the last valid record.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._dirty = 0
+        self._wake = threading.Event()
+        self._closed = False
+
+        new_file = not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE
+        self._f = open(path, "w+b" if new_file else "r+b")
+        if new_file:
+            self._f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, 0).ljust(HEADER_SIZE, b"\0"))
+            self._f.truncate(HEADER_SIZE + capacity * RECORD.size)
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        self._grow_by = capacity
+        self._map()
+        try:
+            _check_header(self._mm, path)
+        except ValueError:
+            self._mm.close()
+            self._f.close()
+            raise
+        self.count = _scan(self._mm)
+
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    # =========================================================================
+    # WRITING
+    # =========================================================================
+    def append(self, trial, onset, rating_time, intensity, pleasantness, stim_hash=b""):
+        """Append one trial record. Cheap enough to call inside the frame loop."""
+        body = RECORD.pack(trial, time.time(), onset, rating_time, bytes(stim_hash)[:16],
+                           float("nan") if intensity is None else intensity,
+                           float("nan") if pleasantness is None else pleasantness, 0)[:-4]
+        record = body + struct.pack("<I", zlib.crc32(body))
+        with self._lock:
+            offset = HEADER_SIZE + self.count * RECORD.size
+            if offset + RECORD.size > len(self._mm):
+                self._grow()
+            self._mm[offset:offset + RECORD.size] = record
+            self.count += 1
+            self._dirty += 1
+            if self._dirty >= self.flush_every:
+                self._wake.set()
+
+    def flush(self):
+        """Force all appended records to disk."""
+        with self._lock:
+            if self._closed:
+                return
+            self._mm.flush()
+            os.fsync(self._f.fileno())
+            self._dirty = 0
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        with self._lock:
+            self._closed = True
+            self._wake.set()
+            self._mm.close()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # =========================================================================
+    # READING / EXPORT
+    # =========================================================================
+    def records(self):
+        """Return all valid records as dicts (stimulus_hash as hex)."""
+        with self._lock:
+            return _records(self._mm, self.count)
+
+    def export_csv(self, csv_path, header=VAS_HEADER, full=False):
+        """Write the records to CSV, see write_csv()."""
+        return write_csv(self.records(), csv_path, header, full)
+
+    # =========================================================================
+    # INTERNALS
+    # =========================================================================
+    def _map(self):
+        self._mm = mmap.mmap(self._f.fileno(), 0)
+
+    def _grow(self):
+        # called with the lock held
+        self._mm.flush()
+        self._mm.close()
+        self._f.truncate(os.path.getsize(self.path) + self._grow_by * RECORD.size)
+        self._map()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._dirty and not self._closed:
+                try:
+                    self.flush()
+                except (ValueError, OSError):
+                    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python session_store.py <store.bin> [out.csv]")
+        sys.exit(1)
+    src = sys.argv[1]
+    dst = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(src)[0] + ".csv"
+    # read-only, a damaged file is left as it is
+    records = read_records(src)
+    write_csv(records, dst)
+    print(f"{len(records)} trials exported to {dst}")
@@ -0,0 +1,88 @@
+'''
+SessionStore recovery and read_records(), run with pytest.
+'''
+
+import os
+import pytest
+
+from session_store import SessionStore, read_records, write_csv, stimulus_hash, HEADER_SIZE, RECORD
+
+
+def _store(path, n):
+    with SessionStore(str(path)) as store:
+        for i in range(n):
+            store.append(i, 1.0 + i, 2.0 + i, i / 2, -i / 2, stimulus_hash("stim_a"))
+
+
+def test_read_records_matches_the_store(tmp_path):
+    path = tmp_path / "2024-01-01_10-00-00_P01_vas-data.bin"
+    _store(path, 5)
+    records = read_records(str(path))
+    assert [r["trial"] for r in records] == list(range(5))
+    assert records[3]["intensity"] == 1.5 and records[3]["pleasantness"] == -1.5
+    assert records[0]["stimulus_hash"] == stimulus_hash("stim_a").hex()
+
+
+@pytest.mark.parametrize("content", [b"", b"VASSTOR1\x01"])
+def test_read_records_leaves_a_short_file_alone(tmp_path, content):
+    path = tmp_path / "2024-01-01_10-00-00_P01_vas-data.bin"
+    path.write_bytes(content)
+    with pytest.raises(ValueError):
+        read_records(str(path))
+    assert path.read_bytes() == content
+
+
+def test_ingest_does_not_change_session_files(tmp_path):
+    from session_ingest import parse_file
+    good = tmp_path / "2024-01-01_10-00-00_P01_vas-data.bin"
+    _store(good, 3)
+    before = good.read_bytes()
+    assert parse_file(str(good), "vas_data")["vas"]["trial"] == [0, 1, 2]
+    assert good.read_bytes() == before
+    short = tmp_path / "2024-01-01_11-00-00_P01_vas-data.bin"
+    short.write_bytes(b"\0" * (HEADER_SIZE - 1))
+    with pytest.raises(ValueError):
+        parse_file(str(short), "vas_data")
+    assert os.path.getsize(short) == HEADER_SIZE - 1
+
+
+def _record_offset(i):
+    return HEADER_SIZE + i * RECORD.size
+
+
+def test_scan_stops_at_a_corrupted_record(tmp_path):
+    path = tmp_path / "2024-01-01_10-00-00_P01_vas-data.bin"
+    _store(path, 6)
+    data = bytearray(path.read_bytes())
+    # one flipped bit in the intensity of record 3
+    data[_record_offset(3) + 44] ^= 0x01
+    path.write_bytes(bytes(data))
+    assert [r["trial"] for r in read_records(str(path))] == [0, 1, 2]
+
+
+def test_reopen_after_a_torn_write_continues_after_the_last_valid_record(tmp_path):
+    path = tmp_path / "2024-01-01_10-00-00_P01_vas-data.bin"
+    _store(path, 4)
+    data = bytearray(path.read_bytes())
+    # record 3 only partly reached the disk, its CRC no longer matches
+    data[_record_offset(3) + RECORD.size // 2:_record_offset(4)] = bytes(RECORD.size - RECORD.size // 2)
+    path.write_bytes(bytes(data))
+    with SessionStore(str(path)) as store:
+        assert store.count == 3
+        store.append(10, 0.0, 0.5, 7, 8, stimulus_hash("stim_b"))
+        store.append(11, 0.0, 0.5, None, 9)
+    records = read_records(str(path))
+    assert [r["trial"] for r in records] == [0, 1, 2, 10, 11]
+    assert records[3]["stimulus_hash"] == stimulus_hash("stim_b").hex()
+    assert records[4]["intensity"] != records[4]["intensity"]
+    csv_path = tmp_path / "out.csv"
+    write_csv(records, str(csv_path))
+    assert csv_path.read_text().splitlines()[-2:] == ["7,8", "None,9"]
+
+
+def test_store_grows_past_its_capacity(tmp_path):
+    path = tmp_path / "2024-01-01_10-00-00_P01_vas-data.bin"
+    with SessionStore(str(path), capacity=4) as store:
+        for i in range(10):
+            store.append(i, 0.0, 0.0, i, i)
+    assert [r["trial"] for r in read_records(str(path))] == list(range(10))
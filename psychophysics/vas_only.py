@@ -1,6 +1,7 @@
 from psychopy import visual, core, gui, data, event
 import numpy, random, os, pygame
 from math import *
+from session_store import SessionStore, stimulus_hash
 
 # -- DISPLAY TEXT --
 
@@ -40,6 +41,7 @@ exptInfo = {'01. Participant Code':'P00',
             '03. Number of repeats':20, 
             '04. Laser threshold':0.0, 
             '05. Stimulation site':'dorsal left hand',
+            '06. Stimulus file':'',
             '08. Participant language':('en','sv'),
             '09. Folder for saving data':'data'}
 exptInfo['10. Date and time']= data.getDateStr(format='%Y-%m-%d_%H-%M-%S') ##add the current time
@@ -68,12 +70,27 @@ if not exptInfo['02. Condition'] == 'practice':
     infoFile = open(fileName+'_info.csv', 'w') 
     # for k,v in exptInfo.iteritems(): infoFile.write(k + ',' + str(v) + '\n')
     for k,v in exptInfo.items(): infoFile.write(k + ',' + str(v) + '\n')
+    infoFile.flush()
+    ## ratings go to a crash-safe store, the csv is exported from it at the end
+    ## (recover an aborted session with: python session_store.py <file>.bin)
     if exptInfo['02. Condition'] == 'pleasantness':
-        dataFile = open(fileName+'_pleasantness-data.csv', 'w')
-        dataFile.write('stroke,rating\n')
+        dataName, dataHeader = fileName+'_pleasantness-data', 'stroke,rating'
     else:
-        dataFile = open(fileName+'_vas-data.csv', 'w')
-        dataFile.write('intensity-rating,pleasantness-rating\n')
+        dataName, dataHeader = fileName+'_vas-data', 'intensity-rating,pleasantness-rating'
+    dataFile = SessionStore(dataName+'.bin')
+    ## every record names the stimulus played: the content of the stimulus file
+    ## (e.g. the csv sent to the Arduino), or what was typed if it is not a file
+    stimulusFile = exptInfo['06. Stimulus file'].strip()
+    if os.path.isfile(stimulusFile):
+        with open(stimulusFile, 'rb') as f:
+            stimulusHash = stimulus_hash(f.read())
+    else:
+        stimulusHash = stimulus_hash(stimulusFile) if stimulusFile else b''
+
+def closeDataFiles():
+    infoFile.close()
+    dataFile.export_csv(dataName+'.csv', header=dataHeader)
+    dataFile.close()
 
 
 # ----
@@ -124,7 +141,7 @@ event.clearEvents()
 waitMessage.draw()
 win.flip()
 if 'escape' in event.waitKeys():
-    if not exptInfo['02. Condition'] == 'practice': infoFile.close(); dataFile.close()
+    if not exptInfo['02. Condition'] == 'practice': closeDataFiles()
     core.quit()
 
 
@@ -142,6 +159,8 @@ else:
         interStimMessage.draw()
         win.flip()
         
+        trialOnset = core.getTime()
+        
         ## present VAS
         core.wait(3.0) # 3 seconds "..." interval
         event.clearEvents()
@@ -151,7 +170,7 @@ else:
             win.flip()
             if event.getKeys(['escape']):
                 print('user aborted')
-                if not exptInfo['02. Condition'] == 'practice': infoFile.close(); dataFile.close()
+                if not exptInfo['02. Condition'] == 'practice': closeDataFiles()
                 core.quit()
         
         ## check rating
@@ -162,7 +181,7 @@ else:
         
         ## record the data if not a practice run
         if not exptInfo['02. Condition'] == 'practice':
-            dataFile.write('{},{}\n' .format(intensityRating,pleasantnessRating)) 
+            dataFile.append(trialNum, trialOnset, core.getTime(), intensityRating, pleasantnessRating, stimulusHash)
         
         print('{} of {} trials complete\n' .format(trialNum+1, exptInfo['03. Number of repeats']))
 
@@ -174,8 +193,7 @@ print('\n=== EXPERIMENT FINISHED ===\n')
 
 ## save data to file
 if not exptInfo['02. Condition'] == 'practice':
-    infoFile.close()
-    dataFile.close()
+    closeDataFiles()
     print('Data saved {}\n\n' .format(fileName))
 else:
     print('Practice only, no data saved.')